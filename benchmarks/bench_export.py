@@ -0,0 +1,105 @@
+"""Benchmark: one .ini file per session against a single XML import file.
+
+Generates one synthetic lab of each --nodes size with both session formats
+of batch_generate(), into a fresh Sessions directory each time, then again
+with nothing changed. Reports wall time, files and bytes written. Fails if
+the XML import file does not parse, so it doubles as a check of the export.
+
+    python benchmarks/bench_export.py [--nodes 10 --nodes 10000] [--dir DIR]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import session_gen  # noqa: E402
+from bench_render import write_node_session_template  # noqa: E402
+
+DEFAULT_NODES = (10, 100, 1000, 10000)
+
+
+def synthetic_lab_info(nodes):
+    lab_tile = dict()
+    lab_tile["id"] = "00000000-0000-4000-8000-000000000000"
+    lab_tile["lab_title"] = "Benchmark Lab"
+    lab_tile["state"] = "STARTED"
+    lab_tile["topology"] = {
+        "nodes": [
+            {"id": f"n{number}", "label": f"R{number}", "node_definition": "iosv"}
+            for number in range(nodes)
+        ]
+    }
+
+    return session_gen.build_lab_info({lab_tile["id"]: lab_tile})
+
+
+def generate(sessions_cml_labs_dir, lab_info, session_format):
+    # Returns (seconds, files written, bytes written)
+    session_gen.reset_run_stats()
+    start_time = time.perf_counter()
+    results = session_gen.batch_generate(
+        sessions_cml_labs_dir,
+        lab_info,
+        lab_info["lab_details"],
+        session_gen.INVALID_CHARS,
+        session_format=session_format,
+    )
+    seconds = time.perf_counter() - start_time
+
+    errors = [result["error"] for result in results if result["error"]]
+    if errors:
+        raise RuntimeError(f"{session_format}: {errors[0]}")
+    run_stats = session_gen.run_stats()
+
+    return seconds, run_stats["files_written"], run_stats["bytes_written"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, action="append", help="nodes per lab")
+    parser.add_argument("--dir", help="directory to write into (default: temp)")
+    args = parser.parse_args()
+
+    rows = []
+    for nodes in args.nodes or DEFAULT_NODES:
+        lab_info = synthetic_lab_info(nodes)
+        for session_format in session_gen.SESSION_FORMATS:
+            root_dir = tempfile.mkdtemp(prefix="bench_export_", dir=args.dir)
+            try:
+                sessions_cml_labs_dir = os.path.join(
+                    root_dir, "Sessions", "CML cml.example.com Labs"
+                )
+                os.makedirs(sessions_cml_labs_dir)
+                write_node_session_template(sessions_cml_labs_dir)
+
+                first_run = generate(sessions_cml_labs_dir, lab_info, session_format)
+                second_run = generate(sessions_cml_labs_dir, lab_info, session_format)
+
+                if session_format == session_gen.SESSION_FORMAT_XML:
+                    xml.etree.ElementTree.parse(
+                        session_gen.export_file_path(sessions_cml_labs_dir)
+                    )
+            finally:
+                shutil.rmtree(root_dir, ignore_errors=True)
+
+            rows.append((nodes, session_format, first_run, second_run[0]))
+
+    print(
+        f"{'NODES':>6} {'FORMAT':<6} {'GENERATE':>10} {'UNCHANGED':>10} "
+        f"{'FILES':>6} {'MB':>8}"
+    )
+    for nodes, session_format, (seconds, files, written), unchanged in rows:
+        print(
+            f"{nodes:>6} {session_format:<6} {seconds:9.3f}s {unchanged:9.3f}s "
+            f"{files:>6} {written / 1e6:8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Microbenchmark: per-node cost of rendering and writing node session files.
+
+Compares the original copy-then-rewrite approach (shutil.copyfile, read back,
+two str.replace passes, write again) against the compiled template used by
+generate_node_sessions_files().
+
+    python benchmarks/bench_render.py [--nodes 5000]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import session_gen  # noqa: E402
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_node_session_template(sessions_cml_labs_dir):
+    # Same transformation setup() applies to cml_console_server
+    with open(os.path.join(SOURCE_DIR, "cml_console_server"), encoding="utf-8") as f:
+        template = f.read()
+    template = template.replace("CHANGEME_USER", "benchmark")
+    template = template.replace("CHANGEME_CONTR", "cml.example.com")
+    template = template.replace(
+        "CHANGEME_CMD", "open /CHANGEME_LAB_TITLE/CHANGEME_NODE_LABEL/0"
+    )
+
+    template_location = os.path.join(sessions_cml_labs_dir, "node_session_template")
+    with open(template_location, "w", encoding="utf-8", newline="") as f:
+        f.write(template)
+
+    return template_location
+
+
+def copy_then_rewrite(template_location, node_session_dir, lab_title, labels):
+    for label in labels:
+        node_session_file = shutil.copyfile(
+            template_location, os.path.join(node_session_dir, label + ".ini")
+        )
+        with open(node_session_file, "r") as f:
+            data = f.read()
+            data = data.replace("CHANGEME_LAB_TITLE", lab_title)
+            data = data.replace("CHANGEME_NODE_LABEL", label)
+        with open(node_session_file, "w") as f:
+            f.write(data)
+
+
+def compiled_render(template_location, node_session_dir, lab_title, labels):
+    compiled_template = session_gen.load_node_session_template(template_location)
+    for label in labels:
+        data = session_gen.render_node_session(
+            compiled_template,
+            {
+                "CHANGEME_LAB_TITLE": lab_title,
+                "CHANGEME_NODE_LABEL": label,
+                "CHANGEME_CONSOLE_LINE": "0",
+            },
+        )
+        with open(
+            os.path.join(node_session_dir, label + ".ini"),
+            "w",
+            encoding="utf-8",
+            newline="",
+        ) as f:
+            f.write(data)
+
+
+def render_only(template_location, labels):
+    compiled_template = session_gen.load_node_session_template(template_location)
+    for label in labels:
+        session_gen.render_node_session(
+            compiled_template,
+            {
+                "CHANGEME_LAB_TITLE": "Benchmark Lab",
+                "CHANGEME_NODE_LABEL": label,
+                "CHANGEME_CONSOLE_LINE": "0",
+            },
+        )
+
+
+def timed(function, *args):
+    start_time = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=5000)
+    args = parser.parse_args()
+
+    labels = [f"R{number}" for number in range(args.nodes)]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        template_location = write_node_session_template(temp_dir)
+
+        results = []
+        for name, function in (
+            ("copy-then-rewrite", copy_then_rewrite),
+            ("compiled template", compiled_render),
+        ):
+            node_session_dir = os.path.join(temp_dir, name)
+            os.makedirs(node_session_dir)
+            seconds = timed(
+                function, template_location, node_session_dir, "Benchmark Lab", labels
+            )
+            results.append((name, seconds))
+
+        results.append(("render only", timed(render_only, template_location, labels)))
+
+    print(f"{args.nodes} nodes")
+    for name, seconds in results:
+        print(
+            f"{name:<20} {seconds:8.3f} s total "
+            f"{seconds / args.nodes * 1e6:10.1f} us/node"
+        )
+
+
+if __name__ == "__main__":
+    main()
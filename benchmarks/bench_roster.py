@@ -0,0 +1,122 @@
+"""Benchmark: one --roster run against one headless run per user.
+
+Starts benchmarks/fake_cml.py and gives --users users a Sessions folder with
+its own node_session_template, then generates every lab for all of them in
+two ways, each into fresh Sessions folders: one session_gen.py --headless
+--batch run per user, the way each engineer on a shared jump host runs it,
+and a single --roster run. Reports wall time and the HTTP requests the
+controller served.
+
+    python benchmarks/bench_roster.py [--users 8] [--labs 50] [--nodes 20]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import session_gen  # noqa: E402
+from bench_render import SOURCE_DIR, write_node_session_template  # noqa: E402
+from bench_service import session_gen_command  # noqa: E402
+from fake_cml import start_fake_cml  # noqa: E402
+
+
+def user_sessions_dirs(fake_cml, root_dir, users):
+    # Sessions folders as setup leaves them, one per user
+    sessions_dirs = []
+    for number in range(users):
+        sessions_dir = os.path.join(root_dir, f"user{number}", "Sessions")
+        sessions_cml_labs_dir = os.path.join(
+            sessions_dir, session_gen.cml_labs_dir_name(fake_cml.controller)
+        )
+        os.makedirs(sessions_cml_labs_dir)
+        write_node_session_template(sessions_cml_labs_dir)
+        sessions_dirs.append(sessions_dir)
+
+    return sessions_dirs
+
+
+def timed_run(fake_cml, command):
+    # Returns (seconds, requests served)
+    fake_cml.requests.clear()
+    start_time = time.perf_counter()
+    subprocess.run(command, cwd=SOURCE_DIR, capture_output=True, check=True)
+
+    return time.perf_counter() - start_time, len(fake_cml.requests)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--labs", type=int, default=50)
+    parser.add_argument("--nodes", type=int, default=20, help="nodes per lab")
+    args = parser.parse_args()
+
+    fake_cml = start_fake_cml(labs=args.labs, nodes=args.nodes)
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            per_user_seconds = 0
+            per_user_requests = 0
+            per_user_dir = os.path.join(temp_dir, "per-user")
+            for number, sessions_dir in enumerate(
+                user_sessions_dirs(fake_cml, per_user_dir, args.users)
+            ):
+                seconds, requests = timed_run(
+                    fake_cml,
+                    session_gen_command(
+                        fake_cml,
+                        sessions_dir,
+                        os.path.join(per_user_dir, f"user{number}", "config.yaml"),
+                        "--headless",
+                        "--batch",
+                    ),
+                )
+                per_user_seconds += seconds
+                per_user_requests += requests
+
+            roster_dir = os.path.join(temp_dir, "roster")
+            roster_file = os.path.join(roster_dir, "roster.yaml")
+            sessions_dirs = user_sessions_dirs(fake_cml, roster_dir, args.users)
+            with open(roster_file, "w") as f:
+                f.write("users:\n")
+                for number, sessions_dir in enumerate(sessions_dirs):
+                    f.write(f"  - name: user{number}\n")
+                    f.write(f"    sessions_dir: '{sessions_dir}'\n")
+
+            roster_seconds, roster_requests = timed_run(
+                fake_cml,
+                [
+                    sys.executable,
+                    os.path.join(SOURCE_DIR, "session_gen.py"),
+                    "--roster",
+                    roster_file,
+                    "--controller",
+                    fake_cml.controller,
+                    "--username",
+                    "benchmark",
+                    "--password",
+                    "benchmark",
+                    "--config",
+                    os.path.join(roster_dir, "config.yaml"),
+                ],
+            )
+    finally:
+        fake_cml.stop()
+
+    print(
+        f"{args.users} users, {args.labs} labs of {args.nodes} nodes, "
+        f"{session_gen.ROSTER_PROCESSES} roster process(es)"
+    )
+    for name, seconds, requests in (
+        ("per-user runs", per_user_seconds, per_user_requests),
+        ("roster run", roster_seconds, roster_requests),
+    ):
+        print(f"{name:<14} {seconds:8.2f} s {requests:8} HTTP requests")
+
+
+if __name__ == "__main__":
+    main()
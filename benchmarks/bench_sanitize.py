@@ -0,0 +1,110 @@
+"""Microbenchmark: sanitizing lab titles and node labels into file names.
+
+Compares the original per-character loop (one `in` test and `replace` per
+invalid character) against the single str.translate() pass of sanitize_name()
+on its own and together with the Windows checks sanitize_name() adds, and
+times unique_names(), which also resolves labels that end up with the same
+file name, over --labels synthetic labels.
+
+    python benchmarks/bench_sanitize.py [--labels 100000]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import session_gen  # noqa: E402
+
+# The original tuple, including its two-character "\/" entry
+LEGACY_INVALID_CHARS = ("<", ">", ":", '"', "\\/", "\\", "|", "?", "*")
+
+
+def legacy_sanitize_name(name, invalid_chars):
+    for invalid_char in invalid_chars:
+        if invalid_char in name:
+            name = name.replace(invalid_char, "_").strip()
+
+    return name
+
+
+def synthetic_labels(count):
+    # Mostly plain labels, with invalid characters, reserved names, trailing
+    # dots and labels that only differ in case or in an invalid character
+    shapes = (
+        "R{number}",
+        "SW-{number}",
+        "core:{number}/edge",
+        "r{number}",
+        "R{number}?",
+        "CON",
+        "srv {number}. ",
+        'a<b>c"{number}"|*',
+    )
+    return {
+        f"n{number}": shapes[number % len(shapes)].format(number=number // 4)
+        for number in range(count)
+    }
+
+
+def timed(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start_time, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--labels", type=int, default=100000)
+    args = parser.parse_args()
+
+    labels = synthetic_labels(args.labels)
+    label_values = list(labels.values())
+
+    legacy_seconds, _ = timed(
+        lambda: [
+            legacy_sanitize_name(label, LEGACY_INVALID_CHARS) for label in label_values
+        ]
+    )
+    translate_seconds, _ = timed(
+        lambda: [
+            session_gen.sanitize_name(label, session_gen.INVALID_CHARS)
+            for label in label_values
+        ]
+    )
+    table = session_gen.sanitize_table(session_gen.INVALID_CHARS)
+    translate_only_seconds, _ = timed(
+        lambda: [label.translate(table) for label in label_values]
+    )
+    unique_seconds, unique_labels = timed(
+        session_gen.unique_names, labels, session_gen.INVALID_CHARS
+    )
+
+    sanitized_count = len(
+        set(
+            session_gen.sanitize_name(label, session_gen.INVALID_CHARS).casefold()
+            for label in label_values
+        )
+    )
+    unique_count = len(set(label.casefold() for label in unique_labels.values()))
+
+    print(f"{args.labels} labels")
+    for name, seconds in (
+        ("per-character loop", legacy_seconds),
+        ("translate pass only", translate_only_seconds),
+        ("sanitize_name", translate_seconds),
+        ("unique_names", unique_seconds),
+    ):
+        print(
+            f"{name:<20} {seconds:8.3f} s {seconds / args.labels * 1e6:8.2f} us/label"
+        )
+    print(
+        f"{args.labels - sanitized_count} colliding label(s) resolved, "
+        f"{unique_count} unique file names"
+    )
+
+
+if __name__ == "__main__":
+    main()
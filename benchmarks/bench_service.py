@@ -0,0 +1,161 @@
+"""Benchmark: service mode (--serve) against one-off headless runs.
+
+Starts benchmarks/fake_cml.py, then session_gen.py --serve against it, and
+times --requests calls of GET /labs and POST /labs/<id>/generate. For
+comparison it times --cold-runs runs of session_gen.py --headless --lab-id
+for the same lab, each paying interpreter start-up, authentication and the
+lab list download. Fails if the service returns anything but 200, so it
+doubles as an end-to-end check of service mode.
+
+    python benchmarks/bench_service.py [--labs 200] [--nodes 20] [--requests 50]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import session_gen  # noqa: E402
+from bench_render import SOURCE_DIR, write_node_session_template  # noqa: E402
+from fake_cml import start_fake_cml  # noqa: E402
+
+
+def session_gen_command(fake_cml, sessions_dir, config_yaml, *extra_args):
+    return [
+        sys.executable,
+        "-u",
+        os.path.join(SOURCE_DIR, "session_gen.py"),
+        "--controller",
+        fake_cml.controller,
+        "--username",
+        "benchmark",
+        "--password",
+        "benchmark",
+        "--output-root",
+        sessions_dir,
+        "--config",
+        config_yaml,
+        *extra_args,
+    ]
+
+
+def start_service(fake_cml, sessions_dir, config_yaml):
+    # Returns (process, base URL) once the service prints its address
+    service = subprocess.Popen(
+        session_gen_command(
+            fake_cml, sessions_dir, config_yaml, "--serve", "--port", "0"
+        ),
+        cwd=SOURCE_DIR,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    for line in service.stdout:
+        if line.startswith("Serving "):
+            return service, line.split(" on ", 1)[1].split(" ", 1)[0]
+    raise RuntimeError(f"service did not start (exit status {service.wait()})")
+
+
+def call(base_url, token, method, path):
+    request = urllib.request.Request(
+        base_url + path,
+        method=method,
+        headers={"Authorization": "Bearer " + token},
+        data=b"" if method == "POST" else None,
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def timed_calls(count, function, *args):
+    seconds = []
+    for _ in range(count):
+        start_time = time.perf_counter()
+        function(*args)
+        seconds.append(time.perf_counter() - start_time)
+    seconds.sort()
+    return seconds[len(seconds) // 2], seconds[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--labs", type=int, default=200)
+    parser.add_argument("--nodes", type=int, default=20, help="nodes per lab")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--cold-runs", type=int, default=5)
+    args = parser.parse_args()
+
+    fake_cml = start_fake_cml(labs=args.labs, nodes=args.nodes)
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            sessions_dir = os.path.join(temp_dir, "Sessions")
+            sessions_cml_labs_dir = os.path.join(
+                sessions_dir, session_gen.cml_labs_dir_name(fake_cml.controller)
+            )
+            os.makedirs(sessions_cml_labs_dir)
+            write_node_session_template(sessions_cml_labs_dir)
+            config_yaml = os.path.join(temp_dir, "config.yaml")
+            lab_id = next(iter(fake_cml.labs))
+
+            def cold_run():
+                subprocess.run(
+                    session_gen_command(
+                        fake_cml,
+                        sessions_dir,
+                        config_yaml,
+                        "--headless",
+                        "--lab-id",
+                        lab_id,
+                    ),
+                    cwd=SOURCE_DIR,
+                    capture_output=True,
+                    check=True,
+                )
+
+            cold = timed_calls(args.cold_runs, cold_run)
+
+            service, base_url = start_service(fake_cml, sessions_dir, config_yaml)
+            try:
+                token_file = os.path.join(temp_dir, session_gen.SERVICE_TOKEN_FILENAME)
+                with open(token_file) as f:
+                    token = f.read().strip()
+
+                labs = call(base_url, token, "GET", "/labs")["labs"]
+                if len(labs) != args.labs:
+                    raise RuntimeError(f"service listed {len(labs)} labs")
+                list_labs = timed_calls(
+                    args.requests, call, base_url, token, "GET", "/labs"
+                )
+                generate = timed_calls(
+                    args.requests,
+                    call,
+                    base_url,
+                    token,
+                    "POST",
+                    f"/labs/{lab_id}/generate",
+                )
+            finally:
+                service.terminate()
+                service.wait()
+    finally:
+        fake_cml.stop()
+
+    print(f"{args.labs} labs of {args.nodes} nodes")
+    for name, (median, slowest) in (
+        ("cold headless run", cold),
+        ("service: list labs", list_labs),
+        ("service: generate", generate),
+    ):
+        print(
+            f"{name:<20} median {median * 1000:9.1f} ms   slowest {slowest * 1000:9.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
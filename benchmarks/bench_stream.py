@@ -0,0 +1,191 @@
+"""Peak memory of parsing a large populate_lab_tiles response.
+
+Feeds a synthetic populate_lab_tiles body (generated chunk by chunk, never held
+in memory as a whole) through the streaming parser used by get_lab_info() and
+reports peak RSS, both for the parser alone ("streaming") and when the compact
+lab tiles get_lab_info() keeps are retained ("streaming-compact"). With
+--buffered the same body is also parsed the old way, with the whole body
+buffered and passed to json.loads(), for comparison. Where the resource module
+is missing (Windows), the peak of the memory traced by tracemalloc is reported
+instead.
+
+    python benchmarks/bench_stream.py [--megabytes 100] [--buffered]
+
+Exits with status 1 if the parser's peak RSS grows by more than
+--max-growth-mb (default: 64) while parsing.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Windows; tracemalloc's peak stands in for peak RSS
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import session_gen  # noqa: E402
+
+CHUNK_SIZE = 64 * 1024
+
+
+def synthetic_lab_tile(lab_number, nodes_per_lab):
+    # Shaped like a CML lab tile, padded with fields the generator ignores
+    return {
+        "id": f"{lab_number:08x}-0000-4000-8000-000000000000",
+        "lab_title": f"Synthetic Lab {lab_number}",
+        "lab_description": "x" * 512,
+        "state": "STOPPED",
+        "owner": "00000000-0000-4000-8000-000000000001",
+        "topology": {
+            "nodes": [
+                {
+                    "id": f"n{node_number}",
+                    "label": f"R{node_number}",
+                    "node_definition": "iosv",
+                    "x": node_number,
+                    "y": -node_number,
+                    "configuration": "!\nhostname R\n!\n" * 8,
+                    "interfaces": [
+                        {"id": f"i{number}", "label": f"Gi0/{number}"}
+                        for number in range(4)
+                    ],
+                }
+                for node_number in range(nodes_per_lab)
+            ],
+            "links": [],
+        },
+    }
+
+
+def iter_synthetic_body(megabytes, nodes_per_lab):
+    # Yields the body in CHUNK_SIZE byte chunks until about `megabytes` MB
+    target_bytes = megabytes * 1024 * 1024
+    sent_bytes = 0
+    pending = b'{"lab_tiles": {'
+    lab_number = 0
+
+    while sent_bytes + len(pending) < target_bytes:
+        lab_tile = synthetic_lab_tile(lab_number, nodes_per_lab)
+        separator = b", " if lab_number else b""
+        pending += separator + json.dumps(lab_tile["id"]).encode() + b": "
+        pending += json.dumps(lab_tile).encode()
+        lab_number += 1
+        while len(pending) >= CHUNK_SIZE:
+            yield pending[:CHUNK_SIZE]
+            sent_bytes += CHUNK_SIZE
+            pending = pending[CHUNK_SIZE:]
+
+    yield pending + b"}}"
+
+
+def peak_rss_mb():
+    if resource is None:
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak_rss / (1024 * 1024)
+    return peak_rss / 1024
+
+
+def run(mode, megabytes, nodes_per_lab):
+    if resource is None:
+        tracemalloc.start()
+    baseline_mb = peak_rss_mb()
+    start_time = time.perf_counter()
+
+    if mode == "streaming":
+        lab_count = 0
+        for lab_id, lab_tile in session_gen.iter_lab_tiles(
+            iter_synthetic_body(megabytes, nodes_per_lab)
+        ):
+            session_gen.compact_lab_tile(lab_tile)
+            lab_count += 1
+        lab_tiles = range(lab_count)
+    elif mode == "streaming-compact":
+        lab_tiles = dict()
+        for lab_id, lab_tile in session_gen.iter_lab_tiles(
+            iter_synthetic_body(megabytes, nodes_per_lab)
+        ):
+            lab_tiles[lab_id] = session_gen.compact_lab_tile(lab_tile)
+    else:
+        body = b"".join(iter_synthetic_body(megabytes, nodes_per_lab))
+        lab_tiles = json.loads(body)["lab_tiles"]
+
+    result = {
+        "mode": mode,
+        "megabytes": megabytes,
+        "labs": len(lab_tiles),
+        "seconds": round(time.perf_counter() - start_time, 3),
+        "baseline_rss_mb": round(baseline_mb, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "memory": "rss" if resource is not None else "tracemalloc",
+    }
+    result["rss_growth_mb"] = round(result["peak_rss_mb"] - baseline_mb, 1)
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--megabytes", type=int, default=100)
+    parser.add_argument("--nodes-per-lab", type=int, default=20)
+    parser.add_argument("--buffered", action="store_true")
+    parser.add_argument("--max-growth-mb", type=float, default=64)
+    parser.add_argument(
+        "--mode",
+        choices=("streaming", "streaming-compact", "buffered"),
+        help=argparse.SUPPRESS,
+    )
+    args = parser.parse_args()
+
+    if args.mode:
+        # Child process: one measurement per process so peak RSS is not shared
+        print(json.dumps(run(args.mode, args.megabytes, args.nodes_per_lab)))
+        return 0
+
+    modes = ["streaming", "streaming-compact"]
+    if args.buffered:
+        modes.append("buffered")
+    results = []
+    for mode in modes:
+        output = subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--mode",
+                mode,
+                "--megabytes",
+                str(args.megabytes),
+                "--nodes-per-lab",
+                str(args.nodes_per_lab),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results.append(json.loads(output))
+
+    print(json.dumps(results, indent=2))
+
+    if results[0]["rss_growth_mb"] > args.max_growth_mb:
+        print(
+            f"FAIL: streaming parser peak RSS grew by {results[0]['rss_growth_mb']} MB "
+            f"(limit {args.max_growth_mb} MB)"
+        )
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
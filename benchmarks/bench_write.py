@@ -0,0 +1,98 @@
+"""Microbenchmark: writing session files serially and with the writer pool.
+
+Writes --files rendered node sessions with write_session_files(), once with
+one worker and once per --workers value, into a fresh directory each time.
+Point --dir at a network share (e.g. the SMB-backed roaming profile) to see
+the real round-trip cost, or use --latency-ms to add a simulated round trip
+to every file on a local disk.
+
+    python benchmarks/bench_write.py [--files 5000] [--workers 4 --workers 8]
+    python benchmarks/bench_write.py --dir //server/profile/bench --files 2000
+    python benchmarks/bench_write.py --latency-ms 5
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import session_gen  # noqa: E402
+from bench_render import write_node_session_template  # noqa: E402
+
+
+def with_latency(write_session_file, latency_seconds):
+    # Stands in for the per-file round trip of a network filesystem
+    def delayed_write_session_file(*args):
+        time.sleep(latency_seconds)
+        return write_session_file(*args)
+
+    return delayed_write_session_file
+
+
+def pending_writes(template_location, node_session_dir, files):
+    compiled_template = session_gen.load_node_session_template(template_location)
+    return [
+        (
+            os.path.join(node_session_dir, f"R{number}.ini"),
+            session_gen.render_node_session(
+                compiled_template,
+                {
+                    "CHANGEME_LAB_TITLE": "Benchmark Lab",
+                    "CHANGEME_NODE_LABEL": f"R{number}",
+                    "CHANGEME_CONSOLE_LINE": "0",
+                },
+            ),
+        )
+        for number in range(files)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--workers", type=int, action="append")
+    parser.add_argument("--dir", help="directory to write into (default: temp)")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    if args.latency_ms:
+        session_gen.write_session_file = with_latency(
+            session_gen.write_session_file, args.latency_ms / 1000
+        )
+
+    root_dir = tempfile.mkdtemp(prefix="bench_write_", dir=args.dir)
+    try:
+        template_location = write_node_session_template(root_dir)
+        results = []
+        for workers in [1] + (args.workers or [session_gen.SESSION_WRITE_WORKERS]):
+            node_session_dir = os.path.join(root_dir, f"workers-{workers}")
+            os.makedirs(node_session_dir)
+            writes = pending_writes(template_location, node_session_dir, args.files)
+
+            start_time = time.perf_counter()
+            write_results = session_gen.write_session_files(writes, workers)
+            seconds = time.perf_counter() - start_time
+
+            errors = [error for written, error in write_results if error is not None]
+            if errors:
+                raise RuntimeError(f"{len(errors)} file(s) failed: {errors[0]}")
+            results.append((workers, seconds))
+    finally:
+        shutil.rmtree(root_dir, ignore_errors=True)
+
+    print(f"{args.files} files, {args.latency_ms} ms simulated latency")
+    serial_seconds = results[0][1]
+    for workers, seconds in results:
+        print(
+            f"{workers:>3} worker(s) {seconds:8.3f} s "
+            f"{args.files / seconds:10.0f} files/s "
+            f"{serial_seconds / seconds:6.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+"""Local stand-in for the CML controller API used by benchmarks and tests.
+
+Serves generated labs of configurable size from the endpoints session_gen.py
+uses: /authenticate, /system_information, /labs, /labs/{id},
+/labs/{id}/nodes, /populate_lab_tiles and /node_definitions. Responses are serialized once up
+front, gzip-compressed when the client asks for it and carry ETags so
+conditional requests are answered with 304. Tests can make the next requests
+for a path fail with FakeCML.inject_faults().
+
+    python benchmarks/fake_cml.py --labs 100 --nodes 50 [--port 8080]
+    python benchmarks/fake_cml.py --https ...   (needs the openssl CLI)
+
+The controller to give session_gen.py is printed on startup, e.g.
+http://127.0.0.1:8080. Any username and password are accepted except the
+password "wrong", which is rejected with 403.
+"""
+
+import argparse
+import base64
+import gzip
+import hashlib
+import json
+import os
+import socket
+import ssl
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+API_PREFIX = "/api/v0"
+TOKEN_LIFETIME = 3600
+
+NODE_DEFINITIONS = ("iosv", "iosvl2", "csr1000v", "nxosv9000", "server")
+
+# Serial ports reported by /node_definitions
+SERIAL_PORTS = {
+    "iosv": 1,
+    "iosvl2": 1,
+    "csr1000v": 1,
+    "nxosv9000": 2,
+    "server": 1,
+    "external_connector": 0,
+    "unmanaged_switch": 0,
+}
+
+
+def fake_token(username):
+    # Unsigned JWT-shaped token so session_gen.py can read its expiry
+    def encode(claims):
+        return base64.urlsafe_b64encode(json.dumps(claims).encode()).rstrip(b"=")
+
+    header = encode({"alg": "none", "typ": "JWT"})
+    payload = encode({"sub": username, "exp": int(time.time()) + TOKEN_LIFETIME})
+
+    return (header + b"." + payload + b".").decode()
+
+
+def generate_labs(labs, nodes, extra_nodes=("external_connector",)):
+    # Returns {lab ID: lab} with `nodes` console-capable nodes per lab plus the
+    # node definitions in extra_nodes, which have no console
+    generated_labs = dict()
+
+    for lab_number in range(labs):
+        lab_id = f"{lab_number:08x}-0000-4000-8000-{lab_number:012x}"
+        lab_nodes = []
+        node_definitions = [
+            NODE_DEFINITIONS[node_number % len(NODE_DEFINITIONS)]
+            for node_number in range(nodes)
+        ] + list(extra_nodes)
+        for node_number, node_definition in enumerate(node_definitions):
+            lab_nodes.append(
+                {
+                    "id": f"n{node_number}",
+                    "lab_id": lab_id,
+                    "label": f"R{node_number}",
+                    "node_definition": node_definition,
+                    "x": node_number * 40,
+                    "y": 0,
+                    "state": "DEFINED_ON_CORE",
+                    "configuration": f"hostname R{node_number}\n",
+                    "image_definition": None,
+                    "tags": [],
+                }
+            )
+        generated_labs[lab_id] = {
+            "id": lab_id,
+            "lab_title": f"Benchmark Lab {lab_number}",
+            "lab_description": "Generated by benchmarks/fake_cml.py",
+            "state": "STOPPED" if lab_number % 3 else "STARTED",
+            "owner": "00000000-0000-4000-8000-000000000001",
+            "owner_username": "admin",
+            "created": "2026-01-01T00:00:00+00:00",
+            "modified": "2026-01-01T00:00:00+00:00",
+            "node_count": len(lab_nodes),
+            "link_count": 0,
+            "nodes": lab_nodes,
+        }
+
+    return generated_labs
+
+
+def build_responses(generated_labs, version):
+    # Path -> JSON-serializable body, serialized once by FakeCML
+    responses = dict()
+    responses["/system_information"] = {"version": version, "ready": True}
+    responses["/labs"] = list(generated_labs)
+
+    lab_tiles = dict()
+    for lab_id, lab in generated_labs.items():
+        lab_summary = {key: value for key, value in lab.items() if key != "nodes"}
+        responses[f"/labs/{lab_id}"] = lab_summary
+        responses[f"/labs/{lab_id}/nodes"] = lab["nodes"]
+        lab_tiles[lab_id] = dict(lab_summary, topology={"nodes": lab["nodes"]})
+    responses["/populate_lab_tiles"] = {"lab_tiles": lab_tiles}
+    responses["/node_definitions"] = [
+        {
+            "id": node_definition,
+            "general": {"description": f"Stand-in {node_definition}"},
+            "device": {"interfaces": {"serial_ports": serial_ports}},
+        }
+        for node_definition, serial_ports in SERIAL_PORTS.items()
+    ]
+
+    return responses
+
+
+class FakeCML:
+    """A running stand-in controller; use start_fake_cml() to create one."""
+
+    def __init__(
+        self, labs, nodes, version="2.5.0", https=False, host="127.0.0.1", port=0
+    ):
+        self.labs = generate_labs(labs, nodes)
+        self.version = version
+        self.requests = []
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._bodies = dict()
+        self._faults = dict()
+        self.set_responses(build_responses(self.labs, version))
+
+        self.server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.server.daemon_threads = True
+        scheme = "http"
+        if https:
+            self.server.socket = _ssl_context().wrap_socket(
+                self.server.socket, server_side=True
+            )
+            scheme = "https"
+        self.controller = f"{scheme}://{host}:{self.server.server_port}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def set_responses(self, responses):
+        # Pre-serializes bodies, their gzip form and their ETag
+        bodies = dict()
+        for path, body in responses.items():
+            raw_body = json.dumps(body).encode()
+            bodies[path] = (
+                raw_body,
+                gzip.compress(raw_body, compresslevel=1),
+                '"' + hashlib.sha1(raw_body).hexdigest() + '"',
+            )
+        with self._lock:
+            self._bodies.update(bodies)
+
+    def body(self, path):
+        with self._lock:
+            return self._bodies.get(path)
+
+    def inject_faults(self, path, *faults):
+        # The next requests for path (without query string) fail in turn. A
+        # status code is answered with that status, (status, seconds) adds a
+        # Retry-After header, "reset" drops the connection without a response
+        # and a float delays the normal response by that many seconds.
+        with self._lock:
+            self._faults.setdefault(path, []).extend(faults)
+
+    def next_fault(self, path):
+        with self._lock:
+            faults = self._faults.get(path)
+            return faults.pop(0) if faults else None
+
+    def record(self, method, path, bytes_sent):
+        with self._lock:
+            self.requests.append((method, path))
+            self.bytes_sent += bytes_sent
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _ssl_context():
+    # Self-signed certificate generated with the openssl CLI
+    cert_dir = tempfile.mkdtemp(prefix="fake_cml_")
+    cert_file = os.path.join(cert_dir, "cert.pem")
+    key_file = os.path.join(cert_dir, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-keyout",
+            key_file,
+            "-out",
+            cert_file,
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_file, key_file)
+
+    return context
+
+
+def _make_handler(fake_cml):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are written separately; avoid delayed-ACK stalls
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body_entry, path):
+            raw_body, gzip_body, etag = body_entry
+            # Requests are recorded before the response is sent, so a client
+            # that has its response always finds its request recorded
+            if etag is not None and self.headers.get("If-None-Match") == etag:
+                fake_cml.record(self.command, path, 0)
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            body = raw_body
+            gzip_accepted = "gzip" in self.headers.get("Accept-Encoding", "")
+            if gzip_accepted:
+                body = gzip_body
+            fake_cml.record(self.command, path, len(body))
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            if gzip_accepted:
+                self.send_header("Content-Encoding", "gzip")
+            if etag is not None:
+                self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_error_json(self, status, description, retry_after=None):
+            raw_body = json.dumps({"code": status, "description": description}).encode()
+            fake_cml.record(self.command, self.recorded_path(), len(raw_body))
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            if retry_after is not None:
+                self.send_header("Retry-After", str(retry_after))
+            self.send_header("Content-Length", str(len(raw_body)))
+            self.end_headers()
+            self.wfile.write(raw_body)
+
+        def recorded_path(self):
+            # The API path with its query string, e.g. /labs?show_all=true
+            if self.path.startswith(API_PREFIX):
+                return self.path[len(API_PREFIX) :]
+            return self.path
+
+        def api_path(self):
+            path = self.path.split("?", 1)[0]
+            if not path.startswith(API_PREFIX):
+                return None
+            return path[len(API_PREFIX) :]
+
+        def injected_fault(self):
+            # Returns True if an injected fault answered the request
+            fault = fake_cml.next_fault(self.api_path())
+            if fault is None:
+                return False
+            if fault == "reset":
+                fake_cml.record(self.command, self.recorded_path(), 0)
+                # Closing with a zero linger time sends a TCP reset
+                self.connection.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+                )
+                self.connection.close()
+                self.close_connection = True
+                return True
+            if isinstance(fault, float):
+                time.sleep(fault)
+                return False
+            status, retry_after = fault if isinstance(fault, tuple) else (fault, None)
+            self.send_error_json(status, "Injected fault", retry_after)
+            return True
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            request_body = self.rfile.read(length)
+            if self.injected_fault():
+                return
+            if self.api_path() != "/authenticate":
+                self.send_error_json(404, "Not found")
+                return
+            try:
+                credentials = json.loads(request_body)
+            except ValueError:
+                self.send_error_json(400, "Bad request")
+                return
+            if credentials.get("password") == "wrong":
+                self.send_error_json(403, "Authentication failed!")
+                return
+            token = json.dumps(fake_token(credentials.get("username", ""))).encode()
+            self.send_json(200, (token, gzip.compress(token), None), "/authenticate")
+
+        def do_GET(self):
+            path = self.api_path()
+            if path is None:
+                self.send_error_json(404, "Not found")
+                return
+            if self.injected_fault():
+                return
+            if path != "/system_information" and not self.headers.get(
+                "Authorization", ""
+            ).startswith("Bearer "):
+                self.send_error_json(401, "No authorization token provided.")
+                return
+            body_entry = fake_cml.body(path)
+            if body_entry is None:
+                self.send_error_json(404, "Not found")
+                return
+            self.send_json(200, body_entry, self.recorded_path())
+
+    return Handler
+
+
+def start_fake_cml(labs=10, nodes=10, version="2.5.0", https=False, port=0):
+    """Starts a stand-in controller in a background thread and returns it."""
+    return FakeCML(labs, nodes, version=version, https=https, port=port).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--labs", type=int, default=10)
+    parser.add_argument("--nodes", type=int, default=10, help="nodes per lab")
+    parser.add_argument("--version", default="2.5.0", help="reported CML version")
+    parser.add_argument("--https", action="store_true")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    fake_cml = FakeCML(
+        args.labs, args.nodes, version=args.version, https=args.https, port=args.port
+    )
+    print(f"Stand-in CML controller: {fake_cml.controller}")
+    try:
+        fake_cml.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+"""Benchmark suite for session_gen.py against a local stand-in CML controller.
+
+Each scenario starts benchmarks/fake_cml.py with LABS labs of NODES nodes,
+points the generator at a temporary SecureCRT "Sessions" directory and
+measures:
+
+    authenticate     validate_settings_get_token()
+    get_lab_info     lab listing (per-lab endpoints or populate_lab_tiles)
+    get_lab_nodes    node lists of every lab
+    generate         batch_generate() of every lab into an empty directory
+    regenerate       the same again with nothing changed
+    main             the whole headless run in a fresh interpreter
+
+Timings, files per second, HTTP bytes and peak memory (tracemalloc for the
+in-process phases, peak RSS for the headless run where the resource module
+is available) are written as JSON, along
+with the cold start cost of session_gen.py: its import time and the modules it
+pulls in according to `python -X importtime`, and the wall time of
+`session_gen.py --help` in a fresh interpreter.
+
+    python benchmarks/run_benchmarks.py                         default scenarios
+    python benchmarks/run_benchmarks.py --scenario 2000x10 --scenario 1x50000
+    python benchmarks/run_benchmarks.py --output new.json --baseline old.json
+
+With --baseline, exits with status 1 if any phase got more than --tolerance
+(default: 25%) slower than in the baseline results.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Windows; the headless run is reported without its peak RSS
+    resource = None
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, SOURCE_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import session_gen  # noqa: E402
+from bench_render import write_node_session_template  # noqa: E402
+from fake_cml import start_fake_cml  # noqa: E402
+
+DEFAULT_SCENARIOS = ("1x10", "10x100", "200x25", "1x5000")
+
+# CML versions that select the per-lab endpoints and populate_lab_tiles
+API_VERSIONS = {"lazy": "2.5.0", "bulk": "2.2.2"}
+
+# Phases faster than this are not reported as regressions
+MIN_REGRESSION_SECONDS = 0.05
+
+# Fresh interpreters started per startup measurement; the fastest run counts
+STARTUP_RUNS = 5
+
+# Modules imported by session_gen that take less than this are not listed
+MIN_REPORTED_IMPORT_MS = 1.0
+
+
+def parse_scenario(scenario):
+    labs, nodes = scenario.lower().split("x")
+    return int(labs), int(nodes)
+
+
+def reset_session_gen():
+    # Drops per-process caches so each scenario starts cold
+    session_gen._http_session = None
+    session_gen._auth_headers.clear()
+    session_gen._cml_versions.clear()
+    session_gen._conditional_responses.clear()
+    session_gen._compiled_templates.clear()
+
+
+def peak_children_rss_mb():
+    # None where the resource module is missing
+    if resource is None:
+        return None
+
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == "darwin":
+        return peak_rss / (1024 * 1024)
+    return peak_rss / 1024
+
+
+def measure(phases, name, function, *args, trace_memory=False):
+    # Runs function(*args) quietly and records its duration under phases[name]
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args)
+    seconds = time.perf_counter() - start_time
+
+    phase = phases.setdefault(name, dict())
+    if trace_memory:
+        phase["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2)
+        tracemalloc.stop()
+    else:
+        phase["seconds"] = round(seconds, 4)
+
+    return result
+
+
+def in_process_phases(fake_cml, sessions_cml_labs_dir, phases, trace_memory):
+    reset_session_gen()
+
+    validate_return = measure(
+        phases,
+        "authenticate",
+        session_gen.validate_settings_get_token,
+        "benchmark",
+        "benchmark",
+        fake_cml.controller,
+        trace_memory=trace_memory,
+    )
+    base_url = validate_return["cml_url"]
+    token = validate_return["bearer_token"]
+
+    bytes_before = fake_cml.bytes_sent
+    lab_info = measure(
+        phases,
+        "get_lab_info",
+        session_gen.get_lab_info,
+        base_url,
+        token,
+        trace_memory=trace_memory,
+    )
+    phases["get_lab_info"]["http_bytes"] = fake_cml.bytes_sent - bytes_before
+
+    labs = lab_info["lab_details"]
+    bytes_before = fake_cml.bytes_sent
+    measure(
+        phases,
+        "get_lab_nodes",
+        session_gen.get_lab_nodes,
+        base_url,
+        token,
+        lab_info,
+        [lab[3] for lab in labs],
+        trace_memory=trace_memory,
+    )
+    phases["get_lab_nodes"]["http_bytes"] = fake_cml.bytes_sent - bytes_before
+
+    for name in ("generate", "regenerate"):
+        results = measure(
+            phases,
+            name,
+            session_gen.batch_generate,
+            sessions_cml_labs_dir,
+            lab_info,
+            labs,
+            session_gen.INVALID_CHARS,
+            trace_memory=trace_memory,
+        )
+        errors = [result["error"] for result in results if result["error"]]
+        if errors:
+            raise RuntimeError(f"{name} failed: {errors[0]}")
+        files = sum(
+            session_gen.sessions_written(result["session_sync"]) for result in results
+        )
+        phases[name]["files"] = files
+        if not trace_memory and phases[name]["seconds"]:
+            phases[name]["files_per_second"] = round(files / phases[name]["seconds"])
+
+
+def headless_phase(fake_cml, temp_dir, sessions_dir, phases):
+    config_yaml = os.path.join(temp_dir, "config.yaml")
+    start_time = time.perf_counter()
+    completed = subprocess.run(
+        [
+            sys.executable,
+            os.path.join(SOURCE_DIR, "session_gen.py"),
+            "--headless",
+            "--batch",
+            "--controller",
+            fake_cml.controller,
+            "--username",
+            "benchmark",
+            "--password",
+            "benchmark",
+            "--output-root",
+            sessions_dir,
+            "--config",
+            config_yaml,
+        ],
+        cwd=SOURCE_DIR,
+        capture_output=True,
+        text=True,
+    )
+    phases["main"] = {
+        "seconds": round(time.perf_counter() - start_time, 4),
+        "exit_status": completed.returncode,
+    }
+    peak_rss_mb = peak_children_rss_mb()
+    if peak_rss_mb is not None:
+        phases["main"]["peak_rss_mb"] = round(peak_rss_mb, 1)
+    if completed.returncode != 0:
+        raise RuntimeError(
+            f"headless run failed:\n{completed.stdout}{completed.stderr}"
+        )
+
+
+def parse_importtime(stderr):
+    # -X importtime lines: "import time: self [us] | cumulative | package",
+    # with the package name indented two spaces per nesting level and nested
+    # imports listed before the module that imported them. Returns
+    # (cumulative ms of session_gen, {directly imported module: cumulative ms}).
+    nested_imports = dict()
+
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:") :].split("|")
+        try:
+            cumulative_ms = int(fields[1]) / 1000
+        except ValueError:
+            # Column header
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        if depth == 1 and cumulative_ms >= MIN_REPORTED_IMPORT_MS:
+            nested_imports[name] = round(cumulative_ms, 1)
+        elif depth == 0:
+            if name == "session_gen":
+                return cumulative_ms, nested_imports
+            nested_imports = dict()
+
+    raise RuntimeError("session_gen not found in -X importtime output")
+
+
+def startup_phase():
+    # Cold start of session_gen.py, the best of STARTUP_RUNS fresh interpreters
+    import_runs = []
+    help_seconds = []
+
+    for _ in range(STARTUP_RUNS):
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import session_gen"],
+            cwd=SOURCE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        import_runs.append(parse_importtime(completed.stderr))
+
+        start_time = time.perf_counter()
+        subprocess.run(
+            [sys.executable, os.path.join(SOURCE_DIR, "session_gen.py"), "--help"],
+            cwd=SOURCE_DIR,
+            capture_output=True,
+            check=True,
+        )
+        help_seconds.append(time.perf_counter() - start_time)
+
+    import_ms, imports = min(import_runs, key=lambda import_run: import_run[0])
+
+    return {
+        "seconds": round(min(help_seconds), 4),
+        "import_ms": round(import_ms, 1),
+        "imports": dict(sorted(imports.items(), key=lambda item: -item[1])),
+    }
+
+
+def run_scenario(labs, nodes, api, trace_memory=True):
+    fake_cml = start_fake_cml(labs=labs, nodes=nodes, version=API_VERSIONS[api])
+    phases = dict()
+
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            labs_dir_name = session_gen.cml_labs_dir_name(fake_cml.controller)
+            for run in ("timing", "memory", "main"):
+                if run == "memory" and not trace_memory:
+                    continue
+                sessions_dir = os.path.join(temp_dir, run, "Config", "Sessions")
+                sessions_cml_labs_dir = os.path.join(sessions_dir, labs_dir_name)
+                os.makedirs(sessions_cml_labs_dir)
+                write_node_session_template(sessions_cml_labs_dir)
+
+                if run == "main":
+                    headless_phase(fake_cml, temp_dir, sessions_dir, phases)
+                else:
+                    in_process_phases(
+                        fake_cml, sessions_cml_labs_dir, phases, run == "memory"
+                    )
+    finally:
+        fake_cml.stop()
+
+    return {
+        "name": f"{labs}x{nodes}-{api}",
+        "labs": labs,
+        "nodes_per_lab": nodes,
+        "api": api,
+        "phases": phases,
+    }
+
+
+def find_regressions(results, baseline, tolerance):
+    baseline_scenarios = {
+        scenario["name"]: scenario for scenario in baseline.get("scenarios", [])
+    }
+    regressions = []
+
+    old_seconds = baseline.get("startup", {}).get("seconds")
+    new_seconds = results.get("startup", {}).get("seconds")
+    if old_seconds is not None and new_seconds is not None:
+        # Cold start is well below MIN_REGRESSION_SECONDS, so only the ratio counts
+        if new_seconds > old_seconds * (1 + tolerance):
+            regressions.append(f"startup: {old_seconds:.3f}s -> {new_seconds:.3f}s")
+
+    for scenario in results["scenarios"]:
+        baseline_scenario = baseline_scenarios.get(scenario["name"])
+        if baseline_scenario is None:
+            continue
+        for name, phase in scenario["phases"].items():
+            old_seconds = baseline_scenario["phases"].get(name, {}).get("seconds")
+            new_seconds = phase.get("seconds")
+            if old_seconds is None or new_seconds is None:
+                continue
+            if (
+                new_seconds > old_seconds * (1 + tolerance)
+                and new_seconds - old_seconds > MIN_REGRESSION_SECONDS
+            ):
+                regressions.append(
+                    f"{scenario['name']} {name}: {old_seconds:.3f}s -> {new_seconds:.3f}s"
+                )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.splitlines()[2:]),
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        metavar="LABSxNODES",
+        help="labs and nodes per lab, e.g. 100x50; may be repeated",
+    )
+    parser.add_argument(
+        "--api",
+        choices=("lazy", "bulk", "both"),
+        default="both",
+        help="per-lab endpoints (CML 2.4+), populate_lab_tiles or both",
+    )
+    parser.add_argument(
+        "--no-memory", action="store_true", help="skip the tracemalloc pass"
+    )
+    parser.add_argument(
+        "--no-startup", action="store_true", help="skip the cold start measurement"
+    )
+    parser.add_argument("--output", metavar="FILE", help="write JSON results to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="compare with FILE")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    apis = ("lazy", "bulk") if args.api == "both" else (args.api,)
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scenarios": [],
+    }
+
+    if not args.no_startup:
+        print("startup...", file=sys.stderr)
+        results["startup"] = startup_phase()
+
+    for scenario in args.scenario or DEFAULT_SCENARIOS:
+        labs, nodes = parse_scenario(scenario)
+        for api in apis:
+            print(f"{labs}x{nodes}-{api}...", file=sys.stderr)
+            results["scenarios"].append(
+                run_scenario(labs, nodes, api, trace_memory=not args.no_memory)
+            )
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,65 +1,276 @@
 import sys
 import os
-from getpass import getpass
-from platform import node
-import shutil
-import subprocess
-import yaml
+import argparse
+import fnmatch
+import threading
+import base64
+import codecs
+import hashlib
+import re
+import contextlib
+import importlib.util
 import json
 import time
-import requests
-from requests.exceptions import HTTPError
-from tabulate import tabulate
-from traceback import format_exc
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
+
+## DEFAULTS ####################################################################
+################################################################################
+
+# Defaults when session_gen is imported as a library; the script sets
+# CONFIG_YAML from --config or CML_CONFIG
+OS = sys.platform
+CONFIG_YAML = "config.yaml"
+clear_screen = "cls" if OS == "win32" else "clear"
+
+
+## ERRORS ######################################################################
+################################################################################
+
+
+class SessionGenError(Exception):
+    # Base class of the errors the library API raises
+    pass
+
+
+class ConfigError(SessionGenError):
+    # SecureCRT, its Sessions directory or a setting could not be found
+    pass
+
+
+class SetupRequiredError(ConfigError):
+    # The controller's node session template does not exist yet
+    pass
+
+
+class LabNotFoundError(SessionGenError, LookupError):
+    # A lab ID is unknown to the controller or missing from the lab snapshot
+    pass
+
+
+## LAZY IMPORTS ################################################################
+################################################################################
+
+# requests, yaml, tabulate, subprocess, shutil and getpass are only imported on
+# the code paths that use them, so starting the script stays cheap
+
+
+def lazy_import(module_name):
+    # Returns the module at once but only executes it on first attribute access
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+
+    spec = importlib.util.find_spec(module_name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {module_name!r}", name=module_name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+
+requests = lazy_import("requests")
+
+
+def tabulate(*args, **kwargs):
+    from tabulate import tabulate
+
+    return tabulate(*args, **kwargs)
+
+
+## RUN TIMINGS #################################################################
+################################################################################
+
+# Seconds are summed across threads, so concurrent phases can exceed wall time
+RUN_PHASES = (
+    "discover",
+    "config",
+    "auth",
+    "lab_fetch",
+    "json_parse",
+    "render",
+    "write",
+)
+
+_run_stats_lock = threading.Lock()
+_run_stats = dict()
+_profiler = None
+
+
+def reset_run_stats():
+    with _run_stats_lock:
+        _run_stats.clear()
+        _run_stats["phases"] = {phase: [0.0, 0] for phase in RUN_PHASES}
+        _run_stats["http_bytes_received"] = 0
+        _run_stats["files_written"] = 0
+        _run_stats["bytes_written"] = 0
+        _run_stats["api_retries"] = 0
+
+
+def record_phase(phase, seconds, calls=1):
+    with _run_stats_lock:
+        phase_stats = _run_stats["phases"].setdefault(phase, [0.0, 0])
+        phase_stats[0] += seconds
+        phase_stats[1] += calls
+
+
+def record_counter(counter, amount):
+    with _run_stats_lock:
+        _run_stats[counter] += amount
+
+
+@contextlib.contextmanager
+def timed_phase(phase):
+    # Usable as a context manager or as a function decorator
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, time.perf_counter() - start_time)
+
+
+def run_stats():
+    with _run_stats_lock:
+        return {
+            "phases": {
+                phase: {"seconds": round(seconds, 4), "calls": calls}
+                for phase, (seconds, calls) in _run_stats["phases"].items()
+            },
+            "http_bytes_received": _run_stats["http_bytes_received"],
+            "files_written": _run_stats["files_written"],
+            "bytes_written": _run_stats["bytes_written"],
+            "api_retries": _run_stats["api_retries"],
+        }
+
+
+def print_run_stats(output_format):
+    stats = run_stats()
+
+    if output_format == "json":
+        print(json.dumps(stats, indent=2))
+        return
+
+    print()
+    print(
+        tabulate(
+            [
+                [phase, phase_stats["seconds"], phase_stats["calls"]]
+                for phase, phase_stats in stats["phases"].items()
+            ],
+            headers=["PHASE", "SECONDS", "CALLS"],
+            floatfmt=".4f",
+        )
+    )
+    print()
+    print(f"HTTP bytes received: {stats['http_bytes_received']}")
+    print(f"Files written:       {stats['files_written']}")
+    print(f"Bytes written:       {stats['bytes_written']}")
+    print(f"API retries:         {stats['api_retries']}")
+
+
+def start_profiler():
+    # cProfile and tracemalloc for the render loop of generate_node_sessions_files()
+    global _profiler
+    import cProfile
+    import tracemalloc
+
+    _profiler = cProfile.Profile()
+    tracemalloc.start()
+
+
+@contextlib.contextmanager
+def profiled():
+    if _profiler is None:
+        yield
+        return
+
+    _profiler.enable()
+    try:
+        yield
+    finally:
+        _profiler.disable()
+
+
+def stop_profiler(stats_file):
+    # Writes cProfile stats to stats_file and the top allocations recorded by
+    # tracemalloc to stats_file + ".tracemalloc.txt"
+    global _profiler
+    import tracemalloc
+
+    snapshot = tracemalloc.take_snapshot()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    _profiler.dump_stats(stats_file)
+    _profiler = None
+
+    with open(stats_file + ".tracemalloc.txt", "w") as f:
+        f.write(f"Peak traced memory: {peak_bytes} bytes\n\n")
+        for statistic in snapshot.statistics("lineno")[:25]:
+            f.write(f"{statistic}\n")
+
+    print(f"Profile written to {stats_file} (view with: python -m pstats {stats_file})")
+    print(f"Allocations written to {stats_file}.tracemalloc.txt")
+
+
+reset_run_stats()
 
 
 ## SECURECRT PATH ##############################################################
 ################################################################################
 
 
-def application_installed():
-    if OS == "win32":
+@timed_phase("discover")
+def find_securecrt(os_name=None):
+    # Path of the SecureCRT application; raises ConfigError if it is missing
+    os_name = os_name or OS
+
+    if os_name == "win32":
         # SecureCRT may or may not be in system PATH
         # This is how to find it regardless
-        program_files_32bit = os.environ.get("ProgramFiles(x86)")
-        program_files_64bit = os.environ.get("ProgramW6432")
         securecrt_dir = "VanDyke Software\\SecureCRT\\"
         securecrt_file = "SecureCRT.exe"
-        securecrt_path = os.path.join(
-            program_files_32bit, securecrt_dir, securecrt_file
-        )
-        if os.path.exists(securecrt_path) is False:
+        for program_files in ("ProgramFiles(x86)", "ProgramW6432"):
+            program_files_dir = os.environ.get(program_files)
+            if program_files_dir is None:
+                continue
             securecrt_path = os.path.join(
-                program_files_64bit, securecrt_dir, securecrt_file
+                program_files_dir, securecrt_dir, securecrt_file
             )
-            if os.path.exists(securecrt_path) is False:
-                input(
-                    f"ERROR:   {securecrt_file} was not found.\nPress ENTER to exit..."
-                )
-                sys.exit(1)
-    elif OS == "darwin":
-        securecrt_dir = "/Applications"
+            if os.path.exists(securecrt_path):
+                return securecrt_path
+    elif os_name == "darwin":
         securecrt_file = "SecureCRT.app"
-        securecrt_path = os.path.join(securecrt_dir, securecrt_file)
-        if os.path.exists(securecrt_path) is False:
-            input(f"ERROR:   {securecrt_file} was not found.\nPress ENTER to exit...")
-            sys.exit(1)
+        securecrt_path = os.path.join("/Applications", securecrt_file)
+        if os.path.exists(securecrt_path):
+            return securecrt_path
     else:
-        input("ERROR:   Operating system not supported.\nPress ENTER to exit...")
-        sys.exit(1)
+        raise ConfigError("Operating system not supported.")
+
+    raise ConfigError(f"{securecrt_file} was not found.")
+
 
-    return securecrt_path
+def application_installed():
+    try:
+        return find_securecrt()
+    except ConfigError as err:
+        input(f"ERROR:   {err}\nPress ENTER to exit...")
+        sys.exit(1)
 
 
 ## SECURECRT CONFIG PATH #######################################################
 ################################################################################
 
 
-def config_path():
+@timed_phase("discover")
+def securecrt_config_dir(os_name=None):
+    # Returns SecureCRT's configuration directory or None if it cannot be found
     # seccrt_key is a holdover from when this script was only for Windows
+    os_name = os_name or OS
+
+    if os_name == "win32":
+        import winreg
 
-    if OS == "win32":
         try:
             # Searching Windows registry
             # If exists, securecrt_dir will be set to seccrt_key[0]
@@ -68,35 +279,54 @@ def config_path():
             seccrt_key = winreg.QueryValueEx(seccrt_location, "Config Path")
             winreg.CloseKey(seccrt_location)
             seccrt_key = list(seccrt_key).pop(0)
-        except:
-            input(
-                "ERROR:   Cannot find SecureCRT configuration directory via Windows registry.\nPress ENTER to exit..."
-            )
-            sys.exit(1)
-    elif OS == "darwin":
+        except OSError:
+            return None
+    elif os_name == "darwin":
         seccrt_key = os.path.expanduser(
             "~/Library/Application Support/VanDyke/SecureCRT/Config"
         )
     else:
-        input("ERROR:   Operating system not supported.\nPress ENTER to exit...")
+        return None
+
+    return seccrt_key
+
+
+def find_sessions_dir(os_name=None):
+    # SecureCRT's 'Sessions' directory; raises ConfigError if it is missing
+    os_name = os_name or OS
+    seccrt_key = securecrt_config_dir(os_name)
+
+    if seccrt_key is None:
+        if os_name == "win32":
+            raise ConfigError(
+                "Cannot find SecureCRT configuration directory via Windows registry."
+            )
+        raise ConfigError("Operating system not supported.")
 
     sessions_dir = os.path.join(seccrt_key, "Sessions")
 
     if os.path.exists(sessions_dir) is False:
-        input(
-            "ERROR:   Cannot find SecureCRT configuration directory.\nPress ENTER to exit..."
-        )
-        sys.exit(1)
+        raise ConfigError("Cannot find SecureCRT configuration directory.")
 
     return sessions_dir
 
 
+def config_path():
+    try:
+        return find_sessions_dir()
+    except ConfigError as err:
+        input(f"ERROR:   {err}\nPress ENTER to exit...")
+        sys.exit(1)
+
+
 ################################################################################
 ## GETS CONFIGURATION SETTINGS FOR config.yaml #################################
 ################################################################################
 
 
 def get_config_settings():
+    import getpass
+
     cml_username = ""
 
     while len(cml_username) == 0:
@@ -106,9 +336,9 @@ def get_config_settings():
 
     while len(cml_password) == 0:
         cml_password_conf = ""
-        cml_password = getpass("CML Password: ").strip()
+        cml_password = getpass.getpass("CML Password: ").strip()
         if len(cml_password) != 0:
-            cml_password_conf = getpass("Confirm Password: ").strip()
+            cml_password_conf = getpass.getpass("Confirm Password: ").strip()
             if cml_password == cml_password_conf:
                 break
             else:
@@ -127,551 +357,4675 @@ def get_config_settings():
     return config_settings
 
 
-## VALIDATE CONFIGURATION SETTINGS & GET BEARER TOKEN ##########################
+## CML API CLIENT #############################################################
 ################################################################################
 
+# (connect, read) deadlines in seconds, keyed by the first segment of the endpoint
+API_TIMEOUTS = {
+    "authenticate": (3.05, 10),
+    "populate_lab_tiles": (3.05, 120),
+    "default": (3.05, 30),
+}
 
-def validate_settings_get_token(cml_user, cml_pass, cml_server):
-    print()
+# Upper bound on keep-alive connections held open per controller
+API_POOL_MAXSIZE = 16
 
-    # Base URL for future API calls
-    base_url = "https://" + cml_server + "/api/v0"
+# Controllers whose connection pools are kept at the same time
+API_POOL_HOSTS = 16
 
-    # Token required to authenticate API calls
-    api_url_authenticate = base_url + "/authenticate"
+_http_session = None
+_http_session_lock = threading.Lock()
+_auth_headers = dict()
 
-    payload = json.dumps({"username": cml_user, "password": cml_pass})
-    headers = {"Content-Type": "application/json", "Accept": "application/json"}
 
-    try:
-        authenticate_response = requests.request(
-            "POST",
-            api_url_authenticate,
-            headers=headers,
-            data=payload,
-            verify=False,
-            timeout=3,
-        )
-        authenticate_response.raise_for_status()
-        authenticate_status_code = str(authenticate_response.status_code)
-        token_text = authenticate_response.text
-        token = token_text.strip('"')
-        if "200" in authenticate_status_code:
-            validate_return = dict()
-            validate_return["status_code"] = authenticate_status_code
-            validate_return["cml_url"] = base_url
-            validate_return["bearer_token"] = token
+def get_http_session():
+    # One pooled keep-alive session is shared by every CML API call so the
+    # TCP+TLS handshake is only paid once per controller
+    global _http_session
 
-            return validate_return
+    with _http_session_lock:
+        if _http_session is None:
+            # Certificates of lab controllers are usually self-signed
+            requests.packages.urllib3.disable_warnings(
+                requests.packages.urllib3.exceptions.InsecureRequestWarning
+            )
+            http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=API_POOL_HOSTS, pool_maxsize=API_POOL_MAXSIZE
+            )
+            http_session.mount("https://", adapter)
+            http_session.mount("http://", adapter)
+            http_session.verify = False
+            http_session.headers.update(
+                {
+                    "Accept": "application/json",
+                    "Accept-Encoding": "gzip, deflate",
+                    "Connection": "keep-alive",
+                }
+            )
+            _http_session = http_session
 
-    except requests.exceptions.ConnectTimeout as err:
-        err = str(err)
-        return err
-    except requests.exceptions.HTTPError as err:
-        err = str(err).split()
-        return err[0]
-    except requests.exceptions.ConnectionError as err:
-        err = str(err)
-        return err
-    except requests.exceptions.RequestException as err:
-        err = str(err).split()
-        return err
+    return _http_session
 
 
-## LAB INFO ####################################################################
-################################################################################
+def auth_header(bearer_token):
+    # The Authorization header is built once per token and reused
+    header = _auth_headers.get(bearer_token)
+    if header is None:
+        header = {"Authorization": "Bearer " + bearer_token}
+        _auth_headers[bearer_token] = header
 
+    return header
 
-def get_lab_info(base_url, bearer_token):
-    # Get lab info: lab title, lab state, and lab ID
 
-    api_url_pop_lab_tiles = base_url + "/populate_lab_tiles"
+def api_timeout(endpoint):
+    endpoint_key = endpoint.strip("/").split("/")[0].split("?")[0]
 
-    payload = {}
-    headers = {"Accept": "application/json", "Authorization": "Bearer " + bearer_token}
+    return API_TIMEOUTS.get(endpoint_key, API_TIMEOUTS["default"])
 
-    pop_lab_tiles_response = requests.request(
-        "GET", api_url_pop_lab_tiles, headers=headers, data=payload, verify=False
-    )
 
-    pop_lab_tiles_response_json = pop_lab_tiles_response.json()
-    lab_tiles = pop_lab_tiles_response_json["lab_tiles"]
-    lab_tiles_keys = list(lab_tiles.keys())
+def cml_api_request(method, base_url, endpoint, bearer_token=None, **kwargs):
+    # Connection errors, resets and 429/5xx responses are retried with
+    # jittered exponential backoff. Name lookup failures and read timeouts are
+    # not retried. The last 429/5xx response is returned like any other.
+    headers = dict(kwargs.pop("headers", None) or {})
+    if bearer_token is not None:
+        headers.update(auth_header(bearer_token))
+    timeout = kwargs.pop("timeout", None) or api_timeout(endpoint)
+    # Passed per request; REQUESTS_CA_BUNDLE would otherwise override the
+    # session-level setting
+    kwargs.setdefault("verify", False)
 
-    labs = []
-    lab_num = 0
+    http_session = get_http_session()
+    attempt = 0
+    while True:
+        check_circuit(base_url)
+        budget_left = api_budget_left(base_url)
 
-    for lab_tile in lab_tiles_keys:
-        lab_num += 1
-        lab_titles = lab_tiles[lab_tile]["lab_title"]
-        lab_states = lab_tiles[lab_tile]["state"]
-        lab_ids = lab_tiles[lab_tile]["id"]
-        lab = [lab_num, lab_titles, lab_states, lab_ids]
-        labs.append(lab)
+        try:
+            response = http_session.request(
+                method,
+                base_url + endpoint,
+                headers=headers,
+                timeout=budget_timeout(timeout, budget_left),
+                **kwargs,
+            )
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+        ) as err:
+            record_circuit(base_url, True)
+            if attempt >= API_RETRIES or is_name_resolution_error(err):
+                raise
+            delay = retry_delay(attempt)
+        except requests.exceptions.Timeout:
+            record_circuit(base_url, True)
+            raise
+        else:
+            if response.status_code not in API_RETRY_STATUS_CODES:
+                record_circuit(base_url, False)
+                return response
+            # 429 means the controller is alive but busy
+            record_circuit(base_url, response.status_code != 429)
+            if attempt >= API_RETRIES:
+                return response
+            delay = retry_delay(attempt, response)
+            response.close()
+
+        budget_left = api_budget_left(base_url)
+        if budget_left is not None and delay >= budget_left:
+            raise requests.exceptions.Timeout(
+                f"API time budget of this run used up retrying {base_url}"
+            )
+        attempt += 1
+        record_counter("api_retries", 1)
+        time.sleep(delay)
 
-    num_of_labs = len(labs) + 1
 
-    lab_info = dict()
-    lab_info["lab_details"] = labs
-    lab_info["total_labs"] = num_of_labs
-    lab_info["lab_tiles"] = lab_tiles
+def record_bytes_received(response):
+    # Counts the body as it came over the wire, before gzip decoding; call it
+    # once the body has been read
+    try:
+        bytes_received = response.raw.tell()
+    except (AttributeError, OSError, ValueError):
+        bytes_received = int(response.headers.get("Content-Length") or 0)
 
-    return lab_info
+    record_counter("http_bytes_received", bytes_received)
 
 
-## SELECT LAB ##################################################################
-################################################################################
+# Last response per URL for endpoints fetched with cml_api_get_json()
+_conditional_responses = dict()
 
 
-def lab_selector(labs, num_of_labs):
-    print(tabulate(labs, headers=["NUMBER", "LAB", "STATE", "UUID"]))
-    print("\n" * 5)
-    print("\n['q' to quit.]\n\n")
+def cml_api_get_json(base_url, endpoint, bearer_token, compact=None):
+    # GET with If-None-Match/If-Modified-Since when the controller supplied an
+    # ETag or Last-Modified header last time; a 304 reuses the previous body.
+    # compact(data), if given, is applied before the body is kept so only the
+    # fields the generator uses are held in memory and in lab snapshots.
+    url = base_url + endpoint
+    cached_response = _conditional_responses.get(url)
 
-    while True:
-        user_specified_lab = input("Enter a lab NUMBER from the list above: ")
-        print()
-        if "q" in user_specified_lab:
-            print("Exiting")
-            sys.exit(1)
-        if user_specified_lab.isdigit():
-            user_specified_lab = int(user_specified_lab)
-            if user_specified_lab in range(1, num_of_labs):
-                user_specified_lab = user_specified_lab - 1
-                break
-        else:
-            user_specified_lab = user_specified_lab.lower()
-            if "q" in user_specified_lab:
-                print("Exiting")
-                sys.exit(1)
+    with timed_phase("lab_fetch"):
+        response = cml_api_request(
+            "GET",
+            base_url,
+            endpoint,
+            bearer_token,
+            headers=conditional_headers(cached_response),
+        )
+    # Reads the body before it is counted
+    response.content
+    record_bytes_received(response)
+    if response.status_code == 304 and cached_response is not None:
+        return cached_response["data"]
+    response.raise_for_status()
 
-    user_specified_lab = labs[user_specified_lab][3]
+    with timed_phase("json_parse"):
+        data = response.json()
+    if compact is not None:
+        data = compact(data)
+    remember_response(url, response, data)
 
-    return user_specified_lab
+    return data
 
 
-## VERIFY INITIAL CONFIG FILE EXISTS ###########################################
-################################################################################
+def conditional_headers(cached_response):
+    # If-None-Match/If-Modified-Since for a response kept by remember_response()
+    headers = dict()
+    if cached_response is not None:
+        if cached_response["etag"]:
+            headers["If-None-Match"] = cached_response["etag"]
+        if cached_response["last_modified"]:
+            headers["If-Modified-Since"] = cached_response["last_modified"]
 
+    return headers
 
-def initial_config_check():
-    init_config_file = "initial_config"
 
-    if os.path.exists(init_config_file):
-        pass
-    else:
-        print(f"{init_config_file} was not found.")
-        print("Exiting")
-        sys.exit(1)
+def remember_response(url, response, data):
+    # Keeps data for conditional requests if the controller sent an ETag or
+    # Last-Modified header
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if etag or last_modified:
+        _conditional_responses[url] = {
+            "etag": etag,
+            "last_modified": last_modified,
+            "data": data,
+        }
 
 
-## VERIFY CML CONSOLE SERVER SESSION TEMPLATE FILE EXISTS ######################
-################################################################################
+def api_base_url(cml_server):
+    # CML is always served over HTTPS; an explicit scheme is only needed for
+    # stand-in servers such as benchmarks/fake_cml.py
+    if cml_server.startswith(("https://", "http://")):
+        return cml_server.rstrip("/") + "/api/v0"
 
+    return "https://" + cml_server + "/api/v0"
 
-def cml_console_server_check():
-    init_console_server_session_file = "cml_console_server"
 
-    if os.path.exists(init_console_server_session_file):
-        pass
-    else:
-        print(f"{init_console_server_session_file} was not found.")
-        print("Exiting")
-        sys.exit(1)
+def cml_labs_dir_name(cml_server):
+    # Name of the 'CML <server> Labs' session folder for a controller
+    cml_server = cml_server.split("://", 1)[-1].rstrip("/")
 
+    return "CML " + sanitize_name(cml_server, INVALID_CHARS) + " Labs"
 
-## VERIFY CML CONSOLE SERVER SESSION TEMPLATE FILE EXIST #######################
-################################################################################
 
+## API RETRIES, RUN BUDGET & CIRCUIT BREAKER ##################################
+################################################################################
 
-def config_yaml_check(CONFIG_YAML):
-    if os.path.exists(CONFIG_YAML):
-        return True
-    else:
-        return False
+# Extra attempts after a connection error, a reset or a 429/5xx response
+API_RETRIES = 2
+API_RETRY_STATUS_CODES = frozenset((429, 500, 502, 503, 504))
 
+# Retry n waits a random time of up to API_BACKOFF_BASE * 2**n seconds
+API_BACKOFF_BASE = 0.5
+API_BACKOFF_MAX = 8
 
-## SET CONFIG VARIABLES ########################################################
-################################################################################
+# Seconds every CML API call of a run may take together (--api-budget)
+API_RUN_BUDGET = 300
 
+# A controller that failed this many attempts in a row is not contacted again
+# until CIRCUIT_OPEN_SECONDS have passed; one more failure then re-opens it
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_OPEN_SECONDS = 30
 
-def set_config_variables():
-    # Read config.yaml and assign field values to variables
-    try:
-        with open("config.yaml") as f:
-            data = yaml.load(f, Loader=yaml.FullLoader)
-            config = list(data.keys())
-            cml_user_index = config.index("username")
-            cml_pass_index = config.index("password")
-            cml_server_index = config.index("controller")
-            cml_user = data[config[cml_user_index]]
-            cml_pass = data[config[cml_pass_index]]
-            cml_server = data[config[cml_server_index]]
+_api_budget = API_RUN_BUDGET
+_api_deadline = None
+_circuits_lock = threading.Lock()
+# Base URL -> {"failures": consecutive failed attempts, "opened": time opened}
+_circuits = dict()
 
-            cml_configs = dict()
-            cml_configs["cml_user"] = cml_user
-            cml_configs["cml_pass"] = cml_pass
-            cml_configs["cml_server"] = cml_server
 
-            return cml_configs
-    except FileNotFoundError:
-        print(f"Error:  {CONFIG_YAML} file not found.")
-        return None
-    except (IndexError, KeyError):
-        print(f"Error:  Invalid or missing fields in {CONFIG_YAML}.")
-        return None
-    except Exception as err:
-        print(f"An error occurred: {err}")
-        return None
+def start_api_budget(seconds=None):
+    # (Re)starts the time budget shared by every following API call, of
+    # `seconds` or else the last budget given; 0 means no budget. Interactive
+    # mode restarts it after every prompt.
+    global _api_budget, _api_deadline
 
+    if seconds is not None:
+        _api_budget = seconds
+    _api_deadline = time.monotonic() + _api_budget if _api_budget else None
 
-## CREATE DIRECTORY FOR LAB SESSIONS ###########################################
-################################################################################
 
+def api_budget_left(base_url):
+    # Seconds left in the run budget, None without a budget
+    if _api_deadline is None:
+        return None
 
-def create_lab_session_dir(sessions_cml_labs_dir, lab_title):
-    node_session_dir = os.path.join(sessions_cml_labs_dir, lab_title)
+    budget_left = _api_deadline - time.monotonic()
+    if budget_left <= 0:
+        raise requests.exceptions.Timeout(
+            f"API time budget of this run used up before contacting {base_url}"
+        )
 
-    try:
-        os.makedirs(node_session_dir, exist_ok=True)
-        print(f"Directory for lab '{lab_title}' created successfully")
-        print("=" * 79)
-        return node_session_dir
-    except OSError:
-        print(f"Directory for lab '{lab_title}' could not be created")
-        sys.exit(1)
-    except Exception as err:
-        print(f"An error occurred: {err}")
-        return None
+    return budget_left
 
 
-## GENERATE NODE SESSIONS ######################################################
-################################################################################
+def check_circuit(base_url):
+    with _circuits_lock:
+        circuit = _circuits.get(base_url)
+        if circuit is None or circuit["failures"] < CIRCUIT_FAILURE_THRESHOLD:
+            return
+        open_seconds = time.monotonic() - circuit["opened"]
+        failures = circuit["failures"]
 
+    if open_seconds < CIRCUIT_OPEN_SECONDS:
+        raise requests.exceptions.ConnectionError(
+            f"{base_url} failed {failures} times in a row; not contacting it "
+            f"again for {CIRCUIT_OPEN_SECONDS - open_seconds:.0f} seconds"
+        )
 
-def generate_node_sessions_files(
-    sessions_cml_labs_dir,
-    lab_nodes,
-    invalid_chars,
-    node_session_dir,
-    lab_title_command,
-    lab_title,
-):
-    print()
-    print(f"Generating session files for lab: {lab_title}")
-    print("=" * 79)
 
-    node_session_template_filename = "node_session_template"
-    node_session_template_location = os.path.join(
-        sessions_cml_labs_dir, node_session_template_filename
-    )
+def record_circuit(base_url, failed):
+    with _circuits_lock:
+        circuit = _circuits.setdefault(base_url, {"failures": 0, "opened": 0.0})
+        if not failed:
+            circuit["failures"] = 0
+            return
+        circuit["failures"] += 1
+        if circuit["failures"] >= CIRCUIT_FAILURE_THRESHOLD:
+            circuit["opened"] = time.monotonic()
 
-    # List of nodes that do not need sessions created because they do not have console access
-    ignore_node_definitions = ["external_connector", "unmanaged_switch"]
 
-    search_cml_node_cmd_lab_title = "CHANGEME_LAB_TITLE"
-    search_cml_node_cmd_label = "CHANGEME_NODE_LABEL"
+def retry_delay(attempt, response=None):
+    # Full jitter keeps parallel workers from retrying in lock step. A
+    # Retry-After header in seconds is honoured up to API_BACKOFF_MAX.
+    import random
 
-    for lab_node in lab_nodes:
-        lab_node_definition = lab_node["node_definition"]
-        if lab_node_definition not in ignore_node_definitions:
-            lab_node_label = lab_node["label"]
-            lab_node_label_command = lab_node_label
-            for invalid_char in invalid_chars:
-                if invalid_char in lab_node_label:
-                    new_lab_node_label = lab_node_label.replace(
-                        invalid_char, "_"
-                    ).strip()
-                    lab_node_label = new_lab_node_label
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), API_BACKOFF_MAX)
 
-            node_session_filename = lab_node_label + ".ini"
-            node_session_location = os.path.join(
-                node_session_dir, node_session_filename
-            )
-            node_session_file = shutil.copyfile(
-                node_session_template_location, node_session_location
-            )
+    return random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2**attempt))
 
-            with open(node_session_file, "r") as f:
-                node_session_data = f.read()
-                node_session_data = node_session_data.replace(
-                    search_cml_node_cmd_lab_title, lab_title_command
-                )
-                node_session_data = node_session_data.replace(
-                    search_cml_node_cmd_label, lab_node_label_command
-                )
 
-            with open(node_session_file, "w") as f:
-                f.write(node_session_data)
+def budget_timeout(timeout, budget_left):
+    # (connect, read) deadlines shortened to what is left of the run budget
+    if budget_left is None:
+        return timeout
 
-    print()
-    print(f"Generation of node session files for lab '{lab_title}' complete.")
-    print("=" * 79)
-    input("\nPress ENTER to exit...\n\n")
+    return tuple(min(deadline, budget_left) for deadline in timeout)
 
 
-## SETUP #######################################################################
+## CML API ERRORS ##############################################################
 ################################################################################
 
+# CMLAPIError kinds
+API_ERROR_AUTH = "auth"
+API_ERROR_TIMEOUT = "timeout"
+API_ERROR_BAD_HOST = "bad_host"
+API_ERROR_UNREACHABLE = "unreachable"
+API_ERROR_HTTP = "http"
+API_ERROR_OTHER = "other"
+
+
+class CMLAPIError(SessionGenError):
+    # A failed CML API call, classified by the type of the underlying error
+    # instead of by its message text
+    def __init__(self, kind, message, status_code=None):
+        super().__init__(message)
+        self.kind = kind
+        self.status_code = status_code
+
+
+class AuthenticationError(CMLAPIError):
+    # The controller rejected the username or password (kind API_ERROR_AUTH)
+    pass
+
+
+class ControllerUnreachableError(CMLAPIError):
+    # Kinds API_ERROR_TIMEOUT, API_ERROR_BAD_HOST and API_ERROR_UNREACHABLE
+    pass
+
+
+def is_name_resolution_error(err):
+    # requests wraps the socket.gaierror of a failed DNS lookup a few levels
+    # deep, in exception arguments, 'reason' attributes and chained exceptions
+    import socket
+
+    pending = [err]
+    seen = set()
+    while pending:
+        error = pending.pop()
+        if error is None or id(error) in seen:
+            continue
+        seen.add(id(error))
+        if isinstance(error, socket.gaierror):
+            return True
+        pending.extend((getattr(error, "reason", None), error.__cause__))
+        pending.append(error.__context__)
+        pending.extend(arg for arg in error.args if isinstance(arg, BaseException))
+
+    return False
+
+
+def api_error(err):
+    # requests exception -> CMLAPIError or one of its subclasses
+    if isinstance(err, requests.exceptions.HTTPError) and err.response is not None:
+        status_code = err.response.status_code
+        if status_code in (401, 403):
+            return AuthenticationError(API_ERROR_AUTH, str(err), status_code)
+        return CMLAPIError(API_ERROR_HTTP, str(err), status_code)
+    # ConnectTimeout is both a Timeout and a ConnectionError
+    if isinstance(err, requests.exceptions.Timeout):
+        return ControllerUnreachableError(API_ERROR_TIMEOUT, str(err))
+    if isinstance(err, requests.exceptions.ConnectionError):
+        if is_name_resolution_error(err):
+            return ControllerUnreachableError(API_ERROR_BAD_HOST, str(err))
+        return ControllerUnreachableError(API_ERROR_UNREACHABLE, str(err))
+
+    return CMLAPIError(API_ERROR_OTHER, str(err))
 
-def setup(init_console_server_session_file, sessions_dir, CONFIG_YAML, securecrt_path):
-    os.system(clear_screen)
 
-    print(
-        "Ensure that SecureCRT is not running before continuing.\n"
-        "Setup cannot properly complete if SecureCRT is running\n\n"
-    )
+## VALIDATE CONFIGURATION SETTINGS & GET BEARER TOKEN ##########################
+################################################################################
 
-    input("Press ENTER to continue setup...")
-    os.system(clear_screen)
 
-    search_username = "CHANGEME_USER"
-    search_contr = "CHANGEME_CONTR"
-    search_cml_cmd = "CHANGEME_CMD"
-    replace_cml_contr_cmd = "quit"
+@timed_phase("auth")
+def validate_settings_get_token(cml_user, cml_pass, cml_server):
+    # Base URL for future API calls
+    base_url = api_base_url(cml_server)
+
+    payload = json.dumps({"username": cml_user, "password": cml_pass})
+    headers = {"Content-Type": "application/json"}
+
+    try:
+        # Token required to authenticate API calls
+        authenticate_response = cml_api_request(
+            "POST", base_url, "/authenticate", headers=headers, data=payload
+        )
+        authenticate_response.raise_for_status()
+        authenticate_status_code = str(authenticate_response.status_code)
+        token_text = authenticate_response.text
+        record_bytes_received(authenticate_response)
+        token = token_text.strip('"')
+        if "200" in authenticate_status_code:
+            validate_return = dict()
+            validate_return["status_code"] = authenticate_status_code
+            validate_return["cml_url"] = base_url
+            validate_return["bearer_token"] = token
+
+            return validate_return
+
+    except requests.exceptions.RequestException as err:
+        return api_error(err)
+
+
+## PRIVATE CACHE FILES #######################################################
+################################################################################
+
+# Token, template, config and node definition caches, lab snapshots and the
+# service token are readable only by the current user. They are written to a
+# temporary file first so a crash never leaves a truncated file.
+
+
+def load_json_cache(cache_file):
+    # {} if the file is missing, unreadable or not a JSON object
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+    if not isinstance(cache, dict):
+        return dict()
+
+    return cache
+
+
+def save_json_cache(cache_file, cache, compact=False):
+    if compact:
+        cache_data = json.dumps(cache, separators=(",", ":"))
+    else:
+        cache_data = json.dumps(cache, indent=2)
+
+    write_private_file(cache_file, cache_data)
+
+
+def write_private_file(private_file, data):
+    os.makedirs(os.path.dirname(os.path.abspath(private_file)), exist_ok=True)
+    temp_file = private_file + ".tmp"
+    with open(temp_file, "w") as f:
+        f.write(data)
+    os.chmod(temp_file, 0o600)
+    os.replace(temp_file, private_file)
+
+
+## BEARER TOKEN CACHE ##########################################################
+################################################################################
+
+TOKEN_CACHE_FILENAME = "token_cache.json"
+
+# Refresh cached tokens this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 300
+
+# Used when the token does not carry its own expiry
+TOKEN_DEFAULT_LIFETIME = 3600
+
+# Controllers authenticated in parallel share one cache file
+_token_cache_lock = threading.Lock()
+
+
+def token_cache_path(config_yaml):
+    # The token cache lives next to config.yaml
+    config_dir = os.path.dirname(os.path.abspath(config_yaml))
+
+    return os.path.join(config_dir, TOKEN_CACHE_FILENAME)
+
+
+def token_expiry(bearer_token):
+    # CML bearer tokens are JWTs; read the 'exp' claim without verifying it
+    try:
+        jwt_payload = bearer_token.split(".")[1]
+        jwt_payload += "=" * (-len(jwt_payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(jwt_payload))
+        return float(claims["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + TOKEN_DEFAULT_LIFETIME
+
+
+def get_cached_token(config_yaml, cml_user, cml_server):
+    # Returns the same structure as validate_settings_get_token() or None if
+    # there is no cached token or it is close to expiring
+    token_cache = load_json_cache(token_cache_path(config_yaml))
+    cached_token = token_cache.get(f"{cml_user}@{cml_server}")
+
+    if not isinstance(cached_token, dict):
+        return None
+    if cached_token.get("expires", 0) - TOKEN_REFRESH_MARGIN < time.time():
+        return None
+
+    validate_return = dict()
+    validate_return["status_code"] = "200"
+    validate_return["cml_url"] = cached_token["cml_url"]
+    validate_return["bearer_token"] = cached_token["bearer_token"]
+
+    return validate_return
+
+
+def cache_token(config_yaml, cml_user, cml_server, validate_return):
+    cache_file = token_cache_path(config_yaml)
+
+    with _token_cache_lock:
+        token_cache = load_json_cache(cache_file)
+        token_cache[f"{cml_user}@{cml_server}"] = {
+            "cml_url": validate_return["cml_url"],
+            "bearer_token": validate_return["bearer_token"],
+            "expires": token_expiry(validate_return["bearer_token"]),
+        }
+
+        try:
+            save_json_cache(cache_file, token_cache)
+        except OSError as err:
+            print(f"WARNING: Could not write {cache_file}: {err}")
+
+
+def invalidate_cached_token(config_yaml, cml_user, cml_server):
+    cache_file = token_cache_path(config_yaml)
+
+    with _token_cache_lock:
+        token_cache = load_json_cache(cache_file)
+        if token_cache.pop(f"{cml_user}@{cml_server}", None) is not None:
+            try:
+                save_json_cache(cache_file, token_cache)
+            except OSError:
+                pass
+
+
+def authenticate(config_yaml, cml_user, cml_pass, cml_server, use_cache=True):
+    # Same return values as validate_settings_get_token(); a cached token is
+    # only replaced when it is missing, about to expire or rejected (401)
+    if use_cache:
+        validate_return = get_cached_token(config_yaml, cml_user, cml_server)
+        if validate_return is not None:
+            validate_return["cached"] = True
+            return validate_return
+
+    validate_return = validate_settings_get_token(cml_user, cml_pass, cml_server)
+    if isinstance(validate_return, dict):
+        validate_return["cached"] = False
+        cache_token(config_yaml, cml_user, cml_server, validate_return)
+
+    return validate_return
+
+
+def is_unauthorized(err):
+    return err.response is not None and err.response.status_code == 401
+
+
+def authenticate_get_lab_info(config_yaml, cml_user, cml_pass, cml_server):
+    # Returns (validate_return, lab_info); lab_info is None if authentication
+    # failed. A cached token that the controller rejects is replaced once.
+    # The lab list is saved as this controller's lab snapshot.
+    validate_return = authenticate(config_yaml, cml_user, cml_pass, cml_server)
+    if not isinstance(validate_return, dict):
+        return validate_return, None
+
+    snapshot_file = lab_snapshot_path(config_yaml, cml_user, cml_server)
+    snapshot = load_lab_snapshot(snapshot_file)
+    if snapshot is not None:
+        restore_conditional_responses(snapshot)
+
+    try:
+        lab_info = get_lab_info(
+            validate_return["cml_url"], validate_return["bearer_token"]
+        )
+    except requests.exceptions.HTTPError as err:
+        if not is_unauthorized(err) or not validate_return["cached"]:
+            raise
+        # Cached token was revoked or expired early
+        invalidate_cached_token(config_yaml, cml_user, cml_server)
+        validate_return = authenticate(
+            config_yaml, cml_user, cml_pass, cml_server, False
+        )
+        if not isinstance(validate_return, dict):
+            return validate_return, None
+        lab_info = get_lab_info(
+            validate_return["cml_url"], validate_return["bearer_token"]
+        )
+
+    lab_info["cml_url"] = validate_return["cml_url"]
+    lab_info["snapshot_file"] = snapshot_file
+    save_lab_snapshot(lab_info)
+    lab_info["node_definitions"] = get_node_definitions(
+        config_yaml, validate_return["cml_url"], validate_return["bearer_token"]
+    )
+
+    return validate_return, lab_info
+
+
+## CML VERSION ################################################################
+################################################################################
+
+# Oldest CML release whose per-lab nodes endpoint accepts ?data=true. Older
+# controllers only expose node labels and definitions via populate_lab_tiles.
+LAZY_FETCH_MIN_VERSION = (2, 4)
+
+_cml_versions = dict()
+
+
+def parse_cml_version(version_string):
+    # "2.5.1+build.10" -> (2, 5, 1)
+    version_numbers = re.match(r"(\d+)\.(\d+)(?:\.(\d+))?", version_string or "")
+    if version_numbers is None:
+        return None
+
+    return tuple(int(number or 0) for number in version_numbers.groups())
+
+
+def get_cml_version(base_url):
+    # Returns the controller version as a tuple or None if it is unknown
+    if base_url not in _cml_versions:
+        try:
+            with timed_phase("lab_fetch"):
+                system_information_response = cml_api_request(
+                    "GET", base_url, "/system_information"
+                )
+            # Reads the body before it is counted
+            system_information_response.content
+            record_bytes_received(system_information_response)
+            system_information_response.raise_for_status()
+            version_string = system_information_response.json().get("version")
+            _cml_versions[base_url] = parse_cml_version(version_string)
+        except (requests.exceptions.RequestException, ValueError, AttributeError):
+            _cml_versions[base_url] = None
+
+    return _cml_versions[base_url]
+
+
+## STREAMING LAB TILES PARSER ##################################################
+################################################################################
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_json_decoder = json.JSONDecoder()
+_json_whitespace = re.compile(r"[ \t\n\r]*")
+
+
+def iter_lab_tiles(chunks):
+    # Incrementally parses a populate_lab_tiles body, {"lab_tiles": {id: tile}},
+    # from an iterable of byte chunks and yields (lab ID, lab tile) pairs.
+    # Only one lab tile is decoded at a time; other top-level keys are skipped.
+    chunks = iter(chunks)
+    utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    end_of_stream = False
+
+    def fill(minimum_growth):
+        # Drops the consumed text and reads until the unconsumed text has grown
+        # by at least minimum_growth characters. Growing geometrically keeps
+        # retried raw_decode() calls on a large lab tile linear overall.
+        nonlocal buffer, position, end_of_stream
+        if end_of_stream:
+            return False
+
+        pieces = [buffer[position:]]
+        target_length = len(pieces[0]) + max(minimum_growth, 1)
+        buffered_length = len(pieces[0])
+
+        while buffered_length < target_length:
+            chunk = next(chunks, None)
+            if chunk is None:
+                pieces.append(utf8_decoder.decode(b"", final=True))
+                end_of_stream = True
+                break
+            text = utf8_decoder.decode(chunk)
+            pieces.append(text)
+            buffered_length += len(text)
+
+        buffer = "".join(pieces)
+        position = 0
+
+        return True
+
+    def peek():
+        nonlocal position
+        while True:
+            position = _json_whitespace.match(buffer, position).end()
+            if position < len(buffer):
+                return buffer[position]
+            if not fill(1):
+                raise ValueError("Unexpected end of populate_lab_tiles response")
+
+    def expect(char):
+        nonlocal position
+        if peek() != char:
+            raise ValueError(
+                f"Expected '{char}' in populate_lab_tiles response, found '{peek()}'"
+            )
+        position += 1
+
+    def decode_value():
+        nonlocal position
+        peek()
+        while True:
+            try:
+                value, end = _json_decoder.raw_decode(buffer, position)
+                # A number cut off by the end of the buffer, or just after its
+                # '.', 'e' or sign, decodes as a shorter number
+                if end_of_stream or not (
+                    isinstance(value, (int, float))
+                    and not isinstance(value, bool)
+                    and (end == len(buffer) or buffer[end] in ".eE+-")
+                ):
+                    position = end
+                    return value
+            except json.JSONDecodeError:
+                if end_of_stream:
+                    raise
+            fill(len(buffer) - position)
+
+    expect("{")
+    while True:
+        char = peek()
+        if char == "}":
+            return
+        if char == ",":
+            position += 1
+            continue
+
+        key = decode_value()
+        expect(":")
+        if key != "lab_tiles":
+            decode_value()
+            continue
+
+        expect("{")
+        while True:
+            char = peek()
+            if char == "}":
+                position += 1
+                break
+            if char == ",":
+                position += 1
+                continue
+            lab_id = decode_value()
+            expect(":")
+            yield lab_id, decode_value()
+
+
+## LAB INFO ####################################################################
+################################################################################
+
+# Number of per-lab API calls in flight at once
+LAB_FETCH_WORKERS = 8
+
+
+def fetch_concurrently(function, items, workers=LAB_FETCH_WORKERS):
+    # Runs function(item) for every item over the shared connection pool and
+    # returns the results in the order of items
+    items = list(items)
+    if len(items) <= 1:
+        return [function(item) for item in items]
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        return list(executor.map(function, items))
+
+
+def lab_owner(lab):
+    # Newer controllers name the owner; older ones only give the user ID
+    return lab.get("owner_username") or lab.get("owner") or ""
+
+
+def lab_summary(lab):
+    # Lab title, state, owner and ID only; the topology is fetched separately
+    lab_tile = dict()
+    lab_tile["id"] = lab["id"]
+    lab_tile["lab_title"] = lab["lab_title"]
+    lab_tile["state"] = lab["state"]
+    lab_tile["owner"] = lab_owner(lab)
+    lab_tile["modified"] = lab.get("modified")
+
+    return lab_tile
+
+
+def get_lab_tile(base_url, bearer_token, lab_id):
+    # A copy, since get_lab_nodes() adds the topology to lab tiles
+    return dict(
+        cml_api_get_json(
+            base_url,
+            f"/labs/{lab_id}",
+            bearer_token,
+            compact=lambda lab: lab_summary(dict(lab, id=lab.get("id", lab_id))),
+        )
+    )
+
+
+def get_lab_tiles(base_url, bearer_token):
+    # show_all lists every lab to admin and service accounts, not just their
+    # own, as populate_lab_tiles does
+    lab_ids = cml_api_get_json(base_url, "/labs?show_all=true", bearer_token)
+
+    lab_tiles = fetch_concurrently(
+        lambda lab_id: get_lab_tile(base_url, bearer_token, lab_id), lab_ids
+    )
+
+    return {lab_tile["id"]: lab_tile for lab_tile in lab_tiles}
+
+
+def node_key(lab_node):
+    # Nodes without an ID (older controllers) are keyed by their label
+    return lab_node.get("id") or lab_node["label"]
+
+
+def compact_lab_tile(lab_tile):
+    # Keeps only the lab and node fields the generator uses
+    compact_tile = dict()
+    compact_tile["id"] = lab_tile["id"]
+    compact_tile["lab_title"] = lab_tile["lab_title"]
+    compact_tile["state"] = lab_tile["state"]
+    compact_tile["owner"] = lab_owner(lab_tile)
+    compact_tile["modified"] = lab_tile.get("modified")
+    compact_tile["topology"] = {
+        "nodes": [
+            {
+                "id": node_key(lab_node),
+                "label": lab_node["label"],
+                "node_definition": lab_node["node_definition"],
+            }
+            for lab_node in (lab_tile.get("topology") or {}).get("nodes", [])
+        ]
+    }
+
+    return compact_tile
+
+
+def get_populated_lab_tiles(base_url, bearer_token):
+    # Every lab including its full topology in a single (large) response. The
+    # body is parsed as it streams in, one lab tile at a time, so memory use
+    # does not grow with the size of the response. Sent as a conditional
+    # request like cml_api_get_json(), so an unchanged inventory is answered
+    # with a 304 instead of being downloaded again.
+    url = base_url + "/populate_lab_tiles"
+    cached_response = _conditional_responses.get(url)
+
+    start_time = time.perf_counter()
+    pop_lab_tiles_response = cml_api_request(
+        "GET",
+        base_url,
+        "/populate_lab_tiles",
+        bearer_token,
+        headers=conditional_headers(cached_response),
+        stream=True,
+    )
+    request_seconds = time.perf_counter() - start_time
+
+    if pop_lab_tiles_response.status_code == 304 and cached_response is not None:
+        with pop_lab_tiles_response:
+            # Reads the body before it is counted
+            pop_lab_tiles_response.content
+            record_bytes_received(pop_lab_tiles_response)
+        record_phase("lab_fetch", request_seconds)
+        # Copies, so the kept response is not changed through lab_info
+        return {
+            lab_id: dict(lab_tile)
+            for lab_id, lab_tile in cached_response["data"].items()
+        }
+    body_seconds = 0.0
+
+    def timed_chunks(chunks):
+        # Time spent waiting for the body counts as lab_fetch, the rest of the
+        # parsing loop as json_parse
+        nonlocal body_seconds
+        chunks = iter(chunks)
+        while True:
+            chunk_start_time = time.perf_counter()
+            chunk = next(chunks, None)
+            body_seconds += time.perf_counter() - chunk_start_time
+            if chunk is None:
+                return
+            yield chunk
+
+    with pop_lab_tiles_response:
+        pop_lab_tiles_response.raise_for_status()
+
+        parse_start_time = time.perf_counter()
+        lab_tiles = dict()
+        for lab_id, lab_tile in iter_lab_tiles(
+            timed_chunks(pop_lab_tiles_response.iter_content(STREAM_CHUNK_SIZE))
+        ):
+            lab_tiles[lab_id] = compact_lab_tile(lab_tile)
+        parse_seconds = time.perf_counter() - parse_start_time - body_seconds
+        record_bytes_received(pop_lab_tiles_response)
+
+    record_phase("lab_fetch", request_seconds + body_seconds)
+    record_phase("json_parse", parse_seconds)
+    remember_response(
+        url,
+        pop_lab_tiles_response,
+        {lab_id: dict(lab_tile) for lab_id, lab_tile in lab_tiles.items()},
+    )
+
+    return lab_tiles
+
+
+def get_lab_info(base_url, bearer_token):
+    # Get lab info: lab title, lab state, and lab ID
+    # Node lists are only included on controllers that are too old to fetch
+    # them per lab; see get_lab_nodes()
+    cml_version = get_cml_version(base_url)
+
+    if cml_version is not None and cml_version >= LAZY_FETCH_MIN_VERSION:
+        lab_tiles = get_lab_tiles(base_url, bearer_token)
+    else:
+        lab_tiles = get_populated_lab_tiles(base_url, bearer_token)
+
+    return build_lab_info(lab_tiles)
+
+
+def build_lab_info(lab_tiles):
+    lab_tiles_keys = list(lab_tiles.keys())
+
+    labs = []
+    lab_num = 0
+
+    for lab_tile in lab_tiles_keys:
+        lab_num += 1
+        lab_titles = lab_tiles[lab_tile]["lab_title"]
+        lab_states = lab_tiles[lab_tile]["state"]
+        lab_ids = lab_tiles[lab_tile]["id"]
+        lab = [lab_num, lab_titles, lab_states, lab_ids]
+        labs.append(lab)
+
+    num_of_labs = len(labs) + 1
+
+    lab_info = dict()
+    lab_info["lab_details"] = labs
+    lab_info["total_labs"] = num_of_labs
+    lab_info["lab_tiles"] = lab_tiles
+
+    return lab_info
+
+
+## LAB NODES ###################################################################
+################################################################################
+
+
+def compact_node_list(lab_nodes):
+    # Only the fields the generator uses are kept
+    return [
+        {
+            "id": lab_node["id"],
+            "label": lab_node["label"],
+            "node_definition": lab_node["node_definition"],
+        }
+        for lab_node in lab_nodes
+    ]
+
+
+def get_node_list(base_url, bearer_token, lab_id):
+    return list(
+        cml_api_get_json(
+            base_url,
+            f"/labs/{lab_id}/nodes?data=true",
+            bearer_token,
+            compact=compact_node_list,
+        )
+    )
+
+
+def get_lab_nodes(base_url, bearer_token, lab_info, lab_ids):
+    # Adds the topology to the lab tiles of the given labs, fetching the node
+    # lists of labs that do not have one yet concurrently. Offline, only the
+    # node lists in the snapshot are available.
+    lab_tiles = lab_info["lab_tiles"]
+    missing_lab_ids = [
+        lab_id for lab_id in lab_ids if "topology" not in lab_tiles[lab_id]
+    ]
+    if lab_info.get("offline") or not missing_lab_ids:
+        return lab_info
+
+    node_lists = fetch_concurrently(
+        lambda lab_id: get_node_list(base_url, bearer_token, lab_id), missing_lab_ids
+    )
+
+    for lab_id, lab_nodes in zip(missing_lab_ids, node_lists):
+        lab_tiles[lab_id]["topology"] = {"nodes": lab_nodes}
+
+    save_lab_snapshot(lab_info)
+
+    return lab_info
+
+
+## NODE DEFINITION CATALOG ####################################################
+################################################################################
+
+# Serial ports per node definition, fetched from each controller and cached
+# next to config.yaml until the controller is upgraded or the entry is
+# NODE_DEFINITIONS_MAX_AGE seconds old
+NODE_DEFINITIONS_CACHE_FILENAME = "node_definitions_cache.json"
+NODE_DEFINITIONS_MAX_AGE = 7 * 24 * 3600
+
+# Skipped when the catalog is unavailable or does not know a node definition
+CONSOLELESS_NODE_DEFINITIONS = ("external_connector", "unmanaged_switch")
+
+_node_definitions_lock = threading.Lock()
+
+
+def node_definitions_cache_path(config_yaml):
+    config_dir = os.path.dirname(os.path.abspath(config_yaml))
+
+    return os.path.join(config_dir, NODE_DEFINITIONS_CACHE_FILENAME)
+
+
+def compact_node_definitions(node_definitions):
+    # {node definition ID: number of serial ports}; None if the definition
+    # does not say
+    serial_ports = dict()
+    for node_definition in node_definitions:
+        interfaces = (node_definition.get("device") or dict()).get("interfaces")
+        ports = (interfaces or dict()).get("serial_ports")
+        serial_ports[node_definition["id"]] = ports if isinstance(ports, int) else None
+
+    return serial_ports
+
+
+def cml_version_key(base_url):
+    cml_version = get_cml_version(base_url)
+    if cml_version is None:
+        return "unknown"
+
+    return ".".join(str(number) for number in cml_version)
+
+
+def get_node_definitions(config_yaml, base_url, bearer_token):
+    # Serial ports per node definition of the controller, or None if the
+    # catalog could not be fetched and was never cached. Without a bearer
+    # token (offline) the cached catalog is used whatever its age.
+    cache_file = node_definitions_cache_path(config_yaml)
+    with _node_definitions_lock:
+        catalog_cache = load_json_cache(cache_file)
+    cached_catalog = catalog_cache.get(base_url)
+    if not isinstance(cached_catalog, dict):
+        cached_catalog = None
+
+    if bearer_token is None:
+        return cached_catalog and cached_catalog["serial_ports"]
+
+    # A catalog younger than NODE_DEFINITIONS_MAX_AGE is used without asking
+    # the controller for its version, unless this run already knows it
+    if (
+        cached_catalog is not None
+        and time.time() - cached_catalog.get("fetched", 0) < NODE_DEFINITIONS_MAX_AGE
+        and (
+            base_url not in _cml_versions
+            or cached_catalog.get("version") == cml_version_key(base_url)
+        )
+    ):
+        return cached_catalog["serial_ports"]
+
+    version = cml_version_key(base_url)
+
+    try:
+        serial_ports = cml_api_get_json(
+            base_url,
+            "/node_definitions",
+            bearer_token,
+            compact=compact_node_definitions,
+        )
+    except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+        # Older controllers and restricted accounts fall back to the stale
+        # catalog or to CONSOLELESS_NODE_DEFINITIONS
+        return cached_catalog and cached_catalog["serial_ports"]
+
+    with _node_definitions_lock:
+        catalog_cache = load_json_cache(cache_file)
+        catalog_cache[base_url] = {
+            "version": version,
+            "fetched": time.time(),
+            "serial_ports": serial_ports,
+        }
+        try:
+            save_json_cache(cache_file, catalog_cache)
+        except OSError:
+            # Not fatal; the catalog is fetched again next time
+            pass
+
+    return serial_ports
+
+
+def console_lines(lab_node, node_definitions, all_consoles=False):
+    # Console lines to write sessions for: none for node definitions without
+    # serial ports, otherwise line 0, or every line with all_consoles
+    node_definition = lab_node["node_definition"]
+    ports = None
+    if node_definitions is not None:
+        ports = node_definitions.get(node_definition)
+
+    if ports is None:
+        if node_definition in CONSOLELESS_NODE_DEFINITIONS:
+            return []
+        return [0]
+    if not all_consoles:
+        return [0] if ports else []
+
+    return list(range(ports))
+
+
+## LAB SNAPSHOTS ###############################################################
+################################################################################
+
+# Compact copy of the last lab list and node lists fetched from each
+# controller, kept next to config.yaml. It is used with --offline or when the
+# controller cannot be reached, and its ETags make the next fetch conditional.
+LAB_SNAPSHOT_DIRNAME = "lab_snapshots"
+
+
+def lab_snapshot_path(config_yaml, cml_user, cml_server):
+    config_dir = os.path.dirname(os.path.abspath(config_yaml))
+    snapshot_filename = sanitize_name(f"{cml_user}@{cml_server}", INVALID_CHARS)
+
+    return os.path.join(config_dir, LAB_SNAPSHOT_DIRNAME, snapshot_filename + ".json")
+
+
+def load_lab_snapshot(snapshot_file):
+    snapshot = load_json_cache(snapshot_file)
+    if not isinstance(snapshot.get("lab_tiles"), dict):
+        return None
+
+    return snapshot
+
+
+def save_lab_snapshot(lab_info):
+    # Node lists of labs that were not fetched this time are kept from the
+    # previous snapshot as long as the lab's 'modified' timestamp is unchanged
+    snapshot_file = lab_info.get("snapshot_file")
+    if snapshot_file is None or lab_info.get("offline"):
+        return
+
+    base_url = lab_info["cml_url"]
+    previous_snapshot = load_lab_snapshot(snapshot_file) or {"lab_tiles": dict()}
+
+    lab_tiles = dict()
+    for lab_id, lab_tile in lab_info["lab_tiles"].items():
+        previous_tile = previous_snapshot["lab_tiles"].get(lab_id) or dict()
+        if (
+            "topology" not in lab_tile
+            and "topology" in previous_tile
+            and lab_tile.get("modified") is not None
+            and lab_tile.get("modified") == previous_tile.get("modified")
+        ):
+            lab_tile = dict(lab_tile, topology=previous_tile["topology"])
+        lab_tiles[lab_id] = lab_tile
+
+    snapshot = dict()
+    snapshot["cml_url"] = base_url
+    snapshot["saved"] = time.time()
+    snapshot["lab_tiles"] = lab_tiles
+    snapshot["responses"] = {
+        url: cached_response
+        for url, cached_response in list(_conditional_responses.items())
+        if url.startswith(base_url + "/")
+    }
+
+    # The snapshot is only a fallback, so failing to write it never fails a run
+    try:
+        save_json_cache(snapshot_file, snapshot, compact=True)
+    except OSError as err:
+        print(f"WARNING: Could not write {snapshot_file}: {err}")
+
+
+def restore_conditional_responses(snapshot):
+    # Lets the first fetch after a restart be answered with 304s
+    for url, cached_response in (snapshot.get("responses") or dict()).items():
+        _conditional_responses.setdefault(url, cached_response)
+
+
+def offline_lab_info(config_yaml, cml_user, cml_server):
+    # lab_info from the last snapshot, or None if there is none yet
+    snapshot = load_lab_snapshot(lab_snapshot_path(config_yaml, cml_user, cml_server))
+    if snapshot is None:
+        return None
+
+    lab_info = build_lab_info(snapshot["lab_tiles"])
+    lab_info["cml_url"] = snapshot.get("cml_url")
+    lab_info["offline"] = True
+    lab_info["snapshot_saved"] = snapshot.get("saved", 0)
+    lab_info["node_definitions"] = get_node_definitions(
+        config_yaml, lab_info["cml_url"], None
+    )
+
+    return lab_info
+
+
+def offline_validate_return(lab_info):
+    # Stands in for validate_settings_get_token()'s result when offline
+    validate_return = dict()
+    validate_return["status_code"] = None
+    validate_return["cml_url"] = lab_info["cml_url"]
+    validate_return["bearer_token"] = None
+    validate_return["cached"] = True
+
+    return validate_return
+
+
+def print_offline_notice(lab_info, reason):
+    saved = time.strftime("%Y-%m-%d %H:%M", time.localtime(lab_info["snapshot_saved"]))
+    print(f"OFFLINE: {reason}. Using the lab list saved {saved}.")
+
+
+## SELECT LAB ##################################################################
+################################################################################
+
+
+# Labs listed per page by lab_selector()
+LAB_PAGE_SIZE = 20
+
+LAB_SEARCH_FIELDS = ("title", "owner", "state")
+
+
+def build_lab_index(lab_info):
+    # One entry per lab in get_lab_info() order, with its fields lower-cased
+    # once for searching
+    lab_index = []
+
+    for lab in lab_info["lab_details"]:
+        owner = lab_info["lab_tiles"][lab[3]].get("owner") or ""
+
+        index_entry = dict()
+        index_entry["lab"] = lab
+        index_entry["owner"] = owner
+        index_entry["fields"] = {
+            "title": lab[1].casefold(),
+            "owner": owner.casefold(),
+            "state": lab[2].casefold(),
+        }
+        index_entry["text"] = "\n".join(index_entry["fields"].values())
+        lab_index.append(index_entry)
+
+    return lab_index
+
+
+def parse_lab_query(query):
+    # "core owner:adm" -> [(None, "core"), ("owner", "adm")]. Plain terms match
+    # anywhere in the title, owner or state, FIELD:TEXT terms match the start
+    # of that field; every term has to match.
+    search_terms = []
+
+    for term in query.casefold().split():
+        field, separator, value = term.partition(":")
+        if separator and field in LAB_SEARCH_FIELDS:
+            search_terms.append((field, value))
+        else:
+            search_terms.append((None, term))
+
+    return search_terms
+
+
+def lab_matches(index_entry, search_terms):
+    for field, value in search_terms:
+        if field is None:
+            if value not in index_entry["text"]:
+                return False
+        elif not index_entry["fields"][field].startswith(value):
+            return False
+
+    return True
+
+
+def refines(search_terms, previous_terms):
+    # True if every lab matching search_terms also matches previous_terms,
+    # e.g. "core" after "co" or "co state:s" after "co"
+    if len(search_terms) < len(previous_terms):
+        return False
+
+    return all(
+        field == previous_field and value.startswith(previous_value)
+        for (field, value), (previous_field, previous_value) in zip(
+            search_terms, previous_terms
+        )
+    )
+
+
+def search_lab_index(lab_index, search_terms, search_cache):
+    # search_cache holds (search terms, matches) of earlier searches. A query
+    # that narrows an earlier one only scans that query's matches, so typing
+    # a query a few characters at a time stays cheap with thousands of labs.
+    candidates = lab_index
+    for previous_terms, previous_matches in search_cache:
+        if len(previous_matches) < len(candidates) and refines(
+            search_terms, previous_terms
+        ):
+            candidates = previous_matches
+
+    matches = [
+        index_entry
+        for index_entry in candidates
+        if lab_matches(index_entry, search_terms)
+    ]
+    search_cache.append((search_terms, matches))
+
+    return matches
+
+
+def parse_lab_numbers(selection, num_of_labs):
+    # "3", "3 5" or "3,5,8-10" -> [3, 5, 8, 9, 10]; None if any part is not a
+    # lab NUMBER or range of them
+    lab_numbers = []
+
+    for part in selection.replace(",", " ").split():
+        first, separator, last = part.partition("-")
+        if not first.isdigit() or (separator and not last.isdigit()):
+            return None
+        first = int(first)
+        last = int(last) if separator else first
+        if not 1 <= first <= last < num_of_labs:
+            return None
+        for lab_number in range(first, last + 1):
+            if lab_number not in lab_numbers:
+                lab_numbers.append(lab_number)
+
+    return lab_numbers or None
+
+
+def print_lab_page(matches, page, query):
+    # Only the rows on the page are formatted
+    page_count = max(1, -(-len(matches) // LAB_PAGE_SIZE))
+    page_matches = matches[page * LAB_PAGE_SIZE : (page + 1) * LAB_PAGE_SIZE]
+
+    print()
+    print(
+        tabulate(
+            [
+                index_entry["lab"][:3] + [index_entry["owner"], index_entry["lab"][3]]
+                for index_entry in page_matches
+            ],
+            headers=["NUMBER", "LAB", "STATE", "OWNER", "UUID"],
+        )
+    )
+    print()
+    if query:
+        print(f"{len(matches)} lab(s) matching '{query}', ", end="")
+    else:
+        print(f"{len(matches)} lab(s), ", end="")
+    print(f"page {page + 1} of {page_count}")
+
+
+def lab_selector(lab_info):
+    # Returns the lab_details rows of the labs the user picked
+    labs = lab_info["lab_details"]
+    num_of_labs = lab_info["total_labs"]
+
+    lab_index = build_lab_index(lab_info)
+    search_cache = []
+    matches = lab_index
+    query = ""
+    page = 0
+
+    print(
+        "\nEnter lab NUMBER(s), e.g. 3 or 3,5,8-10, or '*' for every lab listed.\n"
+        "'/TEXT' searches titles, owners and states ('owner:NAME', "
+        "'state:STARTED' and 'title:TEXT' match the start of a field),\n"
+        "'/' clears the search, 'n' and 'p' page forward and back.\n"
+        "['q' to quit.]"
+    )
+
+    while True:
+        print_lab_page(matches, page, query)
+        user_specified_lab = input("Enter lab NUMBER(s) or a command: ").strip()
+        print()
+
+        if user_specified_lab.lower() == "q":
+            print("Exiting")
+            sys.exit(1)
+        elif user_specified_lab.startswith("/"):
+            query = user_specified_lab[1:].strip()
+            matches = search_lab_index(lab_index, parse_lab_query(query), search_cache)
+            page = 0
+        elif user_specified_lab.lower() == "n":
+            if (page + 1) * LAB_PAGE_SIZE < len(matches):
+                page += 1
+        elif user_specified_lab.lower() == "p":
+            page = max(0, page - 1)
+        elif user_specified_lab == "*":
+            if matches:
+                return [index_entry["lab"] for index_entry in matches]
+        elif user_specified_lab:
+            lab_numbers = parse_lab_numbers(user_specified_lab, num_of_labs)
+            if lab_numbers is not None:
+                return [labs[lab_number - 1] for lab_number in lab_numbers]
+            print(f"'{user_specified_lab}' is not a lab NUMBER or command.")
+
+
+## VERIFY INITIAL CONFIG FILE EXISTS ###########################################
+################################################################################
+
+
+def initial_config_check():
+    init_config_file = "initial_config"
+
+    if os.path.exists(init_config_file):
+        pass
+    else:
+        print(f"{init_config_file} was not found.")
+        print("Exiting")
+        sys.exit(1)
+
+
+## VERIFY CML CONSOLE SERVER SESSION TEMPLATE FILE EXISTS ######################
+################################################################################
+
+
+def cml_console_server_check():
+    init_console_server_session_file = "cml_console_server"
+
+    if os.path.exists(init_console_server_session_file):
+        pass
+    else:
+        print(f"{init_console_server_session_file} was not found.")
+        print("Exiting")
+        sys.exit(1)
+
+
+## VERIFY CML CONSOLE SERVER SESSION TEMPLATE FILE EXIST #######################
+################################################################################
+
+
+def config_yaml_check(CONFIG_YAML):
+    if os.path.exists(CONFIG_YAML):
+        return True
+    else:
+        return False
+
+
+## SET CONFIG VARIABLES ########################################################
+################################################################################
+
+
+def config_cache_path(config_yaml):
+    # config.yaml -> .config.yaml.cache.json in the same directory
+    config_dir, config_name = os.path.split(os.path.abspath(config_yaml))
+    return os.path.join(config_dir, f".{config_name}.cache.json")
+
+
+def load_config_yaml(config_yaml):
+    # Parsed config.yaml. The parsed form is cached as JSON next to it and
+    # reused while config.yaml's size and modification time are unchanged, so
+    # yaml is only imported after config.yaml has been edited.
+    config_stat = os.stat(config_yaml)
+    cache_file = config_cache_path(config_yaml)
+    cache_key = [config_stat.st_size, config_stat.st_mtime_ns]
+
+    config_cache = load_json_cache(cache_file)
+    if config_cache.get("key") == cache_key and "data" in config_cache:
+        return config_cache["data"]
+
+    import yaml
+
+    # libyaml's C loader when PyYAML was built with it
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    with open(config_yaml) as f:
+        data = yaml.load(f, Loader=loader)
+
+    config_cache = dict()
+    config_cache["key"] = cache_key
+    config_cache["data"] = data
+    try:
+        save_json_cache(cache_file, config_cache, compact=True)
+    except (OSError, TypeError, ValueError):
+        # Not fatal; config.yaml is parsed again next time
+        pass
+
+    return data
+
+
+@timed_phase("config")
+def config_controllers():
+    # Every controller in config.yaml: the top-level username, password and
+    # controller, if present, followed by the entries of the optional
+    # 'controllers' list. List entries without a username or password use the
+    # top-level ones.
+    try:
+        data = load_config_yaml(CONFIG_YAML)
+        config_entries = []
+        if "controller" in data:
+            config_entries.append(data)
+        config_entries.extend(data.get("controllers") or [])
+
+        controllers = []
+        for config_entry in config_entries:
+            cml_configs = dict()
+            cml_configs["cml_user"] = config_entry.get("username", data.get("username"))
+            cml_configs["cml_pass"] = config_entry.get("password", data.get("password"))
+            cml_configs["cml_server"] = config_entry["controller"]
+            if not all(cml_configs.values()):
+                raise KeyError("username")
+            # Skip a controller listed twice for the same user
+            if cml_configs not in controllers:
+                controllers.append(cml_configs)
+        if not controllers:
+            raise KeyError("controller")
+
+        return controllers
+    except FileNotFoundError:
+        print(f"Error:  {CONFIG_YAML} file not found.")
+        return None
+    except (IndexError, KeyError, TypeError, AttributeError):
+        print(f"Error:  Invalid or missing fields in {CONFIG_YAML}.")
+        return None
+    except Exception as err:
+        print(f"An error occurred: {err}")
+        return None
+
+
+def set_config_variables():
+    # Settings of the first controller in config.yaml
+    controllers = config_controllers()
+    if controllers is None:
+        return None
+
+    return controllers[0]
+
+
+## CREATE DIRECTORY FOR LAB SESSIONS ###########################################
+################################################################################
+
+
+def create_lab_session_dir(sessions_cml_labs_dir, lab_title):
+    # The lab folder itself appears when its sessions are published
+    node_session_dir = os.path.join(sessions_cml_labs_dir, lab_title)
+
+    try:
+        os.makedirs(sessions_cml_labs_dir, exist_ok=True)
+        print(f"Directory for lab '{lab_title}' ready")
+        print("=" * 79)
+        return node_session_dir
+    except OSError:
+        print(f"Directory for lab '{lab_title}' could not be created")
+        sys.exit(1)
+    except Exception as err:
+        print(f"An error occurred: {err}")
+        return None
+
+
+## SESSION MANIFEST ############################################################
+################################################################################
+
+# Written into every lab folder; maps CML node ID -> session file name and hash
+SESSION_MANIFEST_FILENAME = ".session_manifest.json"
+
+
+def load_session_manifest(
+    node_session_dir, manifest_filename=SESSION_MANIFEST_FILENAME
+):
+    manifest_file = os.path.join(node_session_dir, manifest_filename)
+
+    try:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+    if not isinstance(manifest, dict):
+        return dict()
+
+    return manifest
+
+
+def save_session_manifest(
+    node_session_dir, manifest, manifest_filename=SESSION_MANIFEST_FILENAME
+):
+    manifest_file = os.path.join(node_session_dir, manifest_filename)
+    temp_file = manifest_file + ".tmp"
+
+    with open(temp_file, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(temp_file, manifest_file)
+
+
+def new_session_sync():
+    # Filenames of the sessions touched by a run, grouped by kind of change
+    session_sync = dict()
+    session_sync["added"] = []
+    session_sync["changed"] = []
+    session_sync["renamed"] = []
+    session_sync["removed"] = []
+    session_sync["unchanged"] = 0
+    # (filename, error) of session files that could not be written
+    session_sync["failed"] = []
+
+    return session_sync
+
+
+def sessions_written(session_sync):
+    return (
+        len(session_sync["added"])
+        + len(session_sync["changed"])
+        + len(session_sync["renamed"])
+    )
+
+
+def print_session_sync(session_sync):
+    for filename in session_sync["added"]:
+        print(f"  + {filename}")
+    for filename in session_sync["changed"]:
+        print(f"  ~ {filename}")
+    for old_filename, filename in session_sync["renamed"]:
+        print(f"  > {old_filename} -> {filename}")
+    for filename in session_sync["removed"]:
+        print(f"  - {filename}")
+    for filename, error in session_sync["failed"]:
+        print(f"  ! {filename}: {error}")
+
+    print(
+        f"\n{len(session_sync['added'])} added, {len(session_sync['changed'])} changed, "
+        f"{len(session_sync['renamed'])} renamed, {len(session_sync['removed'])} removed, "
+        f"{session_sync['unchanged']} unchanged"
+    )
+    if session_sync["failed"]:
+        print(f"{len(session_sync['failed'])} session file(s) could not be written")
+
+
+## NODE SESSION TEMPLATE #######################################################
+################################################################################
+
+NODE_SESSION_PLACEHOLDERS = (
+    "CHANGEME_LAB_TITLE",
+    "CHANGEME_NODE_LABEL",
+    "CHANGEME_CONSOLE_LINE",
+)
+
+# Templates created before console lines became a placeholder end the
+# console server command with a fixed line 0
+LEGACY_CONSOLE_LINE_COMMAND = "CHANGEME_NODE_LABEL/0"
+
+_node_session_template_pattern = re.compile(
+    "(" + "|".join(re.escape(p) for p in NODE_SESSION_PLACEHOLDERS) + ")"
+)
+
+# Session file formats: one .ini file per session, or every session of the
+# selected labs in one SecureCRT XML import file (see BULK EXPORT)
+SESSION_FORMAT_INI = "ini"
+SESSION_FORMAT_XML = "xml"
+SESSION_FORMATS = (SESSION_FORMAT_INI, SESSION_FORMAT_XML)
+
+# Compiled templates keyed by (path, format); reloaded only if the file
+# changes on disk
+_compiled_templates = dict()
+
+
+def compile_node_session_template(node_session_template):
+    # Splits the template into static chunks and placeholder slots once so
+    # each session is rendered with a single join instead of full-string
+    # replace passes
+    node_session_template = node_session_template.replace(
+        LEGACY_CONSOLE_LINE_COMMAND, "CHANGEME_NODE_LABEL/CHANGEME_CONSOLE_LINE"
+    )
+    template_parts = _node_session_template_pattern.split(node_session_template)
+
+    compiled_template = dict()
+    compiled_template["parts"] = template_parts
+    compiled_template["slots"] = [
+        (index, template_parts[index]) for index in range(1, len(template_parts), 2)
+    ]
+
+    return compiled_template
+
+
+def load_node_session_template(
+    node_session_template_location, session_format=SESSION_FORMAT_INI
+):
+    template_stat = os.stat(node_session_template_location)
+    template_key = (template_stat.st_mtime_ns, template_stat.st_size)
+    cache_key = (node_session_template_location, session_format)
+
+    cached_template = _compiled_templates.get(cache_key)
+    if cached_template is not None and cached_template[0] == template_key:
+        return cached_template[1]
+
+    with open(node_session_template_location, encoding="utf-8", newline="") as f:
+        node_session_template = f.read()
+
+    if session_format == SESSION_FORMAT_XML:
+        node_session_template = export_session_template(node_session_template)
+    compiled_template = compile_node_session_template(node_session_template)
+
+    _compiled_templates[cache_key] = (template_key, compiled_template)
+
+    return compiled_template
+
+
+def render_node_session(compiled_template, substitutions):
+    # substitutions maps placeholder -> value, e.g. {"CHANGEME_LAB_TITLE": ...}
+    session_parts = compiled_template["parts"].copy()
+    for index, placeholder in compiled_template["slots"]:
+        session_parts[index] = substitutions[placeholder]
+
+    return "".join(session_parts)
+
+
+## SESSION FILE WRITER #########################################################
+################################################################################
+
+# Session files written at once. On SMB-backed roaming profiles every create,
+# write and close is a network round trip, so overlapping them hides latency.
+SESSION_WRITE_WORKERS = 8
+
+# Labs with fewer files to write are written on the calling thread; on a local
+# disk the pool would only add overhead
+PARALLEL_WRITE_MIN_FILES = 32
+
+# Files between progress updates in verbose mode
+WRITE_PROGRESS_STEP = 100
+
+
+def write_session_file(node_session_location, node_session_data):
+    # Returns the number of bytes written. Encoded up front and written in
+    # binary mode; same bytes as a utf-8 text file opened with newline=""
+    encoded_data = node_session_data.encode("utf-8")
+    with open(node_session_location, "wb") as f:
+        f.write(encoded_data)
+
+    return len(encoded_data)
+
+
+def write_session_files(pending_writes, workers=SESSION_WRITE_WORKERS, progress=None):
+    # pending_writes is a list of (location, data). Returns one
+    # (bytes written, error) tuple per file, in the order of pending_writes;
+    # error is None if the file was written. progress(done, total) is called
+    # in the same order as files complete.
+    def write(pending_write):
+        try:
+            return write_session_file(*pending_write), None
+        except (OSError, ValueError) as err:
+            return 0, err
+
+    total = len(pending_writes)
+    write_results = []
+
+    with contextlib.ExitStack() as stack:
+        if workers > 1 and total >= PARALLEL_WRITE_MIN_FILES:
+            from concurrent.futures import ThreadPoolExecutor
+
+            executor = stack.enter_context(
+                ThreadPoolExecutor(max_workers=min(workers, total))
+            )
+            results = executor.map(write, pending_writes)
+        else:
+            results = map(write, pending_writes)
+
+        for result in results:
+            write_results.append(result)
+            if progress is not None:
+                progress(len(write_results), total)
+
+    return write_results
+
+
+def print_write_progress(done, total):
+    if done % WRITE_PROGRESS_STEP == 0 or done == total:
+        end = "\n" if done == total else ""
+        print(f"\rWriting session files: {done}/{total}", end=end, flush=True)
+
+
+## STAGED PUBLISH ##############################################################
+################################################################################
+
+# A lab folder is never written in place. Its next version is built in a
+# staging folder outside the Sessions tree, on the same filesystem, and swapped
+# in with two renames, so SecureCRT sees one change and an interrupted run
+# never leaves a half-written lab. The version it replaced is kept as a
+# one-deep backup:
+#   <SecureCRT Config>/.session_gen/<CML server Labs>/staging/<lab>
+#   <SecureCRT Config>/.session_gen/<CML server Labs>/backup/<lab>
+PUBLISH_WORK_DIRNAME = ".session_gen"
+
+
+def lab_publish_dirs(node_session_dir):
+    # Returns (staging dir, backup dir) of 'Sessions/CML <server> Labs/<lab>'
+    sessions_cml_labs_dir, lab_dirname = os.path.split(
+        os.path.abspath(node_session_dir)
+    )
+    sessions_dir, labs_dirname = os.path.split(sessions_cml_labs_dir)
+    work_dir = os.path.join(
+        os.path.dirname(sessions_dir), PUBLISH_WORK_DIRNAME, labs_dirname
+    )
+
+    return (
+        os.path.join(work_dir, "staging", lab_dirname),
+        os.path.join(work_dir, "backup", lab_dirname),
+    )
+
+
+def recover_lab_session_dir(node_session_dir):
+    # Cleans up after a run that was interrupted while staging or publishing.
+    # The manifest is the last file written to a staging folder, so a staging
+    # folder with a manifest is complete; if the lab folder is missing the run
+    # stopped between the two renames and the staged version is moved in.
+    import shutil
+
+    staging_dir, backup_dir = lab_publish_dirs(node_session_dir)
+    if not os.path.isdir(staging_dir):
+        return
+
+    staged_manifest = os.path.join(staging_dir, SESSION_MANIFEST_FILENAME)
+    if not os.path.exists(node_session_dir) and os.path.exists(staged_manifest):
+        os.rename(staging_dir, node_session_dir)
+    else:
+        shutil.rmtree(staging_dir)
+
+
+def link_or_copy(source, destination):
+    # Hard links make carrying unchanged files over to the staging folder
+    # cheap; filesystems without them get a copy
+    import shutil
+
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def stage_lab_session_dir(node_session_dir, replaced_filenames):
+    # Creates the staging folder with everything in the lab folder except
+    # replaced_filenames, which are about to be rewritten or removed. Files
+    # the generator did not create are carried over untouched.
+    import shutil
+
+    staging_dir = lab_publish_dirs(node_session_dir)[0]
+    os.makedirs(staging_dir)
+
+    if os.path.isdir(node_session_dir):
+        for dir_entry in os.scandir(node_session_dir):
+            if dir_entry.name in replaced_filenames:
+                continue
+            staged_location = os.path.join(staging_dir, dir_entry.name)
+            if dir_entry.is_dir(follow_symlinks=False):
+                shutil.copytree(
+                    dir_entry.path,
+                    staged_location,
+                    symlinks=True,
+                    copy_function=link_or_copy,
+                )
+            else:
+                link_or_copy(dir_entry.path, staged_location)
+
+    return staging_dir
+
+
+def publish_lab_session_dir(node_session_dir):
+    # Swaps the staging folder in; the current lab folder becomes the backup
+    # and is moved back if the staged version cannot be moved in
+    import shutil
+
+    staging_dir, backup_dir = lab_publish_dirs(node_session_dir)
+
+    if not os.path.exists(node_session_dir):
+        os.makedirs(os.path.dirname(node_session_dir), exist_ok=True)
+        os.rename(staging_dir, node_session_dir)
+        return
+
+    if os.path.exists(backup_dir):
+        shutil.rmtree(backup_dir)
+    os.makedirs(os.path.dirname(backup_dir), exist_ok=True)
+
+    os.rename(node_session_dir, backup_dir)
+    try:
+        os.rename(staging_dir, node_session_dir)
+    except OSError:
+        os.rename(backup_dir, node_session_dir)
+        raise
+
+
+def discard_staged_lab_session_dir(node_session_dir):
+    import shutil
+
+    shutil.rmtree(lab_publish_dirs(node_session_dir)[0], ignore_errors=True)
+
+
+## GENERATE NODE SESSIONS ######################################################
+################################################################################
+
+
+def lab_console_sessions(
+    lab_nodes, invalid_chars, node_definitions, all_consoles, previous_names=None
+):
+    # One (session ID, session name, node label, console line) per console
+    # session of a lab. Line 0 keeps the node ID as its session ID; labels
+    # that sanitize to the same session name get numbered suffixes, keeping
+    # the session names in previous_names (session ID -> name) where they can.
+    console_sessions = []
+    for lab_node in lab_nodes:
+        node_id = node_key(lab_node)
+        for line in console_lines(lab_node, node_definitions, all_consoles):
+            if line == 0:
+                console_sessions.append(
+                    (node_id, lab_node["label"], lab_node["label"], line)
+                )
+            else:
+                console_sessions.append(
+                    (
+                        f"{node_id}/{line}",
+                        f"{lab_node['label']} line {line}",
+                        lab_node["label"],
+                        line,
+                    )
+                )
+
+    session_names = unique_names(
+        {
+            session_id: session_name
+            for session_id, session_name, _, _ in console_sessions
+        },
+        invalid_chars,
+        previous_names,
+    )
+
+    return [
+        (session_id, session_names[session_id], lab_node_label, line)
+        for session_id, _, lab_node_label, line in console_sessions
+    ]
+
+
+def session_substitutions(lab_title_command, lab_node_label_command, line):
+    substitutions = dict()
+    substitutions["CHANGEME_LAB_TITLE"] = lab_title_command
+    substitutions["CHANGEME_NODE_LABEL"] = lab_node_label_command
+    substitutions["CHANGEME_CONSOLE_LINE"] = str(line)
+
+    return substitutions
+
+
+def generate_node_sessions_files(
+    sessions_cml_labs_dir,
+    lab_nodes,
+    invalid_chars,
+    node_session_dir,
+    lab_title_command,
+    lab_title,
+    verbose=True,
+    write_workers=SESSION_WRITE_WORKERS,
+    node_definitions=None,
+    all_consoles=False,
+):
+    # node_definitions (see get_node_definitions()) decides which nodes have
+    # a console; with all_consoles every extra console line of a node gets a
+    # '<node> line N' session too.
+    # Only new or changed session files are written. Sessions for nodes that
+    # were deleted or renamed in CML are removed. The manifest kept in the lab
+    # folder records what the previous run wrote. Files that cannot be
+    # written are reported in session_sync["failed"], keep their previous
+    # version and are left out of the manifest so the next run tries them
+    # again. Changes are staged and published as a whole; a lab with nothing
+    # to change is not touched.
+    if verbose:
+        print()
+        print(f"Generating session files for lab: {lab_title}")
+        print("=" * 79)
+
+    node_session_template_filename = "node_session_template"
+    node_session_template_location = os.path.join(
+        sessions_cml_labs_dir, node_session_template_filename
+    )
+
+    compiled_template = load_node_session_template(node_session_template_location)
+
+    recover_lab_session_dir(node_session_dir)
+    previous_manifest = load_session_manifest(node_session_dir)
+    manifest = dict()
+    session_sync = new_session_sync()
+
+    with timed_phase("render"), profiled():
+        for (
+            lab_node_id,
+            lab_node_label,
+            lab_node_label_command,
+            line,
+        ) in lab_console_sessions(
+            lab_nodes,
+            invalid_chars,
+            node_definitions,
+            all_consoles,
+            {
+                lab_node_id: entry["filename"][: -len(".ini")]
+                for lab_node_id, entry in previous_manifest.items()
+                if isinstance(entry, dict)
+                and str(entry.get("filename", "")).endswith(".ini")
+            },
+        ):
+            node_session_data = render_node_session(
+                compiled_template,
+                session_substitutions(lab_title_command, lab_node_label_command, line),
+            )
+
+            node_session_filename = lab_node_label + ".ini"
+            manifest[lab_node_id] = {
+                "filename": node_session_filename,
+                "hash": hashlib.sha256(node_session_data.encode("utf-8")).hexdigest(),
+                "data": node_session_data,
+            }
+
+    files_written = 0
+    bytes_written = 0
+
+    with timed_phase("write"):
+        # Sessions of deleted or renamed nodes are not carried over to the
+        # staged lab folder, unless their file name now belongs to another node
+        current_filenames = set(entry["filename"] for entry in manifest.values())
+        replaced_filenames = set()
+
+        for lab_node_id, previous_entry in previous_manifest.items():
+            previous_filename = previous_entry.get("filename")
+            if not previous_filename:
+                continue
+            if lab_node_id not in manifest:
+                session_sync["removed"].append(previous_filename)
+            if previous_filename in current_filenames:
+                continue
+            previous_location = os.path.join(node_session_dir, previous_filename)
+            if os.path.exists(previous_location):
+                replaced_filenames.add(previous_filename)
+
+        pending_writes = []
+        pending_entries = []
+
+        for lab_node_id, entry in manifest.items():
+            node_session_filename = entry["filename"]
+            node_session_location = os.path.join(
+                node_session_dir, node_session_filename
+            )
+            node_session_data = entry.pop("data")
+            previous_entry = previous_manifest.get(lab_node_id, dict())
+            previous_filename = previous_entry.get("filename")
+
+            if (
+                previous_filename == node_session_filename
+                and previous_entry.get("hash") == entry["hash"]
+                and os.path.exists(node_session_location)
+            ):
+                session_sync["unchanged"] += 1
+                continue
+
+            pending_writes.append((node_session_filename, node_session_data))
+            pending_entries.append((lab_node_id, previous_filename))
+
+        if pending_writes or replaced_filenames or not os.path.isdir(node_session_dir):
+            replaced_filenames.update(filename for filename, _ in pending_writes)
+            replaced_filenames.add(SESSION_MANIFEST_FILENAME)
+
+            staging_dir = stage_lab_session_dir(node_session_dir, replaced_filenames)
+            try:
+                write_results = write_session_files(
+                    [
+                        (os.path.join(staging_dir, filename), node_session_data)
+                        for filename, node_session_data in pending_writes
+                    ],
+                    write_workers,
+                    print_write_progress if verbose and pending_writes else None,
+                )
+
+                for (lab_node_id, previous_filename), (written, error) in zip(
+                    pending_entries, write_results
+                ):
+                    node_session_filename = manifest[lab_node_id]["filename"]
+
+                    if error is not None:
+                        session_sync["failed"].append(
+                            (node_session_filename, str(error))
+                        )
+                        del manifest[lab_node_id]
+                        # The previous version, if any, stays in place
+                        previous_location = os.path.join(
+                            node_session_dir, node_session_filename
+                        )
+                        if os.path.isfile(previous_location):
+                            link_or_copy(
+                                previous_location,
+                                os.path.join(staging_dir, node_session_filename),
+                            )
+                        continue
+
+                    files_written += 1
+                    bytes_written += written
+
+                    if previous_filename is None:
+                        session_sync["added"].append(node_session_filename)
+                    elif previous_filename != node_session_filename:
+                        session_sync["renamed"].append(
+                            (previous_filename, node_session_filename)
+                        )
+                    else:
+                        session_sync["changed"].append(node_session_filename)
+
+                save_session_manifest(staging_dir, manifest)
+                publish_lab_session_dir(node_session_dir)
+            except BaseException:
+                discard_staged_lab_session_dir(node_session_dir)
+                raise
+
+    record_counter("files_written", files_written)
+    record_counter("bytes_written", bytes_written)
+
+    if verbose:
+        print_session_sync(session_sync)
+        print()
+        print(f"Generation of node session files for lab '{lab_title}' complete.")
+        print("=" * 79)
+
+    return session_sync
+
+
+## BULK EXPORT #################################################################
+################################################################################
+
+# With --session-format xml the sessions of every selected lab are written to
+# a single file in the XML format of SecureCRT's Export Settings, instead of
+# one .ini file per session. Tools > Import Settings in SecureCRT merges it
+# into the Sessions tree as 'CML <server> Labs/<lab>/<node>'. The file is
+# 'CML <server> Labs.xml' in the folder that holds Sessions, or in
+# --export-dir.
+
+EXPORT_INDENT = "\t"
+
+# Nesting of a session's values: VanDyke > Sessions > CML Labs > lab > session
+EXPORT_VALUE_DEPTH = 5
+
+# Lines of a session .ini file: S:"Name"=text, D:"Name"=dword, B:"Name"=length
+# and Z:"Name"=count, the last two followed by their data lines
+_session_value_pattern = re.compile(r'^([SDBZ]):"([^"]*)"=(.*)$')
+
+
+def xml_attribute(value):
+    from xml.sax.saxutils import escape
+
+    return escape(value, {'"': "&quot;"})
+
+
+def export_session_template(node_session_template):
+    # Converts an .ini node session template into the XML values of one
+    # session. Placeholders are carried over as they are; their values are
+    # escaped when each session is rendered (see export_labs()).
+    from xml.sax.saxutils import escape
+
+    indent = EXPORT_INDENT * EXPORT_VALUE_DEPTH
+    template_lines = node_session_template.lstrip("\ufeff").splitlines()
+    xml_lines = []
+
+    line_number = 0
+    while line_number < len(template_lines):
+        template_line = template_lines[line_number]
+        line_number += 1
+        if not template_line.strip():
+            continue
+
+        match = _session_value_pattern.match(template_line)
+        if match is None:
+            raise ValueError(
+                f"line {line_number} of the node session template is not a "
+                f"session value: {template_line!r}"
+            )
+        value_type, name, value = match.groups()
+        name = xml_attribute(name)
+
+        if value_type == "S":
+            xml_lines.append(f'{indent}<string name="{name}">{escape(value)}</string>')
+        elif value_type == "D":
+            xml_lines.append(f'{indent}<dword name="{name}">{int(value, 16)}</dword>')
+        elif value_type == "B":
+            # The hex bytes follow on lines of up to 32
+            byte_count = int(value, 16)
+            hex_bytes = []
+            while len(hex_bytes) < byte_count and line_number < len(template_lines):
+                hex_bytes.extend(template_lines[line_number].split())
+                line_number += 1
+            if len(hex_bytes) != byte_count:
+                raise ValueError(f"binary value {name!r} is truncated")
+            xml_lines.append(
+                f'{indent}<binary name="{name}">{"".join(hex_bytes)}</binary>'
+            )
+        else:
+            # One line per string, each indented by a space
+            items = template_lines[line_number : line_number + int(value, 16)]
+            line_number += len(items)
+            if not items:
+                xml_lines.append(f'{indent}<array name="{name}"/>')
+                continue
+            xml_lines.append(f'{indent}<array name="{name}">')
+            for item in items:
+                xml_lines.append(
+                    f"{indent}{EXPORT_INDENT}<string>{escape(item[1:])}</string>"
+                )
+            xml_lines.append(f"{indent}</array>")
+
+    return "\n".join(xml_lines) + "\n"
+
+
+def export_file_path(sessions_cml_labs_dir, export_dir=None):
+    sessions_cml_labs_dir = os.path.abspath(sessions_cml_labs_dir)
+    if export_dir is None:
+        export_dir = os.path.dirname(os.path.dirname(sessions_cml_labs_dir))
+
+    return os.path.join(export_dir, os.path.basename(sessions_cml_labs_dir) + ".xml")
+
+
+def export_labs(
+    sessions_cml_labs_dir,
+    lab_info,
+    labs,
+    invalid_chars,
+    export_file,
+    all_consoles=False,
+):
+    # Writes the sessions of labs (lab_details rows) to export_file and returns
+    # one generate_lab() style result per lab, with the file in
+    # result["export_file"]. Labs are streamed to a temporary file next to
+    # export_file, which replaces it only if its content changed. Labs without
+    # a node list are reported as failed and left out.
+    from xml.sax.saxutils import escape
+
+    lab_tiles = lab_info["lab_tiles"]
+    lab_dirnames = lab_session_dirnames(lab_info, invalid_chars, sessions_cml_labs_dir)
+    node_definitions = lab_info.get("node_definitions")
+
+    results = []
+    for lab in labs:
+        result = dict()
+        result["lab_title"] = lab_tiles[lab[3]]["lab_title"]
+        result["lab_id"] = lab[3]
+        result["session_dir"] = os.path.join(
+            sessions_cml_labs_dir, lab_dirnames[lab[3]]
+        )
+        result["export_file"] = export_file
+        result["session_sync"] = new_session_sync()
+        result["error"] = None
+        result["seconds"] = 0
+        results.append(result)
+
+    temp_file = export_file + ".tmp"
+    export_hash = hashlib.sha256()
+    bytes_written = 0
+    session_names = dict()
+
+    try:
+        compiled_template = load_node_session_template(
+            os.path.join(sessions_cml_labs_dir, "node_session_template"),
+            SESSION_FORMAT_XML,
+        )
+
+        export_dir = os.path.dirname(export_file)
+        if export_dir:
+            os.makedirs(export_dir, exist_ok=True)
+
+        with open(temp_file, "wb") as f:
+
+            def write(export_data):
+                nonlocal bytes_written
+                encoded_data = export_data.encode("utf-8")
+                export_hash.update(encoded_data)
+                bytes_written += f.write(encoded_data)
+
+            with timed_phase("write"):
+                write(
+                    '<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<VanDyke version="3.0">\n'
+                    f'{EXPORT_INDENT}<key name="Sessions">\n'
+                    f'{EXPORT_INDENT * 2}<key name="'
+                    f'{xml_attribute(os.path.basename(sessions_cml_labs_dir))}">\n'
+                )
+
+            for result in results:
+                start_time = time.perf_counter()
+                lab_tile = lab_tiles[result["lab_id"]]
+                if "topology" not in lab_tile:
+                    result["error"] = (
+                        "LookupError: node list not in the offline lab snapshot"
+                    )
+                    continue
+
+                with timed_phase("render"), profiled():
+                    lab_title_command = lab_tile["lab_title"]
+                    lab_dirname = os.path.basename(result["session_dir"])
+                    session_names[result["lab_id"]] = []
+                    export_parts = [
+                        f'{EXPORT_INDENT * 3}<key name="{xml_attribute(lab_dirname)}">\n'
+                    ]
+                    for (
+                        _,
+                        session_name,
+                        lab_node_label_command,
+                        line,
+                    ) in lab_console_sessions(
+                        lab_tile["topology"]["nodes"],
+                        invalid_chars,
+                        node_definitions,
+                        all_consoles,
+                    ):
+                        substitutions = session_substitutions(
+                            lab_title_command, lab_node_label_command, line
+                        )
+                        export_parts.append(
+                            f'{EXPORT_INDENT * 4}<key name="{xml_attribute(session_name)}">\n'
+                        )
+                        export_parts.append(
+                            render_node_session(
+                                compiled_template,
+                                {
+                                    placeholder: escape(value)
+                                    for placeholder, value in substitutions.items()
+                                },
+                            )
+                        )
+                        export_parts.append(f"{EXPORT_INDENT * 4}</key>\n")
+                        session_names[result["lab_id"]].append(session_name)
+                    export_parts.append(f"{EXPORT_INDENT * 3}</key>\n")
+
+                with timed_phase("write"):
+                    write("".join(export_parts))
+
+                result["seconds"] = time.perf_counter() - start_time
+
+            with timed_phase("write"):
+                write(
+                    f"{EXPORT_INDENT * 2}</key>\n"
+                    f"{EXPORT_INDENT}</key>\n"
+                    "</VanDyke>\n"
+                )
+
+        with timed_phase("write"):
+            previous_hash = None
+            if os.path.isfile(export_file):
+                previous_hash = hashlib.sha256()
+                with open(export_file, "rb") as f:
+                    for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+                        previous_hash.update(chunk)
+
+            unchanged = (
+                previous_hash is not None
+                and previous_hash.digest() == export_hash.digest()
+            )
+            if unchanged:
+                os.remove(temp_file)
+            else:
+                os.replace(temp_file, export_file)
+    except Exception as err:
+        with contextlib.suppress(OSError):
+            os.remove(temp_file)
+        for result in results:
+            result["error"] = result["error"] or f"{type(err).__name__}: {err}"
+        return results
+
+    for result in results:
+        exported_sessions = session_names.get(result["lab_id"], [])
+        if unchanged:
+            result["session_sync"]["unchanged"] = len(exported_sessions)
+        else:
+            result["session_sync"]["added"] = exported_sessions
+
+    if not unchanged:
+        record_counter("files_written", 1)
+        record_counter("bytes_written", bytes_written)
+
+    return results
+
+
+## SANITIZE LAB TITLES AND NODE LABELS ########################################
+################################################################################
+
+INVALID_CHARS = ("<", ">", ":", '"', "/", "\\", "|", "?", "*")
+
+# Device names Windows reserves with or without an extension
+WINDOWS_RESERVED_NAMES = frozenset(
+    ["CON", "PRN", "AUX", "NUL"]
+    + [f"COM{number}" for number in range(1, 10)]
+    + [f"LPT{number}" for number in range(1, 10)]
+)
+
+# First three letters of every reserved name, to skip the full check quickly
+_reserved_name_prefixes = frozenset(name[:3] for name in WINDOWS_RESERVED_NAMES)
+
+# str.translate() tables keyed by the invalid characters they replace
+_sanitize_tables = dict()
+
+
+def sanitize_table(invalid_chars):
+    # Maps every invalid character and ASCII control character to "_". A list
+    # indexed by code point is the fastest table str.translate() accepts;
+    # characters past its end are left as they are.
+    invalid_chars = tuple(invalid_chars)
+    table = _sanitize_tables.get(invalid_chars)
+    if table is None:
+        replaced_chars = set(invalid_chars) | set(map(chr, range(32)))
+        table = [chr(code_point) for code_point in range(128)]
+        table += [None] * (max(map(ord, replaced_chars)) + 1 - len(table))
+        for char in replaced_chars:
+            table[ord(char)] = "_"
+        _sanitize_tables[invalid_chars] = table
+
+    return table
+
+
+def sanitize_name(name, invalid_chars):
+    # Replace characters that are not allowed in Windows/macOS file names in a
+    # single pass, then drop what Windows strips or refuses: trailing dots and
+    # spaces and reserved device names such as CON or LPT1
+    name = name.translate(sanitize_table(invalid_chars)).strip().rstrip(". ")
+    if not name:
+        return "_"
+    if (
+        name[:3].upper() in _reserved_name_prefixes
+        and name.split(".", 1)[0].rstrip(" ").upper() in WINDOWS_RESERVED_NAMES
+    ):
+        name = "_" + name
+
+    return name
+
+
+def unique_names(names, invalid_chars, previous_names=None):
+    # names maps a key (lab or node ID) to its title or label. Returns key ->
+    # sanitized name with no two names equal when case is ignored, as on
+    # Windows and macOS file systems. previous_names maps keys to the names
+    # they were given last time. Of the names that sanitize to the same one,
+    # the key that held it last time keeps it, then the name that needed no
+    # changes, then the lowest key. The others keep their previous " (N)"
+    # suffix while it is free, otherwise they get the lowest free one from
+    # " (2)" on, in key order. The result does not depend on the order of
+    # names.
+    previous_names = previous_names or dict()
+    sanitized_names = {
+        key: sanitize_name(name, invalid_chars) for key, name in names.items()
+    }
+
+    claims = dict()
+    for key, sanitized_name in sanitized_names.items():
+        claims.setdefault(sanitized_name.casefold(), []).append(key)
+    taken_names = set(claims)
+
+    def previous_name(key):
+        name = previous_names.get(key)
+        return name.casefold() if isinstance(name, str) else None
+
+    resolved_names = dict()
+    unresolved_keys = []
+    for folded_name in sorted(claims):
+        keys = sorted(
+            claims[folded_name],
+            key=lambda key: (
+                previous_name(key) != folded_name,
+                sanitized_names[key] != names[key],
+                str(key),
+            ),
+        )
+        resolved_names[keys[0]] = sanitized_names[keys[0]]
+        unresolved_keys.extend((folded_name, key) for key in keys[1:])
+
+    # Suffixes held last time are handed out before any new ones
+    suffixed_keys = []
+    for folded_name, key in unresolved_keys:
+        suffix_match = re.fullmatch(
+            re.escape(folded_name) + r" \((\d+)\)", previous_name(key) or ""
+        )
+        if (
+            suffix_match
+            and int(suffix_match.group(1)) >= 2
+            and previous_name(key) not in taken_names
+        ):
+            resolved_names[key] = (
+                f"{sanitized_names[key]} ({int(suffix_match.group(1))})"
+            )
+            taken_names.add(previous_name(key))
+        else:
+            suffixed_keys.append((folded_name, key))
+
+    for folded_name, key in suffixed_keys:
+        number = 2
+        while f"{folded_name} ({number})" in taken_names:
+            number += 1
+        resolved_names[key] = f"{sanitized_names[key]} ({number})"
+        taken_names.add(f"{folded_name} ({number})")
+
+    return resolved_names
+
+
+# Written into every 'CML <server> Labs' folder; maps lab ID -> lab folder
+# name so a lab keeps its folder when another lab's title collides with it
+LAB_FOLDERS_FILENAME = ".lab_folders.json"
+
+
+def lab_session_dirnames(lab_info, invalid_chars, sessions_cml_labs_dir=None):
+    # Lab ID -> lab folder name, resolved across every lab on the controller
+    # so labs with the same title never share a folder. With
+    # sessions_cml_labs_dir the names given there last time are kept (see
+    # unique_names()) and the new ones are recorded.
+    all_lab_dirnames = lab_info.setdefault("lab_dirnames", dict())
+    lab_dirnames = all_lab_dirnames.get(sessions_cml_labs_dir)
+    if lab_dirnames is not None:
+        return lab_dirnames
+
+    lab_folders_file = None
+    previous_lab_dirnames = dict()
+    if sessions_cml_labs_dir is not None:
+        lab_folders_file = os.path.join(sessions_cml_labs_dir, LAB_FOLDERS_FILENAME)
+        previous_lab_dirnames = load_session_manifest(
+            sessions_cml_labs_dir, LAB_FOLDERS_FILENAME
+        )
+
+    lab_dirnames = unique_names(
+        {
+            lab_id: lab_tile["lab_title"]
+            for lab_id, lab_tile in lab_info["lab_tiles"].items()
+        },
+        invalid_chars,
+        previous_lab_dirnames,
+    )
+
+    if lab_folders_file is not None and lab_dirnames != previous_lab_dirnames:
+        try:
+            save_session_manifest(
+                sessions_cml_labs_dir, lab_dirnames, LAB_FOLDERS_FILENAME
+            )
+        except OSError as err:
+            print(f"WARNING: Could not write {lab_folders_file}: {err}")
+
+    all_lab_dirnames[sessions_cml_labs_dir] = lab_dirnames
+
+    return lab_dirnames
+
+
+## BATCH MODE ##################################################################
+################################################################################
+
+
+def filter_labs(labs, title_glob=None, state=None, lab_ids=None):
+    # labs is the lab_details list from get_lab_info(): [NUMBER, LAB, STATE, UUID]
+    # Title globs and states are matched case-insensitively
+    filtered_labs = []
+
+    for lab in labs:
+        lab_title = lab[1]
+        lab_state = lab[2]
+        if lab_ids and lab[3] not in lab_ids:
+            continue
+        if title_glob is not None and not fnmatch.fnmatchcase(
+            lab_title.lower(), title_glob.lower()
+        ):
+            continue
+        if state is not None and lab_state.lower() != state.lower():
+            continue
+        filtered_labs.append(lab)
+
+    return filtered_labs
+
+
+def generate_lab(
+    sessions_cml_labs_dir,
+    lab_tile,
+    invalid_chars,
+    verbose=True,
+    write_workers=SESSION_WRITE_WORKERS,
+    lab_dirname=None,
+    node_definitions=None,
+    all_consoles=False,
+):
+    # Renders a single lab into its 'CML <server> Labs/<lab>' folder, named
+    # lab_dirname if given (see lab_session_dirnames())
+    # Returns a summary of the work done instead of exiting on failure so a
+    # single bad lab does not stop a batch run
+    start_time = time.perf_counter()
+
+    lab_title_command = lab_tile["lab_title"]
+    lab_title = lab_dirname or sanitize_name(lab_title_command, invalid_chars)
+
+    result = dict()
+    result["lab_title"] = lab_title_command
+    result["lab_id"] = lab_tile["id"]
+    result["session_dir"] = os.path.join(sessions_cml_labs_dir, lab_title)
+    result["session_sync"] = new_session_sync()
+    result["error"] = None
+
+    try:
+        if "topology" not in lab_tile:
+            raise LookupError("node list not in the offline lab snapshot")
+        lab_nodes = lab_tile["topology"]["nodes"]
+        node_session_dir = result["session_dir"]
+
+        result["session_sync"] = generate_node_sessions_files(
+            sessions_cml_labs_dir,
+            lab_nodes,
+            invalid_chars,
+            node_session_dir,
+            lab_title_command,
+            lab_title,
+            verbose=verbose,
+            write_workers=write_workers,
+            node_definitions=node_definitions,
+            all_consoles=all_consoles,
+        )
+    except Exception as err:
+        result["error"] = f"{type(err).__name__}: {err}"
+    else:
+        failed = result["session_sync"]["failed"]
+        if failed:
+            result["error"] = (
+                f"{len(failed)} session file(s) not written, "
+                f"first: {failed[0][0]}: {failed[0][1]}"
+            )
+
+    result["seconds"] = time.perf_counter() - start_time
+
+    return result
+
+
+def batch_generate(
+    sessions_cml_labs_dir,
+    lab_info,
+    labs,
+    invalid_chars,
+    workers=8,
+    write_workers=SESSION_WRITE_WORKERS,
+    all_consoles=False,
+    session_format=SESSION_FORMAT_INI,
+    export_dir=None,
+):
+    # Every lab is rendered from the one get_lab_info() response
+    from concurrent.futures import ThreadPoolExecutor
+
+    if session_format == SESSION_FORMAT_XML:
+        return export_labs(
+            sessions_cml_labs_dir,
+            lab_info,
+            labs,
+            invalid_chars,
+            export_file_path(sessions_cml_labs_dir, export_dir),
+            all_consoles,
+        )
+
+    lab_tiles = lab_info["lab_tiles"]
+    lab_dirnames = lab_session_dirnames(lab_info, invalid_chars, sessions_cml_labs_dir)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [
+            executor.submit(
+                generate_lab,
+                sessions_cml_labs_dir,
+                lab_tiles[lab[3]],
+                invalid_chars,
+                False,
+                write_workers,
+                lab_dirnames[lab[3]],
+                lab_info.get("node_definitions"),
+                all_consoles,
+            )
+            for lab in labs
+        ]
+        results = [future.result() for future in futures]
+
+    return results
+
+
+def print_batch_summary(results):
+    summary = []
+    for result in results:
+        session_sync = result["session_sync"]
+        summary.append(
+            [
+                result["lab_title"],
+                sessions_written(session_sync),
+                len(session_sync["removed"]),
+                session_sync["unchanged"],
+                result["seconds"],
+                result["error"] or "",
+            ]
+        )
+
+    print(
+        tabulate(
+            summary,
+            headers=["LAB", "WRITTEN", "REMOVED", "UNCHANGED", "SECONDS", "FAILURE"],
+            floatfmt=".2f",
+        )
+    )
+    print()
+
+    failures = len([result for result in results if result["error"]])
+    total_nodes = sum(sessions_written(result["session_sync"]) for result in results)
+    print(
+        f"{len(results)} lab(s) processed, {total_nodes} node session(s) written, "
+        f"{failures} failure(s)."
+    )
+    for export_file in sorted(
+        set(r["export_file"] for r in results if "export_file" in r)
+    ):
+        print(
+            f"Sessions exported to {export_file}\n"
+            "Import it with Tools > Import Settings in SecureCRT."
+        )
+    print("=" * 79)
+
+
+## LIBRARY API #################################################################
+################################################################################
+
+# For use from other Python code: explicit settings in, structured results
+# out and typed exceptions (SessionGenError and subclasses) instead of prompts
+# or exits. Only cache files that cannot be written print a warning. Example:
+#
+#     paths = session_gen.discover_paths()
+#     lab_info = session_gen.open_controller("cml.example.com", "user", "pass")
+#     for lab in session_gen.list_labs(lab_info): ...
+#     results = session_gen.generate_sessions(lab_info, paths["sessions_dir"])
+#
+# lab_info can be reused for any number of generate_sessions() calls.
+
+
+def discover_paths(os_name=None):
+    # {"securecrt_path": ..., "sessions_dir": ...}; raises ConfigError
+    paths = dict()
+    paths["securecrt_path"] = find_securecrt(os_name)
+    paths["sessions_dir"] = find_sessions_dir(os_name)
+
+    return paths
+
+
+def lab_sessions_dir(sessions_dir, cml_server):
+    # The controller's 'CML <server> Labs' folder in sessions_dir; raises
+    # SetupRequiredError until setup has created its node session template
+    sessions_cml_labs_dir = os.path.join(sessions_dir, cml_labs_dir_name(cml_server))
+    node_session_template_location = os.path.join(
+        sessions_cml_labs_dir, "node_session_template"
+    )
+    if os.path.exists(node_session_template_location) is False:
+        raise SetupRequiredError(f"{node_session_template_location} not found.")
+
+    return sessions_cml_labs_dir
+
+
+def open_controller(
+    controller,
+    username,
+    password,
+    config_yaml=None,
+    offline=False,
+    offline_fallback=False,
+):
+    # Authenticates and fetches the lab list. The token cache, lab snapshots
+    # and node definition catalog are kept next to config_yaml (default:
+    # CONFIG_YAML), which does not need to exist. With offline, or with
+    # offline_fallback when the controller cannot be reached, the lab list
+    # comes from the lab snapshot and lab_info["offline"] is set.
+    # Raises AuthenticationError, ControllerUnreachableError or CMLAPIError.
+    config_yaml = config_yaml or CONFIG_YAML
+
+    if offline:
+        lab_info = offline_lab_info(config_yaml, username, controller)
+        if lab_info is None:
+            raise ControllerUnreachableError(
+                API_ERROR_UNREACHABLE,
+                f"No lab snapshot saved for {username}@{controller} yet.",
+            )
+        validate_return = offline_validate_return(lab_info)
+    else:
+        try:
+            validate_return, lab_info = authenticate_get_lab_info(
+                config_yaml, username, password, controller
+            )
+        except requests.exceptions.RequestException as err:
+            validate_return = api_error(err)
+        except (KeyError, TypeError, ValueError, AttributeError) as err:
+            # Malformed lab list or lab tile
+            validate_return = CMLAPIError(
+                API_ERROR_OTHER,
+                f"Unexpected response from {controller}: "
+                f"{type(err).__name__}: {err}",
+            )
+        if validate_return is None:
+            validate_return = CMLAPIError(
+                API_ERROR_OTHER, "Unexpected response to authentication."
+            )
+
+        if not isinstance(validate_return, dict):
+            lab_info = None
+            if offline_fallback and not auth_failed(validate_return):
+                lab_info = offline_lab_info(config_yaml, username, controller)
+            if lab_info is None:
+                raise validate_return
+            validate_return = offline_validate_return(lab_info)
+
+    lab_info["cml_server"] = controller
+    lab_info["validate_return"] = validate_return
+
+    return lab_info
+
+
+def list_labs(lab_info):
+    # One {"id", "title", "owner", "state"} dict per lab
+    lab_tiles = lab_info["lab_tiles"]
+
+    return [
+        {
+            "id": lab_id,
+            "title": lab_tiles[lab_id]["lab_title"],
+            "owner": lab_owner(lab_tiles[lab_id]),
+            "state": lab_tiles[lab_id]["state"],
+        }
+        for _, _, _, lab_id in lab_info["lab_details"]
+    ]
+
+
+def generate_sessions(
+    lab_info,
+    sessions_dir,
+    lab_ids=None,
+    title=None,
+    state=None,
+    workers=8,
+    write_workers=SESSION_WRITE_WORKERS,
+    all_consoles=False,
+    session_format=SESSION_FORMAT_INI,
+    export_dir=None,
+):
+    # Generates the labs matching lab_ids, title and state (every lab if none
+    # is given) of an open_controller() lab_info into sessions_dir, or with
+    # session_format SESSION_FORMAT_XML into one import file in export_dir
+    # (see export_labs()). Returns one batch_generate() result per lab, with
+    # the paths of the files written in result["written"]; failed labs carry
+    # result["error"].
+    # Raises SetupRequiredError, LabNotFoundError or CMLAPIError.
+    sessions_cml_labs_dir = lab_sessions_dir(sessions_dir, lab_info["cml_server"])
+
+    unknown_lab_ids = [
+        lab_id for lab_id in lab_ids or [] if lab_id not in lab_info["lab_tiles"]
+    ]
+    if unknown_lab_ids:
+        raise LabNotFoundError(f"Unknown lab ID(s): {', '.join(unknown_lab_ids)}")
+
+    selected_labs = filter_labs(lab_info["lab_details"], title, state, lab_ids)
+    if not selected_labs:
+        return []
+
+    validate_return = lab_info["validate_return"]
+    try:
+        get_lab_nodes(
+            validate_return["cml_url"],
+            validate_return["bearer_token"],
+            lab_info,
+            [lab[3] for lab in selected_labs],
+        )
+    except requests.exceptions.RequestException as err:
+        raise api_error(err) from err
+
+    results = batch_generate(
+        sessions_cml_labs_dir,
+        lab_info,
+        selected_labs,
+        INVALID_CHARS,
+        workers,
+        write_workers,
+        all_consoles,
+        session_format,
+        export_dir,
+    )
+    for result in results:
+        session_sync = result["session_sync"]
+        if "export_file" in result:
+            result["written"] = (
+                [result["export_file"]] if sessions_written(session_sync) else []
+            )
+            continue
+        written_filenames = session_sync["added"] + session_sync["changed"]
+        written_filenames += [filename for _, filename in session_sync["renamed"]]
+        result["written"] = [
+            os.path.join(result["session_dir"], filename)
+            for filename in written_filenames
+        ]
+
+    return results
+
+
+## SETUP TEMPLATE CACHE ########################################################
+################################################################################
+
+# Setup has SecureCRT encrypt the CML password into the console server session,
+# which takes a SecureCRT launch and the password typed in by hand. The
+# encrypted fields are cached per user and controller with fingerprints of
+# the password, of cml_console_server and of the node_session_template they
+# went into. When setup runs again, e.g. after an authentication failure
+# removed config.yaml, an unchanged template is kept and a deleted one is
+# rebuilt from cml_console_server and the cached fields. A new password, an
+# edited template or an updated cml_console_server still goes through
+# SecureCRT.
+
+TEMPLATE_CACHE_FILENAME = "template_cache.json"
+
+# Values SecureCRT stores encrypted in a session
+ENCRYPTED_TEMPLATE_FIELDS = (
+    "Password V2",
+    "Monitor Password V2",
+    "SCP Shell Password V2",
+)
+
+# PBKDF2 rounds of the password fingerprint
+CREDENTIAL_HASH_ITERATIONS = 100_000
+
+# Console server command of the node session template written by setup
+NODE_SESSION_COMMAND = (
+    "open /CHANGEME_LAB_TITLE/CHANGEME_NODE_LABEL/CHANGEME_CONSOLE_LINE"
+)
+
+_encrypted_field_pattern = re.compile(
+    '^S:"('
+    + "|".join(re.escape(field) for field in ENCRYPTED_TEMPLATE_FIELDS)
+    + ')"=(.*?)(\r?)$',
+    re.MULTILINE,
+)
+
+
+def template_cache_path(config_yaml):
+    # The template cache lives next to config.yaml
+    config_dir = os.path.dirname(os.path.abspath(config_yaml))
+
+    return os.path.join(config_dir, TEMPLATE_CACHE_FILENAME)
+
+
+def file_sha256(location):
+    # None if the file cannot be read
+    try:
+        with open(location, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def credential_fingerprint(cml_pass, salt):
+    return hashlib.pbkdf2_hmac(
+        "sha256",
+        cml_pass.encode("utf-8"),
+        bytes.fromhex(salt),
+        CREDENTIAL_HASH_ITERATIONS,
+    ).hex()
+
+
+def encrypted_template_fields(node_session_template):
+    # {field: encrypted value} of the encrypted fields that are set
+    return {
+        match.group(1): match.group(2)
+        for match in _encrypted_field_pattern.finditer(node_session_template)
+        if match.group(2)
+    }
+
+
+def save_template_cache(
+    config_yaml,
+    cml_user,
+    cml_pass,
+    cml_server,
+    node_session_template_location,
+    init_console_server_session_file,
+):
+    # Remembers the encrypted fields setup just got from SecureCRT. Nothing is
+    # cached if the password was not saved in the session.
+    import secrets
+
+    try:
+        with open(node_session_template_location, encoding="utf-8", newline="") as f:
+            template_data = f.read()
+    except (OSError, ValueError):
+        return
+    fields = encrypted_template_fields(template_data)
+    if "Password V2" not in fields:
+        return
+
+    template_cache_entry = dict()
+    template_cache_entry["fields"] = fields
+    template_cache_entry["salt"] = secrets.token_hex(16)
+    template_cache_entry["credential"] = credential_fingerprint(
+        cml_pass, template_cache_entry["salt"]
+    )
+    template_cache_entry["source"] = file_sha256(init_console_server_session_file)
+    template_cache_entry["template"] = file_sha256(node_session_template_location)
+    # Line endings SecureCRT saved the template with, so a rebuilt template
+    # renders byte-identical sessions
+    template_cache_entry["newline"] = "\r\n" if "\r\n" in template_data else "\n"
+
+    cache_file = template_cache_path(config_yaml)
+    template_cache = load_json_cache(cache_file)
+    template_cache[f"{cml_user}@{cml_server}"] = template_cache_entry
+    try:
+        save_json_cache(cache_file, template_cache)
+    except OSError as err:
+        print(f"WARNING: Could not write {cache_file}: {err}")
+
+
+def reuse_node_session_template(
+    config_yaml,
+    cml_user,
+    cml_pass,
+    cml_server,
+    sessions_dir,
+    init_console_server_session_file,
+):
+    # Returns True if the controller's node session template is in place
+    # without SecureCRT: either still the one the cached fields were taken
+    # from, or rebuilt from them because it was deleted
+    cache_file = template_cache_path(config_yaml)
+    template_cache = load_json_cache(cache_file)
+    template_cache_entry = template_cache.get(f"{cml_user}@{cml_server}")
+
+    try:
+        if template_cache_entry["credential"] != credential_fingerprint(
+            cml_pass, template_cache_entry["salt"]
+        ):
+            return False
+        if template_cache_entry["source"] != file_sha256(
+            init_console_server_session_file
+        ):
+            return False
+        fields = dict(template_cache_entry["fields"])
+        newline = template_cache_entry.get("newline", os.linesep)
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return False
+
+    sessions_cml_labs_dir = os.path.join(sessions_dir, cml_labs_dir_name(cml_server))
+    node_session_template_location = os.path.join(
+        sessions_cml_labs_dir, "node_session_template"
+    )
+    if os.path.exists(node_session_template_location):
+        return (
+            file_sha256(node_session_template_location)
+            == template_cache_entry["template"]
+        )
+
+    # Same substitutions as setup, with the encrypted fields SecureCRT would
+    # have filled in and the line endings it saved the template with
+    with open(init_console_server_session_file, encoding="utf-8") as f:
+        node_session_data = f.read()
+    node_session_data = node_session_data.replace("CHANGEME_USER", cml_user)
+    node_session_data = node_session_data.replace("CHANGEME_CONTR", cml_server)
+    node_session_data = node_session_data.replace("CHANGEME_CMD", NODE_SESSION_COMMAND)
+    node_session_data = _encrypted_field_pattern.sub(
+        lambda match: (
+            f'S:"{match.group(1)}"='
+            f"{fields.get(match.group(1), match.group(2))}{match.group(3)}"
+        ),
+        node_session_data,
+    )
+
+    os.makedirs(sessions_cml_labs_dir, exist_ok=True)
+    with open(
+        node_session_template_location, "w", encoding="utf-8", newline=newline
+    ) as f:
+        f.write(node_session_data)
+
+    template_cache_entry["template"] = file_sha256(node_session_template_location)
+    try:
+        save_json_cache(cache_file, template_cache)
+    except OSError as err:
+        print(f"WARNING: Could not write {cache_file}: {err}")
+
+    return True
+
+
+## SETUP #######################################################################
+################################################################################
+
+
+def setup(
+    init_console_server_session_file,
+    sessions_dir,
+    CONFIG_YAML,
+    securecrt_path,
+    controller_settings=None,
+):
+    # With controller_settings, one controller of a config.yaml that lists
+    # several is set up and config.yaml itself is left alone. SecureCRT is
+    # only launched if the template cache cannot provide the node session
+    # template (see reuse_node_session_template()).
+    import shutil
+    import subprocess
+
+    search_username = "CHANGEME_USER"
+    search_contr = "CHANGEME_CONTR"
+    search_cml_cmd = "CHANGEME_CMD"
+    replace_cml_contr_cmd = "quit"
 
     console_session_template_filename = init_console_server_session_file + ".ini"
     console_session_template_location = os.path.join(
         sessions_dir, console_session_template_filename
     )
 
-    node_session_template_filename = "node_session_template"
-    node_session_template_location = os.path.join(
-        sessions_dir, node_session_template_filename
+    node_session_template_filename = "node_session_template"
+    node_session_template_location = os.path.join(
+        sessions_dir, node_session_template_filename
+    )
+    while True:
+        os.system(clear_screen)
+        if controller_settings is None:
+            config_settings = get_config_settings()
+        else:
+            config_settings = controller_settings
+        os.system(clear_screen)
+        start_api_budget()
+        validate_return = ""
+        print(
+            f"VALIDATING ACCOUNT {config_settings['cml_user']} AGAINST {config_settings['cml_server']}\n"
+        )
+
+        validate_return = validate_settings_get_token(
+            config_settings["cml_user"],
+            config_settings["cml_pass"],
+            config_settings["cml_server"],
+        )
+        # The error handling here could be better, but it works well enough for now.
+        # Will readdress later.
+        if validate_return:
+            message1 = (
+                f"Try entering configuration settings again.\n"
+                f"Press ENTER to continue..."
+            )
+            if (
+                isinstance(validate_return, dict)
+                and "200" in validate_return["status_code"]
+            ):
+                print("AUTHENTICATION SUCCEEDED\n")
+                bearer_token = validate_return["bearer_token"]
+                base_url = validate_return["cml_url"]
+                cache_token(
+                    CONFIG_YAML,
+                    config_settings["cml_user"],
+                    config_settings["cml_server"],
+                    validate_return,
+                )
+                break
+            elif auth_failed(validate_return):
+                print("AUTHENTICATION FAILED\n")
+                input(message1)
+            elif validate_return.kind == API_ERROR_TIMEOUT:
+                print(
+                    f"ERROR:   COULD NOT CONTACT {config_settings['cml_server']} \nREASON:  TIMEOUT\n"
+                )
+                input(message1)
+            elif validate_return.kind == API_ERROR_BAD_HOST:
+                print(
+                    f"ERROR:   BAD HOSTNAME OR ADDRESS: {config_settings['cml_server']}\n"
+                )
+                input(message1)
+            elif validate_return.kind == API_ERROR_UNREACHABLE:
+                print(
+                    f"ERROR:   Could not reach CML server at {config_settings['cml_server']}. \nREASON:  NO NETWORK CONNECTIVITY\n"
+                )
+                input(message1)
+            else:
+                print("Something went wrong\n")
+                print(validate_return)
+                input(message1)
+        else:
+            print("Something went wrong2\n")
+            print(validate_return)
+            input(message1)
+
+        if controller_settings is not None:
+            # The settings come from config.yaml and cannot be re-entered here
+            print(
+                f"Correct the settings of {config_settings['cml_server']} in {CONFIG_YAML}."
+            )
+            sys.exit(1)
+
+    def create_config_yaml():
+        search_cml_username = "CHANGEME_USER"
+        search_cml_password = "CHANGEME_PASS"
+        search_cml_name_or_ip = "CHANGEME_CML"
+
+        with open(r"initial_config", "r") as f:
+            data = f.read()
+            data = data.replace(search_cml_username, config_settings["cml_user"])
+            data = data.replace(search_cml_password, config_settings["cml_pass"])
+            data = data.replace(search_cml_name_or_ip, config_settings["cml_server"])
+
+        with open(CONFIG_YAML, "w") as f:
+            f.write(data)
+
+    def create_console_server_session_file(cml_user, cml_server):
+        # Creating cml_console_server session file
+        console_session_template_file = shutil.copyfile(
+            init_console_server_session_file, console_session_template_location
+        )
+
+        # Replacing placeholder USERNAME and HOSTNAME values with those found in config.yaml
+        with open(console_session_template_file, "r") as f:
+            console_session_data = f.read()
+            console_session_data = console_session_data.replace(
+                search_username, cml_user
+            )
+            console_session_data = console_session_data.replace(
+                search_contr, cml_server
+            )
+            console_session_data = console_session_data.replace(
+                search_cml_cmd, replace_cml_contr_cmd
+            )
+
+        with open(console_session_template_file, "w") as f:
+            f.write(console_session_data)
+
+        def get_encrypted_seccrt_creds():
+            seccrt = securecrt_path
+            print(
+                "The script will attempt to use SecureCRT to connect to the\n"
+                "CML console server via SSH using the provided credentials.\n\n"
+            )
+            print(
+                "You will need to enter your CML password and leave the\n"
+                "SAVE PASSWORD checkbox checked.\n\n"
+            )
+            print(
+                "This will create a template file with your encrypted credentials\n"
+                "which will be used to generate session files for use with SecureCRT.\n\n"
+            )
+            print(
+                "Close SecureCRT once the 'cml_console_server' session disconnects\n\n"
+            )
+            input("Press ENTER to continue setup...\n")
+            print("Launching SecureCRT with cml_console_server session")
+
+            # Command to launch an SSH session in a tab in SecureCRT
+            if OS == "win32":
+                cmd = [seccrt, "/T", "/S", "cml_console_server"]
+            elif OS == "darwin":
+                cmd = [
+                    "/Applications/SecureCRT.app/Contents/MacOS/SecureCRT",
+                    "/T",
+                    "/S",
+                    "cml_console_server",
+                ]
+
+            # Executing SecureCRT
+            try:
+                subprocess.run(cmd, check=True)
+            except FileNotFoundError as exc:
+                print(
+                    f"Process failed because the executable could not be found.\n{exc}"
+                )
+                print("\nExiting")
+                sys.exit(1)
+            except subprocess.CalledProcessError as exc:
+                print(
+                    f"Process failed because did not return a successful return code. "
+                    f"Returned {exc.returncode}\n{exc}"
+                )
+                print("\nExiting")
+                sys.exit(1)
+            except subprocess.TimeoutExpired as exc:
+                print(f"Process timed out.\n{exc}")
+                print("\nExiting")
+                sys.exit(1)
+
+            os.system(clear_screen)
+
+            print()
+            print("Console server session template file created")
+            print("=" * 79)
+
+        get_encrypted_seccrt_creds()
+
+    def create_cml_sessions_dir():
+        cml_server_dir = cml_labs_dir_name(cml_server)
+        sessions_cml_labs_dir = os.path.join(sessions_dir, cml_server_dir)
+
+        try:
+            os.makedirs(sessions_cml_labs_dir, exist_ok=True)
+            print(f"Directory '{cml_server_dir}' created successfully")
+            print("=" * 79)
+            return sessions_cml_labs_dir
+        except OSError as error:
+            input(
+                f"Directory '{cml_server_dir}' could not be created.\nPress ENTER to exit..."
+            )
+            sys.exit(1)
+
+    def create_node_session_template_file():
+        console_session_template_file = console_session_template_location
+        replace_cml_node_cmd = NODE_SESSION_COMMAND
+
+        sessions_cml_labs_dir = create_cml_sessions_dir()
+        node_session_template_location = os.path.join(
+            sessions_cml_labs_dir, node_session_template_filename
+        )
+
+        # Creating node session template file
+        node_session_template_file = shutil.copyfile(
+            console_session_template_file, node_session_template_location
+        )
+
+        # Replacing placeholder USERNAME and HOStNAME values with those found in config.yaml
+        search_cml_contr_cmd = replace_cml_contr_cmd
+
+        with open(node_session_template_file, "r") as f:
+            node_session_data = f.read()
+            node_session_data = node_session_data.replace(
+                search_cml_contr_cmd, replace_cml_node_cmd
+            )
+
+        with open(node_session_template_file, "w") as f:
+            f.write(node_session_data)
+
+    def housekeeping():
+        # Deleting cml_console_server.ini template file
+        if os.path.exists(console_session_template_location):
+            print(f"Deleting {console_session_template_location}")
+            os.remove(console_session_template_location)
+            os.system(clear_screen)
+        else:
+            input(
+                f"{console_session_template_location} does not exist\nPress ENTER to exit..."
+            )
+            sys.exit(1)
+
+    if controller_settings is None:
+        create_config_yaml()
+        cml_configs = set_config_variables()
+    else:
+        cml_configs = controller_settings
+
+    if cml_configs is not None:
+        cml_user = cml_configs["cml_user"]
+        cml_server = cml_configs["cml_server"]
+    else:
+        input("Press ENTER to exit...")
+        sys.exit(1)
+
+    if reuse_node_session_template(
+        CONFIG_YAML,
+        cml_user,
+        cml_configs["cml_pass"],
+        cml_server,
+        sessions_dir,
+        init_console_server_session_file,
+    ):
+        print(
+            "Using the encrypted credentials of an earlier setup.\n"
+            "SecureCRT does not need to be launched."
+        )
+        print("=" * 79)
+        return
+
+    # Leaves the authentication result on screen for a moment before
+    # SecureCRT is prepared
+    time.sleep(3)
+    os.system(clear_screen)
+
+    print(
+        "Ensure that SecureCRT is not running before continuing.\n"
+        "Setup cannot properly complete if SecureCRT is running\n\n"
+    )
+
+    input("Press ENTER to continue setup...")
+    os.system(clear_screen)
+
+    create_console_server_session_file(cml_user, cml_server)
+
+    create_node_session_template_file()
+
+    housekeeping()
+
+    save_template_cache(
+        CONFIG_YAML,
+        cml_user,
+        cml_configs["cml_pass"],
+        cml_server,
+        os.path.join(
+            sessions_dir, cml_labs_dir_name(cml_server), node_session_template_filename
+        ),
+        init_console_server_session_file,
+    )
+
+
+## HEADLESS MODE ###############################################################
+################################################################################
+
+# Exit status codes used in headless mode
+EXIT_OK = 0
+EXIT_FAILURE = 1
+EXIT_USAGE = 2
+EXIT_CONFIG = 3
+EXIT_AUTH = 4
+EXIT_UNREACHABLE = 5
+EXIT_NO_LABS = 6
+
+
+def headless_settings(args):
+    # Command line flags take precedence over environment variables, which
+    # take precedence over config.yaml. A controller listed in config.yaml
+    # gets the credentials of its own entry; any other controller those of
+    # the first entry.
+    cml_configs = dict()
+    cml_configs["cml_user"] = args.username or os.environ.get("CML_USERNAME")
+    cml_configs["cml_pass"] = args.password or os.environ.get("CML_PASSWORD")
+    cml_configs["cml_server"] = args.controller or os.environ.get("CML_CONTROLLER")
+
+    if not all(cml_configs.values()) and config_yaml_check(CONFIG_YAML):
+        controllers = config_controllers()
+        if controllers is not None:
+            config_yaml_settings = controllers[0]
+            for controller_settings in controllers:
+                if (
+                    cml_configs["cml_server"]
+                    and controller_settings["cml_server"].lower()
+                    == cml_configs["cml_server"].lower()
+                ):
+                    config_yaml_settings = controller_settings
+                    break
+            for key, value in config_yaml_settings.items():
+                cml_configs[key] = cml_configs[key] or value
+
+    # The password is not needed to read the offline lab snapshot
+    required_keys = ["cml_user", "cml_server"]
+    if not args.offline:
+        required_keys.append("cml_pass")
+    if not all(cml_configs[key] for key in required_keys):
+        return None
+
+    return cml_configs
+
+
+def auth_failed(validate_return):
+    # Only a rejected username or password, never a transient error
+    return (
+        isinstance(validate_return, CMLAPIError)
+        and validate_return.kind == API_ERROR_AUTH
+    )
+
+
+def headless_sessions_dir(args):
+    # --output-root, CML_SESSIONS_DIR or SecureCRT's own Sessions directory;
+    # None if it does not exist
+    sessions_dir = args.output_root or os.environ.get("CML_SESSIONS_DIR")
+    if not sessions_dir:
+        seccrt_key = securecrt_config_dir()
+        if seccrt_key is not None:
+            sessions_dir = os.path.join(seccrt_key, "Sessions")
+    if not sessions_dir or os.path.exists(sessions_dir) is False:
+        print(f"ERROR:   SecureCRT sessions directory not found: {sessions_dir}")
+        return None
+
+    return sessions_dir
+
+
+def controller_context(cml_configs, sessions_dir):
+    # Returns (exit status code, settings) like headless_context(), for a
+    # controller whose settings are already known
+    try:
+        sessions_cml_labs_dir = lab_sessions_dir(
+            sessions_dir, cml_configs["cml_server"]
+        )
+    except SetupRequiredError as err:
+        print(f"ERROR:   {err} Run setup interactively first.")
+        return EXIT_CONFIG, None
+
+    cml_configs = dict(cml_configs)
+    cml_configs["sessions_cml_labs_dir"] = sessions_cml_labs_dir
+
+    return EXIT_OK, cml_configs
+
+
+def headless_context(args):
+    # Returns (exit status code, settings); settings is None unless the status
+    # is EXIT_OK
+    cml_configs = headless_settings(args)
+    if cml_configs is None:
+        print(
+            "ERROR:   CML controller, username and password are required "
+            "(flags, CML_* environment variables or config.yaml)."
+        )
+        return EXIT_CONFIG, None
+
+    sessions_dir = headless_sessions_dir(args)
+    if sessions_dir is None:
+        return EXIT_CONFIG, None
+
+    return controller_context(cml_configs, sessions_dir)
+
+
+def headless_controllers(args):
+    # The controller given by --controller or CML_CONTROLLER, otherwise every
+    # controller in config.yaml. With several controllers only --username and
+    # --password override config.yaml; CML_USERNAME and CML_PASSWORD are
+    # left to single-controller runs so one exported variable does not
+    # replace every controller's credentials.
+    if (
+        args.controller
+        or os.environ.get("CML_CONTROLLER")
+        or not config_yaml_check(CONFIG_YAML)
+    ):
+        cml_configs = headless_settings(args)
+        if cml_configs is None:
+            return None
+        return [cml_configs]
+
+    controllers = config_controllers()
+    if controllers is None:
+        return None
+
+    if len(controllers) == 1:
+        cml_configs = headless_settings(args)
+        if cml_configs is None:
+            return None
+        return [cml_configs]
+
+    cml_user = args.username
+    cml_pass = args.password
+    for cml_configs in controllers:
+        cml_configs["cml_user"] = cml_user or cml_configs["cml_user"]
+        cml_configs["cml_pass"] = cml_pass or cml_configs["cml_pass"]
+
+    return controllers
+
+
+def headless_authenticate_get_lab_info(
+    cml_configs, offline=False, offline_fallback=True
+):
+    # Returns (exit status code, validate_return, lab_info). With offline, or
+    # with offline_fallback when the controller is unreachable, lab_info comes
+    # from the lab snapshot.
+    cml_user = cml_configs["cml_user"]
+    cml_server = cml_configs["cml_server"]
+
+    try:
+        lab_info = open_controller(
+            cml_server,
+            cml_user,
+            cml_configs["cml_pass"],
+            CONFIG_YAML,
+            offline,
+            offline_fallback,
+        )
+    except AuthenticationError:
+        print(f"ERROR:   AUTHENTICATION FAILED for {cml_user} on {cml_server}")
+        return EXIT_AUTH, None, None
+    except CMLAPIError as err:
+        if offline:
+            print(f"ERROR:   {err}")
+        else:
+            print(f"ERROR:   COULD NOT CONTACT {cml_server}: {err}")
+        return EXIT_UNREACHABLE, None, None
+
+    if offline:
+        print_offline_notice(lab_info, "--offline given")
+    elif lab_info.get("offline"):
+        print_offline_notice(lab_info, f"Could not contact {cml_server}")
+
+    return EXIT_OK, lab_info["validate_return"], lab_info
+
+
+def run_headless(args):
+    # Never prompts, sleeps or clears the screen; returns an exit status code
+    controllers = headless_controllers(args)
+    if controllers is None:
+        print(
+            "ERROR:   CML controller, username and password are required "
+            "(flags, CML_* environment variables or config.yaml)."
+        )
+        return EXIT_CONFIG
+
+    sessions_dir = headless_sessions_dir(args)
+    if sessions_dir is None:
+        return EXIT_CONFIG
+
+    if len(controllers) > 1:
+        return run_controllers(args, controllers, sessions_dir)
+
+    return run_controller(args, controllers[0], sessions_dir)
+
+
+def run_controller(args, cml_configs, sessions_dir):
+    # Generates the selected labs of one controller; returns an exit status code
+    exit_status, cml_configs = controller_context(cml_configs, sessions_dir)
+    if exit_status != EXIT_OK:
+        return exit_status
+
+    cml_server = cml_configs["cml_server"]
+
+    exit_status, validate_return, lab_info = headless_authenticate_get_lab_info(
+        cml_configs, args.offline
     )
+    if exit_status != EXIT_OK:
+        return exit_status
+
+    try:
+        results = generate_sessions(
+            lab_info,
+            sessions_dir,
+            args.lab_id,
+            args.title,
+            args.state,
+            args.workers,
+            args.write_workers,
+            args.all_consoles,
+            args.session_format,
+            args.export_dir,
+        )
+    except LabNotFoundError as err:
+        print(f"ERROR:   {err}")
+        return EXIT_NO_LABS
+    except AuthenticationError as err:
+        print(f"ERROR:   Could not get nodes from {cml_server}: {err}")
+        return EXIT_AUTH
+    except CMLAPIError as err:
+        print(f"ERROR:   Could not get nodes from {cml_server}: {err}")
+        return EXIT_UNREACHABLE
+
+    if not results:
+        print("No labs matched.")
+        return EXIT_NO_LABS
+
+    print_batch_summary(results)
+
+    if any(result["error"] for result in results):
+        return EXIT_FAILURE
+
+    return EXIT_OK
+
+
+## MULTIPLE CONTROLLERS ########################################################
+################################################################################
+
+# Controllers authenticated and generated at the same time
+CONTROLLER_WORKERS = 8
+
+EXIT_STATUS_NAMES = {
+    EXIT_OK: "OK",
+    EXIT_FAILURE: "LAB FAILED",
+    EXIT_CONFIG: "NOT SET UP",
+    EXIT_AUTH: "AUTHENTICATION FAILED",
+    EXIT_UNREACHABLE: "UNREACHABLE",
+    EXIT_NO_LABS: "NO LABS MATCHED",
+}
+
+
+def controller_selector(controllers):
+    # Asks which controller to use when config.yaml lists more than one
+    if len(controllers) == 1:
+        return controllers[0]
+
+    controller_rows = [
+        [number, cml_configs["cml_server"], cml_configs["cml_user"]]
+        for number, cml_configs in enumerate(controllers, start=1)
+    ]
+    print(tabulate(controller_rows, headers=["NUMBER", "CONTROLLER", "USER"]))
+    print("\n['--batch' generates every controller's labs at once. 'q' to quit.]")
+
     while True:
-        os.system(clear_screen)
-        config_settings = get_config_settings()
-        os.system(clear_screen)
-        validate_return = ""
+        selection = input("Enter controller NUMBER: ").strip()
+        print()
+
+        if selection.lower() == "q":
+            print("Exiting")
+            sys.exit(1)
+        elif selection.isdigit() and 1 <= int(selection) <= len(controllers):
+            return controllers[int(selection) - 1]
+        elif selection:
+            print(f"'{selection}' is not a controller NUMBER.")
+
+
+class ThreadOutput:
+    # Stands in for sys.stdout while controllers are processed in parallel.
+    # What a worker thread prints is collected separately and printed as one
+    # block when its controller is done, so their output never interleaves.
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffers = dict()
+
+    def write(self, text):
+        buffer = self.buffers.get(threading.get_ident())
+        if buffer is None:
+            return self.stream.write(text)
+        buffer.append(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_captured(thread_output, function, *args):
+    # Returns (function's exit status code, everything it printed)
+    thread_id = threading.get_ident()
+    thread_output.buffers[thread_id] = []
+    try:
+        exit_status = function(*args)
+    except Exception as err:
+        print(f"ERROR:   {err}")
+        exit_status = EXIT_FAILURE
+    finally:
+        printed = "".join(thread_output.buffers.pop(thread_id))
+
+    return exit_status, printed
+
+
+def run_controllers(args, controllers, sessions_dir):
+    # Runs run_controller() for every controller in parallel. A slow or
+    # unreachable controller only holds up its own output; every other
+    # controller's block is printed as soon as it finishes. Returns EXIT_OK or
+    # the exit status of the first controller, in config.yaml order, that
+    # did not succeed.
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    workers = min(CONTROLLER_WORKERS, len(controllers))
+    if args.profile:
+        # cProfile only records the thread it was enabled in
+        workers = 1
+
+    print(f"Generating sessions for {len(controllers)} controller(s)\n")
+
+    thread_output = ThreadOutput(sys.stdout)
+    sys.stdout = thread_output
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    run_captured,
+                    thread_output,
+                    run_controller,
+                    args,
+                    cml_configs,
+                    sessions_dir,
+                ): cml_configs
+                for cml_configs in controllers
+            }
+            exit_statuses = dict()
+            for future in as_completed(futures):
+                cml_configs = futures[future]
+                exit_status, printed = future.result()
+                exit_statuses[id(cml_configs)] = exit_status
+                print(f"{cml_configs['cml_user']}@{cml_configs['cml_server']}")
+                print("-" * 79)
+                print(printed)
+    finally:
+        sys.stdout = thread_output.stream
+
+    summary = []
+    for cml_configs in controllers:
+        exit_status = exit_statuses[id(cml_configs)]
+        summary.append(
+            [
+                cml_configs["cml_server"],
+                cml_configs["cml_user"],
+                EXIT_STATUS_NAMES.get(exit_status, exit_status),
+            ]
+        )
+    print(tabulate(summary, headers=["CONTROLLER", "USER", "RESULT"]))
+    print("=" * 79)
+
+    for cml_configs in controllers:
+        if exit_statuses[id(cml_configs)] != EXIT_OK:
+            return exit_statuses[id(cml_configs)]
+
+    return EXIT_OK
+
+
+## ROSTER MODE #################################################################
+################################################################################
+
+# On a shared jump host one run can generate the sessions of every user: the
+# lab list and node lists are fetched once with the service account (flags,
+# CML_* environment variables or config.yaml) and each user's Sessions folder
+# is rendered in a process of its own. Every user must have run setup once;
+# their node_session_template, which holds their own encrypted SecureCRT
+# settings, is only read. Roster file:
+#
+#     users:
+#       - name: alice
+#         sessions_dir: C:\Users\alice\AppData\Roaming\VanDyke\Config\Sessions
+#         owner: alice      # optional: only labs owned by this CML user
+#       - name: bob
+#         sessions_dir: C:\Users\bob\AppData\Roaming\VanDyke\Config\Sessions
+
+# Users rendered at the same time
+ROSTER_PROCESSES = os.cpu_count() or 1
+
+# lab_info of the roster run; handed to each worker process once
+_roster_lab_info = None
+
+
+def load_roster(roster_file):
+    # One {"name", "sessions_dir", "owner"} dict per user; raises ConfigError
+    import yaml
+
+    try:
+        with open(roster_file) as f:
+            data = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+        roster = []
+        for roster_entry in data["users"]:
+            roster_user = dict()
+            roster_user["name"] = str(roster_entry["name"])
+            roster_user["sessions_dir"] = os.path.expanduser(
+                os.path.expandvars(roster_entry["sessions_dir"])
+            )
+            roster_user["owner"] = roster_entry.get("owner")
+            roster.append(roster_user)
+    except OSError as err:
+        raise ConfigError(f"Could not read {roster_file}: {err}") from err
+    except (yaml.YAMLError, KeyError, TypeError, AttributeError) as err:
+        raise ConfigError(f"Invalid or missing fields in {roster_file}.") from err
+
+    if not roster:
+        raise ConfigError(f"No users in {roster_file}.")
+
+    # Two users rendering into the same folder would stage the same labs
+    sessions_dirs = [
+        os.path.normcase(os.path.abspath(roster_user["sessions_dir"]))
+        for roster_user in roster
+    ]
+    if len(set(sessions_dirs)) != len(sessions_dirs):
+        raise ConfigError(f"{roster_file} lists a sessions_dir more than once.")
+
+    return roster
+
+
+def roster_lab_ids(lab_info, labs, owner):
+    # IDs of labs (lab_details rows) owned by the CML user owner, or of all
+    # of them if owner is None
+    lab_tiles = lab_info["lab_tiles"]
+
+    return [
+        lab[3]
+        for lab in labs
+        if owner is None or lab_owner(lab_tiles[lab[3]]).lower() == owner.lower()
+    ]
+
+
+def init_roster_worker(lab_info):
+    global _roster_lab_info
+    _roster_lab_info = lab_info
+
+
+def generate_roster_user(roster_user, lab_ids, options):
+    # Returns (generate_sessions() results, error); runs in a worker process
+    try:
+        results = generate_sessions(
+            _roster_lab_info, roster_user["sessions_dir"], lab_ids, **options
+        )
+    except SetupRequiredError as err:
+        return [], f"{err} Run setup as {roster_user['name']} first."
+    except Exception as err:
+        return [], f"{type(err).__name__}: {err}"
+
+    return results, None
+
+
+def run_roster(args):
+    # Generates the selected labs for every user in the --roster file; returns
+    # an exit status code
+    try:
+        roster = load_roster(args.roster)
+    except ConfigError as err:
+        print(f"ERROR:   {err}")
+        return EXIT_CONFIG
+
+    cml_configs = headless_settings(args)
+    if cml_configs is None:
+        print(
+            "ERROR:   CML controller, username and password of the service "
+            "account are required (flags, CML_* environment variables or "
+            "config.yaml)."
+        )
+        return EXIT_CONFIG
+    cml_server = cml_configs["cml_server"]
+
+    start_time = time.perf_counter()
+
+    exit_status, validate_return, lab_info = headless_authenticate_get_lab_info(
+        cml_configs, args.offline
+    )
+    if exit_status != EXIT_OK:
+        return exit_status
+
+    unknown_lab_ids = [
+        lab_id for lab_id in args.lab_id or [] if lab_id not in lab_info["lab_tiles"]
+    ]
+    if unknown_lab_ids:
+        print(f"ERROR:   Unknown lab ID(s): {', '.join(unknown_lab_ids)}")
+        return EXIT_NO_LABS
+
+    selected_labs = filter_labs(
+        lab_info["lab_details"], args.title, args.state, args.lab_id
+    )
+    user_lab_ids = {
+        roster_user["name"]: roster_lab_ids(
+            lab_info, selected_labs, roster_user["owner"]
+        )
+        for roster_user in roster
+    }
+    pending_users = [
+        roster_user for roster_user in roster if user_lab_ids[roster_user["name"]]
+    ]
+    if not pending_users:
+        print("No labs matched.")
+        return EXIT_NO_LABS
+
+    # Every node list any user needs is fetched here, once; the workers only
+    # render and write
+    try:
+        get_lab_nodes(
+            validate_return["cml_url"],
+            validate_return["bearer_token"],
+            lab_info,
+            list(dict.fromkeys(sum(user_lab_ids.values(), []))),
+        )
+    except requests.exceptions.RequestException as err:
+        print(f"ERROR:   Could not get nodes from {cml_server}: {api_error(err)}")
+        return EXIT_UNREACHABLE
+
+    fetch_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+
+    options = dict()
+    options["workers"] = args.workers
+    options["write_workers"] = args.write_workers
+    options["all_consoles"] = args.all_consoles
+    options["session_format"] = args.session_format
+
+    processes = min(ROSTER_PROCESSES, len(pending_users))
+    if args.profile:
+        # cProfile only records the process it was enabled in
+        processes = 1
+
+    print(
+        f"Generating sessions for {len(pending_users)} user(s) "
+        f"in {processes} process(es)\n"
+    )
+
+    if processes == 1:
+        init_roster_worker(lab_info)
+        outcomes = [
+            generate_roster_user(
+                roster_user, user_lab_ids[roster_user["name"]], options
+            )
+            for roster_user in pending_users
+        ]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=init_roster_worker,
+            initargs=(lab_info,),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    generate_roster_user,
+                    roster_user,
+                    user_lab_ids[roster_user["name"]],
+                    options,
+                )
+                for roster_user in pending_users
+            ]
+            outcomes = [future.result() for future in futures]
+
+    render_seconds = time.perf_counter() - start_time
+
+    user_outcomes = {
+        roster_user["name"]: outcome
+        for roster_user, outcome in zip(pending_users, outcomes)
+    }
+    summary = []
+    failures = 0
+    for roster_user in roster:
+        results, error = user_outcomes.get(roster_user["name"], ([], None))
+        if error is None:
+            lab_errors = [result["error"] for result in results if result["error"]]
+            if lab_errors:
+                error = f"{len(lab_errors)} lab(s) failed, first: {lab_errors[0]}"
+        if error:
+            failures += 1
+        summary.append(
+            [
+                roster_user["name"],
+                len(user_lab_ids[roster_user["name"]]),
+                sum(sessions_written(result["session_sync"]) for result in results),
+                sum(len(result["session_sync"]["removed"]) for result in results),
+                sum(result["session_sync"]["unchanged"] for result in results),
+                error or "",
+            ]
+        )
+
+    print(
+        tabulate(
+            summary,
+            headers=["USER", "LABS", "WRITTEN", "REMOVED", "UNCHANGED", "FAILURE"],
+        )
+    )
+    print()
+    print(
+        f"{len(roster)} user(s), {failures} failure(s). Lab list and nodes "
+        f"fetched in {fetch_seconds:.2f} s, sessions generated in "
+        f"{render_seconds:.2f} s."
+    )
+    print("=" * 79)
+
+    if failures:
+        return EXIT_FAILURE
+
+    return EXIT_OK
+
+
+## WATCH MODE ##################################################################
+################################################################################
+
+
+def lab_fingerprint(lab_tile):
+    # Changes whenever the lab is renamed or a node is added, removed, renamed
+    # or changes node definition
+    lab_nodes = sorted(
+        (str(node_key(lab_node)), lab_node["label"], lab_node["node_definition"])
+        for lab_node in lab_tile["topology"]["nodes"]
+    )
+    fingerprint_data = json.dumps([lab_tile["lab_title"], lab_nodes])
+
+    return hashlib.sha256(fingerprint_data.encode("utf-8")).hexdigest()
+
+
+def run_watch(args):
+    # Polls the controller every --interval seconds over the same keep-alive
+    # connection and regenerates only the labs whose node lists changed.
+    # Lab listings and node lists are fetched with conditional requests, and a
+    # lab's nodes are only re-fetched when its 'modified' timestamp moves.
+    exit_status, cml_configs = headless_context(args)
+    if exit_status != EXIT_OK:
+        return exit_status
+
+    cml_server = cml_configs["cml_server"]
+    sessions_cml_labs_dir = cml_configs["sessions_cml_labs_dir"]
+
+    # Lab ID -> {"modified": ..., "fingerprint": ..., "topology": ...}
+    watched_labs = dict()
+
+    print(f"Watching {cml_server} every {args.interval} seconds. Press CTRL+C to stop.")
+
+    try:
+        while True:
+            start_api_budget(args.api_budget)
+            # Sessions are only ever regenerated from live data
+            exit_status, validate_return, lab_info = headless_authenticate_get_lab_info(
+                cml_configs, offline_fallback=False
+            )
+            if exit_status == EXIT_AUTH:
+                return exit_status
+
+            if exit_status == EXIT_OK:
+                try:
+                    watch_poll(
+                        validate_return,
+                        lab_info,
+                        sessions_cml_labs_dir,
+                        watched_labs,
+                        args,
+                    )
+                except requests.exceptions.RequestException as err:
+                    print(f"WARNING: Polling {cml_server} failed: {err}")
+
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+
+    return EXIT_OK
+
+
+def watch_poll(validate_return, lab_info, sessions_cml_labs_dir, watched_labs, args):
+    base_url = validate_return["cml_url"]
+    token = validate_return["bearer_token"]
+    lab_tiles = lab_info["lab_tiles"]
+
+    selected_labs = filter_labs(
+        lab_info["lab_details"], args.title, args.state, args.lab_id
+    )
+    selected_lab_ids = [lab[3] for lab in selected_labs]
+
+    # Reuse the node lists of labs whose modification timestamp did not move
+    for lab_id in selected_lab_ids:
+        watched_lab = watched_labs.get(lab_id)
+        modified = lab_tiles[lab_id].get("modified")
+        if (
+            watched_lab is not None
+            and modified is not None
+            and modified == watched_lab["modified"]
+            and "topology" not in lab_tiles[lab_id]
+        ):
+            lab_tiles[lab_id]["topology"] = watched_lab["topology"]
+
+    get_lab_nodes(base_url, token, lab_info, selected_lab_ids)
+
+    changed_labs = []
+    for lab in selected_labs:
+        lab_tile = lab_tiles[lab[3]]
+        fingerprint = lab_fingerprint(lab_tile)
+        watched_lab = watched_labs.get(lab[3])
+        if watched_lab is None or watched_lab["fingerprint"] != fingerprint:
+            changed_labs.append(lab)
+        watched_labs[lab[3]] = {
+            "modified": lab_tile.get("modified"),
+            "fingerprint": fingerprint,
+            "topology": lab_tile["topology"],
+        }
+
+    # Labs deleted on the controller are no longer watched
+    for lab_id in list(watched_labs):
+        if lab_id not in lab_tiles:
+            del watched_labs[lab_id]
+
+    if not changed_labs:
+        return
+
+    print(f"\n{time.strftime('%Y-%m-%d %H:%M:%S')} {len(changed_labs)} lab(s) changed")
+    results = batch_generate(
+        sessions_cml_labs_dir,
+        lab_info,
+        changed_labs,
+        INVALID_CHARS,
+        args.workers,
+        args.write_workers,
+        args.all_consoles,
+    )
+    print_batch_summary(results)
+
+    # Failed labs are retried on the next poll
+    for result in results:
+        if result["error"]:
+            watched_labs.pop(result["lab_id"], None)
+
+
+## SERVICE MODE ################################################################
+################################################################################
+
+# Keeps one controller's authentication and lab list in memory and serves
+# them on localhost, so launchers and SecureCRT button scripts can list labs
+# and regenerate sessions without starting Python, authenticating and
+# downloading the lab list each time:
+#
+#     GET  /labs                  the lab list
+#     POST /labs/<lab ID>/generate
+#     POST /generate              JSON body with any of lab_ids, title, state
+#                                 and all_consoles
+#
+# Every request must send 'Authorization: Bearer <token>' with the token the
+# service keeps in SERVICE_TOKEN_FILENAME next to config.yaml.
+SERVICE_PORT = 8765
+SERVICE_TOKEN_FILENAME = "service_token"
+
+
+def service_token(config_yaml):
+    # Token in the service token file next to config_yaml, created on first
+    # use and readable only by the current user
+    import secrets
+
+    token_file = os.path.join(
+        os.path.dirname(os.path.abspath(config_yaml)), SERVICE_TOKEN_FILENAME
+    )
+    try:
+        with open(token_file) as f:
+            token = f.read().strip()
+        if token:
+            return token_file, token
+    except OSError:
+        pass
+
+    token = secrets.token_urlsafe(32)
+    write_private_file(token_file, token + "\n")
+
+    return token_file, token
+
+
+def carry_over_topologies(previous_lab_info, lab_info):
+    # Node lists already fetched are reused for labs whose 'modified'
+    # timestamp did not move
+    if previous_lab_info is None:
+        return
+
+    previous_tiles = previous_lab_info["lab_tiles"]
+    for lab_id, lab_tile in lab_info["lab_tiles"].items():
+        previous_tile = previous_tiles.get(lab_id)
+        if (
+            previous_tile is not None
+            and "topology" in previous_tile
+            and "topology" not in lab_tile
+            and lab_tile.get("modified") is not None
+            and lab_tile.get("modified") == previous_tile.get("modified")
+        ):
+            lab_tile["topology"] = previous_tile["topology"]
+
+
+def refresh_inventory(service):
+    # Replaces the service's lab_info; on failure the previous one is kept
+    cml_configs = service["cml_configs"]
+    start_api_budget()
+    try:
+        lab_info = open_controller(
+            cml_configs["cml_server"],
+            cml_configs["cml_user"],
+            cml_configs["cml_pass"],
+            CONFIG_YAML,
+            service["offline"],
+        )
+    except Exception as err:
+        # Runs on the refresh thread, which must survive any failure; the
+        # error is reported by GET /labs until a refresh succeeds
+        if not isinstance(err, CMLAPIError):
+            err = f"{type(err).__name__}: {err}"
+        with service["lock"]:
+            service["error"] = str(err)
         print(
-            f"VALIDATING ACCOUNT {config_settings['cml_user']} AGAINST {config_settings['cml_server']}\n"
+            f"WARNING: Refreshing labs from {cml_configs['cml_server']} failed: {err}"
+        )
+        return
+
+    with service["lock"]:
+        carry_over_topologies(service["lab_info"], lab_info)
+        service["lab_info"] = lab_info
+        service["refreshed"] = time.time()
+        service["error"] = None
+
+
+def service_generate(service, lab_ids=None, title=None, state=None, all_consoles=None):
+    # generate_sessions() on the warm lab_info; labs are generated one
+    # request at a time so two requests never stage the same lab folder
+    with service["lock"]:
+        lab_info = service["lab_info"]
+    if lab_info is None:
+        raise ControllerUnreachableError(
+            API_ERROR_UNREACHABLE, service["error"] or "No lab list yet."
         )
 
-        validate_return = validate_settings_get_token(
-            config_settings["cml_user"],
-            config_settings["cml_pass"],
-            config_settings["cml_server"],
+    args = service["args"]
+    with service["generate_lock"]:
+        start_api_budget()
+        results = generate_sessions(
+            lab_info,
+            service["sessions_dir"],
+            lab_ids,
+            title,
+            state,
+            args.workers,
+            args.write_workers,
+            args.all_consoles if all_consoles is None else all_consoles,
         )
-        # The error handling here could be better, but it works well enough for now.
-        # Will readdress later.
-        if validate_return:
-            message1 = (
-                f"Try entering configuration settings again.\n"
-                f"Press ENTER to continue..."
-            )
-            if (
-                isinstance(validate_return, dict)
-                and "200" in validate_return["status_code"]
-            ):
-                print("AUTHENTICATION SUCCEEDED\n")
-                bearer_token = validate_return["bearer_token"]
-                base_url = validate_return["cml_url"]
-                break
-            elif "403" in validate_return:
-                print("AUTHENTICATION FAILED\n")
-                input(message1)
-            elif "timeout" in validate_return:
-                print(
-                    f"ERROR:   COULD NOT CONTACT {config_settings['cml_server']} \nREASON:  TIMEOUT\n"
-                )
-                input(message1)
-            elif "getaddrinfo" in validate_return or "nodename" in validate_return:
-                print(
-                    f"ERROR:   BAD HOSTNAME OR ADDRESS: {config_settings['cml_server']}\n"
-                )
-                input(message1)
-            elif "unreachable" in validate_return:
-                print(
-                    f"ERROR:   Could not reach CML server at {config_settings['cml_server']}. \nREASON:  NO NETWORK CONNECTIVITY\n"
+
+    return [
+        {
+            "lab_id": result["lab_id"],
+            "lab_title": result["lab_title"],
+            "session_dir": result["session_dir"],
+            "written": result["written"],
+            "removed": result["session_sync"]["removed"],
+            "unchanged": result["session_sync"]["unchanged"],
+            "failed": result["session_sync"]["failed"],
+            "error": result["error"],
+            "seconds": round(result["seconds"], 4),
+        }
+        for result in results
+    ]
+
+
+def check_service_request(request_body):
+    # Raises ValueError unless the POST /generate body only holds fields of
+    # the right type: lab_ids (list of str, or one str), title and state
+    # (str) and all_consoles (bool)
+    if not isinstance(request_body, dict):
+        raise ValueError("Expected a JSON object.")
+
+    lab_ids = request_body.get("lab_ids")
+    if lab_ids is not None and not isinstance(lab_ids, str):
+        if not isinstance(lab_ids, list) or not all(
+            isinstance(lab_id, str) for lab_id in lab_ids
+        ):
+            raise ValueError("'lab_ids' must be a list of lab IDs.")
+    for field in ("title", "state"):
+        if request_body.get(field) is not None and not isinstance(
+            request_body[field], str
+        ):
+            raise ValueError(f"'{field}' must be a string.")
+    all_consoles = request_body.get("all_consoles")
+    if all_consoles is not None and not isinstance(all_consoles, bool):
+        raise ValueError("'all_consoles' must be true or false.")
+
+
+def make_service_handler(service):
+    from http.server import BaseHTTPRequestHandler
+
+    class ServiceHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body):
+            raw_body = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw_body)))
+            self.end_headers()
+            self.wfile.write(raw_body)
+
+        def authorized(self):
+            import hmac
+
+            expected = "Bearer " + service["token"]
+            if hmac.compare_digest(self.headers.get("Authorization", ""), expected):
+                return True
+            self.send_json(401, {"error": "Missing or wrong service token."})
+            return False
+
+        def read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            if length == 0:
+                return dict()
+            request_body = json.loads(self.rfile.read(length))
+            check_service_request(request_body)
+            return request_body
+
+        def do_GET(self):
+            if not self.authorized():
+                return
+            if self.path.split("?", 1)[0] != "/labs":
+                self.send_json(404, {"error": "Not found."})
+                return
+
+            with service["lock"]:
+                lab_info = service["lab_info"]
+                refreshed = service["refreshed"]
+                error = service["error"]
+            if lab_info is None:
+                self.send_json(503, {"error": error or "No lab list yet."})
+                return
+
+            response_body = dict()
+            response_body["controller"] = service["cml_configs"]["cml_server"]
+            response_body["refreshed"] = refreshed
+            response_body["offline"] = bool(lab_info.get("offline"))
+            response_body["error"] = error
+            response_body["labs"] = list_labs(lab_info)
+            self.send_json(200, response_body)
+
+        def do_POST(self):
+            if not self.authorized():
+                return
+            path = self.path.split("?", 1)[0].strip("/").split("/")
+            try:
+                request_body = self.read_json()
+            except ValueError as err:
+                self.send_json(400, {"error": f"Bad request body: {err}"})
+                return
+
+            if path == ["generate"]:
+                lab_ids = request_body.get("lab_ids")
+                if isinstance(lab_ids, str):
+                    lab_ids = [lab_ids]
+            elif len(path) == 3 and path[0] == "labs" and path[2] == "generate":
+                lab_ids = [path[1]]
+            else:
+                self.send_json(404, {"error": "Not found."})
+                return
+
+            try:
+                results = service_generate(
+                    service,
+                    lab_ids,
+                    request_body.get("title"),
+                    request_body.get("state"),
+                    request_body.get("all_consoles"),
                 )
-                input(message1)
+            except LabNotFoundError as err:
+                self.send_json(404, {"error": str(err)})
+            except SetupRequiredError as err:
+                self.send_json(409, {"error": f"{err} Run setup first."})
+            except CMLAPIError as err:
+                self.send_json(502, {"error": str(err), "kind": err.kind})
+            except Exception as err:
+                self.send_json(500, {"error": f"{type(err).__name__}: {err}"})
             else:
-                print("Something went wrong\n")
-                print(validate_return)
-                input(message1)
-        else:
-            print("Something went wrong2\n")
-            print(validate_return)
-            input(message1)
+                status = 500 if any(result["error"] for result in results) else 200
+                self.send_json(status, {"results": results})
 
-    time.sleep(2)
-    os.system(clear_screen)
+    return ServiceHandler
 
-    def create_config_yaml():
-        search_cml_username = "CHANGEME_USER"
-        search_cml_password = "CHANGEME_PASS"
-        search_cml_name_or_ip = "CHANGEME_CML"
 
-        with open(r"initial_config", "r") as f:
-            data = f.read()
-            data = data.replace(search_cml_username, config_settings["cml_user"])
-            data = data.replace(search_cml_password, config_settings["cml_pass"])
-            data = data.replace(search_cml_name_or_ip, config_settings["cml_server"])
+def run_service(args):
+    # Serves until CTRL+C; returns an exit status code
+    from http.server import ThreadingHTTPServer
 
-        with open(r"config.yaml", "w") as f:
-            f.write(data)
+    cml_configs = headless_settings(args)
+    if cml_configs is None:
+        print(
+            "ERROR:   CML controller, username and password are required "
+            "(flags, CML_* environment variables or config.yaml)."
+        )
+        return EXIT_CONFIG
+    sessions_dir = headless_sessions_dir(args)
+    if sessions_dir is None:
+        return EXIT_CONFIG
+    exit_status, cml_configs = controller_context(cml_configs, sessions_dir)
+    if exit_status != EXIT_OK:
+        return exit_status
+
+    service = dict()
+    service["args"] = args
+    service["cml_configs"] = cml_configs
+    service["sessions_dir"] = sessions_dir
+    service["offline"] = args.offline
+    service["lab_info"] = None
+    service["refreshed"] = None
+    service["error"] = None
+    service["lock"] = threading.Lock()
+    service["generate_lock"] = threading.Lock()
+    token_file, service["token"] = service_token(CONFIG_YAML)
+
+    # Fails early on a wrong password instead of serving errors
+    try:
+        service["lab_info"] = open_controller(
+            cml_configs["cml_server"],
+            cml_configs["cml_user"],
+            cml_configs["cml_pass"],
+            CONFIG_YAML,
+            args.offline,
+        )
+    except AuthenticationError:
+        print(
+            f"ERROR:   AUTHENTICATION FAILED for {cml_configs['cml_user']} "
+            f"on {cml_configs['cml_server']}"
+        )
+        return EXIT_AUTH
+    except CMLAPIError as err:
+        print(f"WARNING: {err}; retrying every {args.interval} seconds.")
+        service["error"] = str(err)
+    else:
+        service["refreshed"] = time.time()
 
-    def create_console_server_session_file(cml_user, cml_server):
-        # Creating cml_console_server session file
-        console_session_template_file = shutil.copyfile(
-            init_console_server_session_file, console_session_template_location
+    try:
+        server = ThreadingHTTPServer(
+            ("127.0.0.1", args.port), make_service_handler(service)
         )
+    except OSError as err:
+        print(f"ERROR:   Cannot listen on 127.0.0.1:{args.port}: {err}")
+        return EXIT_CONFIG
+    server.daemon_threads = True
 
-        # Replacing placeholder USERNAME and HOSTNAME values with those found in config.yaml
-        with open(console_session_template_file, "r") as f:
-            console_session_data = f.read()
-            console_session_data = console_session_data.replace(
-                search_username, cml_user
-            )
-            console_session_data = console_session_data.replace(
-                search_contr, cml_server
-            )
-            console_session_data = console_session_data.replace(
-                search_cml_cmd, replace_cml_contr_cmd
-            )
+    def refresh_loop():
+        while True:
+            time.sleep(args.interval)
+            refresh_inventory(service)
 
-        with open(console_session_template_file, "w") as f:
-            f.write(console_session_data)
+    threading.Thread(target=refresh_loop, daemon=True).start()
 
-        def get_encrypted_seccrt_creds():
-            seccrt = securecrt_path
-            print(
-                "The script will attempt to use SecureCRT to connect to the\n"
-                "CML console server via SSH using the provided credentials.\n\n"
-            )
-            print(
-                "You will need to enter your CML password and leave the\n"
-                "SAVE PASSWORD checkbox checked.\n\n"
-            )
-            print(
-                "This will create a template file with your encrypted credentials\n"
-                "which will be used to generate session files for use with SecureCRT.\n\n"
-            )
-            print(
-                "Close SecureCRT once the 'cml_console_server' session disconnects\n\n"
-            )
-            input("Press ENTER to continue setup...\n")
-            print("Launching SecureCRT with cml_console_server session")
+    print(
+        f"Serving {cml_configs['cml_server']} on "
+        f"http://127.0.0.1:{server.server_port} (token in {token_file}), "
+        f"refreshing labs every {args.interval} seconds. Press CTRL+C to stop."
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped serving.")
+    finally:
+        server.server_close()
 
-            # Command to launch an SSH session in a tab in SecureCRT
-            if OS == "win32":
-                cmd = [seccrt, "/T", "/S", "cml_console_server"]
-            elif OS == "darwin":
-                cmd = [
-                    "/Applications/SecureCRT.app/Contents/MacOS/SecureCRT",
-                    "/T",
-                    "/S",
-                    "cml_console_server",
-                ]
+    return EXIT_OK
 
-            # Executing SecureCRT
-            try:
-                subprocess.run(cmd, check=True)
-            except FileNotFoundError as exc:
-                print(
-                    f"Process failed because the executable could not be found.\n{exc}"
-                )
-                print("\nExiting")
-                sys.exit(1)
-            except subprocess.CalledProcessError as exc:
-                print(
-                    f"Process failed because did not return a successful return code. "
-                    f"Returned {exc.returncode}\n{exc}"
-                )
-                print("\nExiting")
-                sys.exit(1)
-            except subprocess.TimeoutExpired as exc:
-                print(f"Process timed out.\n{exc}")
-                print("\nExiting")
-                sys.exit(1)
 
-            os.system(clear_screen)
+## COMMAND LINE ARGUMENTS ######################################################
+################################################################################
 
-            print()
-            print("Console server session template file created")
-            print("=" * 79)
 
-        get_encrypted_seccrt_creds()
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate SecureCRT session files for labs in Cisco Modeling Labs."
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="generate sessions for every lab (or the labs matching --title/--state)",
+    )
+    parser.add_argument(
+        "--title",
+        metavar="GLOB",
+        help="only labs whose title matches GLOB, e.g. 'CCNP*' (implies --batch)",
+    )
+    parser.add_argument(
+        "--state",
+        metavar="STATE",
+        help="only labs in STATE, e.g. STARTED or STOPPED (implies --batch)",
+    )
+    parser.add_argument(
+        "--lab-id",
+        action="append",
+        metavar="UUID",
+        help="only the lab with this ID; may be repeated (implies --batch)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        metavar="N",
+        help="number of labs rendered in parallel in batch mode (default: 8)",
+    )
+    parser.add_argument(
+        "--write-workers",
+        type=int,
+        default=SESSION_WRITE_WORKERS,
+        metavar="N",
+        help="session files written in parallel per lab; helps when the "
+        "Sessions folder is on a network share, 1 writes serially "
+        f"(default: {SESSION_WRITE_WORKERS})",
+    )
 
-    def create_cml_sessions_dir():
-        cml_server_dir = "CML " + cml_server + " Labs"
-        sessions_cml_labs_dir = os.path.join(sessions_dir, cml_server_dir)
+    parser.add_argument(
+        "--all-consoles",
+        action="store_true",
+        help="also write a '<node> line N' session for every extra console "
+        "line of nodes with more than one serial port",
+    )
 
-        try:
-            os.makedirs(sessions_cml_labs_dir, exist_ok=True)
-            print(f"Directory '{cml_server_dir}' created successfully")
-            print("=" * 79)
-            return sessions_cml_labs_dir
-        except OSError as error:
-            input(
-                f"Directory '{cml_server_dir}' could not be created.\nPress ENTER to exit..."
-            )
-            sys.exit(1)
+    parser.add_argument(
+        "--session-format",
+        choices=SESSION_FORMATS,
+        default=SESSION_FORMAT_INI,
+        help="'ini' writes one session file per node into the Sessions folder; "
+        "'xml' writes the sessions of every selected lab into one file to "
+        "import with Tools > Import Settings in SecureCRT (default: ini)",
+    )
+    parser.add_argument(
+        "--export-dir",
+        metavar="DIR",
+        help="folder of the 'CML <server> Labs.xml' import file written by "
+        "--session-format xml (default: the folder that holds Sessions)",
+    )
 
-    def create_node_session_template_file():
-        console_session_template_file = console_session_template_location
-        replace_cml_node_cmd = "open /CHANGEME_LAB_TITLE/CHANGEME_NODE_LABEL/0"
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="generate sessions from the lab list saved by the last successful "
+        "run without contacting the controller (also used automatically when "
+        "the controller cannot be reached)",
+    )
 
-        sessions_cml_labs_dir = create_cml_sessions_dir()
-        node_session_template_location = os.path.join(
-            sessions_cml_labs_dir, node_session_template_filename
-        )
+    parser.add_argument(
+        "--api-budget",
+        type=float,
+        default=API_RUN_BUDGET,
+        metavar="SECONDS",
+        help="give up on the controller once its API calls, including retries, "
+        "have taken this long in total; in watch mode this applies per poll, "
+        f"0 means no limit (default: {API_RUN_BUDGET})",
+    )
 
-        # Creating node session template file
-        node_session_template_file = shutil.copyfile(
-            console_session_template_file, node_session_template_location
-        )
+    parser.add_argument(
+        "--timings",
+        nargs="?",
+        const="table",
+        choices=("table", "json"),
+        help="print time spent per phase, HTTP bytes received and files/bytes "
+        "written at the end of the run (default format: table)",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="profile the session render loop with cProfile and tracemalloc and "
+        "write the stats to FILE (renders labs one at a time)",
+    )
 
-        # Replacing placeholder USERNAME and HOStNAME values with those found in config.yaml
-        search_cml_contr_cmd = replace_cml_contr_cmd
+    headless = parser.add_argument_group(
+        "headless mode",
+        "Runs without prompts, pauses or screen clearing and exits with "
+        f"{EXIT_OK} on success, {EXIT_FAILURE} if a lab failed, "
+        f"{EXIT_USAGE} on bad arguments, {EXIT_CONFIG} on missing settings or "
+        f"setup, {EXIT_AUTH} on authentication failure, {EXIT_UNREACHABLE} if "
+        f"the controller is unreachable and {EXIT_NO_LABS} if no labs matched. "
+        "Setup must have been completed interactively once.",
+    )
+    headless.add_argument(
+        "--headless",
+        action="store_true",
+        help="run non-interactively, e.g. from cron or a scheduled task",
+    )
+    headless.add_argument(
+        "--controller", help="CML name or IP address (env: CML_CONTROLLER)"
+    )
+    headless.add_argument("--username", help="CML username (env: CML_USERNAME)")
+    headless.add_argument("--password", help="CML password (env: CML_PASSWORD)")
+    headless.add_argument(
+        "--output-root",
+        metavar="DIR",
+        help="SecureCRT 'Sessions' directory (env: CML_SESSIONS_DIR; "
+        "default: discovered from SecureCRT)",
+    )
+    headless.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and regenerate sessions of labs whose nodes change "
+        "(all labs unless --title, --state or --lab-id are given)",
+    )
+    headless.add_argument(
+        "--interval",
+        type=float,
+        default=30,
+        metavar="SECONDS",
+        help="seconds between polls in watch and service mode (default: 30)",
+    )
+    headless.add_argument(
+        "--serve",
+        action="store_true",
+        help="keep the controller's lab list in memory and generate sessions on "
+        "request over HTTP on localhost (see --port)",
+    )
+    headless.add_argument(
+        "--port",
+        type=int,
+        default=SERVICE_PORT,
+        help=f"localhost port of --serve (default: {SERVICE_PORT})",
+    )
+    headless.add_argument(
+        "--roster",
+        metavar="FILE",
+        help="generate sessions for every user listed in FILE, fetching the lab "
+        "list once with the service account given by --controller, --username "
+        "and --password (see README)",
+    )
+    headless.add_argument(
+        "--config",
+        metavar="FILE",
+        help="path of config.yaml (env: CML_CONFIG; default: config.yaml)",
+    )
 
-        with open(node_session_template_file, "r") as f:
-            node_session_data = f.read()
-            node_session_data = node_session_data.replace(
-                search_cml_contr_cmd, replace_cml_node_cmd
-            )
+    args = parser.parse_args(argv)
 
-        with open(node_session_template_file, "w") as f:
-            f.write(node_session_data)
+    if args.title is not None or args.state is not None or args.lab_id:
+        args.batch = True
 
-    def housekeeping():
-        # Deleting cml_console_server.ini template file
-        if os.path.exists(console_session_template_location):
-            print(f"Deleting {console_session_template_location}")
-            os.remove(console_session_template_location)
-            os.system(clear_screen)
-        else:
-            input(
-                f"{console_session_template_location} does not exist\nPress ENTER to exit..."
-            )
-            sys.exit(1)
+    if args.roster:
+        args.headless = True
+        args.batch = True
 
-    create_config_yaml()
+    if args.profile:
+        # cProfile only records the thread it was enabled in
+        args.workers = 1
 
-    cml_configs = set_config_variables()
+    if args.offline and args.watch:
+        parser.error("--offline cannot be combined with --watch")
 
-    if cml_configs is not None:
-        cml_user = cml_configs["cml_user"]
-        cml_server = cml_configs["cml_server"]
-    else:
-        input("Press ENTER to exit...")
-        sys.exit(1)
+    if args.roster and (args.watch or args.serve or args.export_dir):
+        parser.error(
+            "--roster cannot be combined with --watch, --serve or --export-dir"
+        )
 
-    time.sleep(1)
+    if args.serve and (args.watch or args.batch):
+        parser.error("--serve cannot be combined with --watch or lab selection")
 
-    create_console_server_session_file(cml_user, cml_server)
+    if args.session_format == SESSION_FORMAT_XML and (args.watch or args.serve):
+        parser.error("--session-format xml cannot be combined with --watch or --serve")
 
-    create_node_session_template_file()
+    if args.headless and not args.batch and not args.watch and not args.serve:
+        parser.error("--headless requires --batch, --title, --state or --lab-id")
 
-    housekeeping()
+    return args
 
 
 ## MAIN ########################################################################
 ################################################################################
 
 
-def main():
+def main(args):
     running = True
     while running:
         securecrt_path = application_installed()
@@ -686,60 +5040,153 @@ def main():
         while True:
             config_yaml_exists = config_yaml_check(CONFIG_YAML)
             if config_yaml_exists:
-                cml_configs = set_config_variables()
-                if cml_configs is not None:
-                    cml_user = cml_configs["cml_user"]
-                    cml_pass = cml_configs["cml_pass"]
-                    cml_server = cml_configs["cml_server"]
-
-                    sessions_cml_labs_dir_name = "CML " + cml_server + " Labs"
-                    sessions_cml_labs_dir = os.path.join(
-                        sessions_dir, sessions_cml_labs_dir_name
-                    )
-                else:
+                controllers = config_controllers()
+                if controllers is None:
                     input("Press ENTER to exit...")
                     sys.exit(1)
 
+                # Every controller's labs are generated at once in batch mode
+                if args.batch and len(controllers) > 1:
+                    run_controllers(args, controllers, sessions_dir)
+                    input("\nPress ENTER to exit...\n\n")
+
+                    running = False
+                    break
+
+                # config.yaml is only rewritten by setup when it holds a
+                # single controller
+                multiple_controllers = len(controllers) > 1
+                cml_configs = controller_selector(controllers)
+                cml_user = cml_configs["cml_user"]
+                cml_pass = cml_configs["cml_pass"]
+                cml_server = cml_configs["cml_server"]
+
+                sessions_cml_labs_dir_name = cml_labs_dir_name(cml_server)
+                sessions_cml_labs_dir = os.path.join(
+                    sessions_dir, sessions_cml_labs_dir_name
+                )
+
                 if os.path.exists(sessions_cml_labs_dir) is False:
                     input(
                         f"The directory {sessions_cml_labs_dir} was not found.\nPress ENTER to begin setup..."
                     )
+                    if multiple_controllers:
+                        setup(
+                            init_console_server_session_file,
+                            sessions_dir,
+                            CONFIG_YAML,
+                            securecrt_path,
+                            cml_configs,
+                        )
+                        continue
                     os.remove(CONFIG_YAML)
                     break
 
-                print(f"\nVALIDATING ACCOUNT {cml_user} AGAINST {cml_server}\n")
+                if args.offline:
+                    validate_return = "--offline"
+                    lab_info = None
+                else:
+                    print(f"\nVALIDATING ACCOUNT {cml_user} AGAINST {cml_server}\n")
+                    start_api_budget()
+
+                    try:
+                        validate_return, lab_info = authenticate_get_lab_info(
+                            CONFIG_YAML, cml_user, cml_pass, cml_server
+                        )
+                    except requests.exceptions.RequestException as err:
+                        validate_return = api_error(err)
+                        lab_info = None
 
-                validate_return = validate_settings_get_token(
-                    cml_user, cml_pass, cml_server
-                )
                 if isinstance(validate_return, dict):
-                    print("AUTHENTICATION SUCCEEDED\n")
                     base_url = validate_return["cml_url"]
                     token = validate_return["bearer_token"]
-                    time.sleep(2)
+                    print("AUTHENTICATION SUCCEEDED\n")
+                    if not validate_return["cached"]:
+                        time.sleep(2)
                     os.system(clear_screen)
-                else:
+                elif auth_failed(validate_return) and multiple_controllers:
+                    print(f"AUTHENTICATION FAILED for {cml_user} on {cml_server}")
+                    input(
+                        f"Correct its credentials in {CONFIG_YAML}.\nPress ENTER to exit..."
+                    )
+                    sys.exit(1)
+                elif auth_failed(validate_return):
                     input("AUTHENTICATION FAILED\nPress ENTER to begin setup...\n")
                     os.remove(CONFIG_YAML)
                     break
+                else:
+                    # The controller could not be reached; config.yaml is kept
+                    lab_info = offline_lab_info(CONFIG_YAML, cml_user, cml_server)
+                    if lab_info is None:
+                        print(f"COULD NOT CONTACT {cml_server}: {validate_return}")
+                        print("No lab snapshot has been saved for it yet.")
+                        input("Press ENTER to exit...")
+                        sys.exit(1)
+                    if args.offline:
+                        print_offline_notice(lab_info, "--offline given")
+                    else:
+                        print_offline_notice(
+                            lab_info, f"Could not contact {cml_server}"
+                        )
+                    base_url = lab_info["cml_url"]
+                    token = None
 
-                lab_info = get_lab_info(base_url, token)
                 labs = lab_info["lab_details"]
-                num_of_labs = lab_info["total_labs"]
 
-                lab_selection = lab_selector(labs, num_of_labs)
+                invalid_chars = INVALID_CHARS
+
+                if args.batch:
+                    selected_labs = filter_labs(
+                        labs, args.title, args.state, args.lab_id
+                    )
+                else:
+                    selected_labs = lab_selector(lab_info)
+                    start_api_budget()
+
+                # Several labs picked interactively, and every export to an
+                # import file, are generated like a batch
+                if (
+                    len(selected_labs) != 1
+                    or args.batch
+                    or args.session_format == SESSION_FORMAT_XML
+                ):
+                    get_lab_nodes(
+                        base_url, token, lab_info, [lab[3] for lab in selected_labs]
+                    )
+                    print(f"Generating session files for {len(selected_labs)} lab(s)\n")
+                    results = batch_generate(
+                        sessions_cml_labs_dir,
+                        lab_info,
+                        selected_labs,
+                        invalid_chars,
+                        args.workers,
+                        args.write_workers,
+                        args.all_consoles,
+                        args.session_format,
+                        args.export_dir,
+                    )
+                    print_batch_summary(results)
+                    input("\nPress ENTER to exit...\n\n")
+
+                    running = False
+                    break
+
+                lab_selection = selected_labs[0][3]
+                get_lab_nodes(base_url, token, lab_info, [lab_selection])
 
-                invalid_chars = ("<", ">", ":", '"', "\/", "\\", "|", "?", "*")
+                if "topology" not in lab_info["lab_tiles"][lab_selection]:
+                    print(
+                        "The node list of this lab is not in the offline lab snapshot."
+                    )
+                    input("\nPress ENTER to exit...\n\n")
+                    sys.exit(1)
 
                 lab_nodes = lab_info["lab_tiles"][lab_selection]["topology"]["nodes"]
                 lab_title = lab_info["lab_tiles"][lab_selection]["lab_title"]
                 lab_title_command = lab_title
-
-                for invalid_char in invalid_chars:
-                    if invalid_char in lab_title:
-                        lab_title_command = lab_title
-                        new_lab_title = lab_title.replace(invalid_char, "_").strip()
-                        lab_title = new_lab_title
+                lab_title = lab_session_dirnames(
+                    lab_info, invalid_chars, sessions_cml_labs_dir
+                )[lab_selection]
 
                 node_session_dir = create_lab_session_dir(
                     sessions_cml_labs_dir, lab_title
@@ -752,7 +5199,11 @@ def main():
                     node_session_dir,
                     lab_title_command,
                     lab_title,
+                    write_workers=args.write_workers,
+                    node_definitions=lab_info.get("node_definitions"),
+                    all_consoles=args.all_consoles,
                 )
+                input("\nPress ENTER to exit...\n\n")
 
                 running = False
                 break
@@ -775,18 +5226,33 @@ def main():
 
 
 if __name__ == "__main__":
-    OS = sys.platform
-    CONFIG_YAML = "config.yaml"
+    args = parse_args()
 
-    if OS == "win32":
-        from msilib.schema import Directory
-        import winreg
+    CONFIG_YAML = args.config or os.environ.get("CML_CONFIG") or CONFIG_YAML
 
-        clear_screen = "cls"
-    elif OS == "darwin":
-        clear_screen = "clear"
+    if args.profile:
+        start_profiler()
 
-    os.system(clear_screen)
-    requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+    start_api_budget(args.api_budget)
+
+    try:
+        if args.watch:
+            sys.exit(run_watch(args))
+
+        if args.serve:
+            sys.exit(run_service(args))
+
+        if args.roster:
+            sys.exit(run_roster(args))
+
+        if args.headless:
+            sys.exit(run_headless(args))
+
+        os.system(clear_screen)
 
-    main()
+        main(args)
+    finally:
+        if args.profile:
+            stop_profiler(args.profile)
+        if args.timings:
+            print_run_stats(args.timings)
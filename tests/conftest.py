@@ -0,0 +1,49 @@
+import os
+import sys
+
+import pytest
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SOURCE_DIR)
+sys.path.insert(0, os.path.join(SOURCE_DIR, "benchmarks"))
+
+
+@pytest.fixture
+def fake_cml():
+    # Local stand-in CML controller with 3 labs of 4 nodes
+    from fake_cml import start_fake_cml
+
+    server = start_fake_cml(labs=3, nodes=4)
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def make_sessions_dir(tmp_path):
+    # Sets up Sessions/"CML <controller> Labs" with a node session template
+    # and returns the Sessions directory
+    import session_gen
+    from bench_render import write_node_session_template
+
+    def make_sessions_dir(controller):
+        sessions_dir = tmp_path / "Sessions"
+        sessions_cml_labs_dir = sessions_dir / session_gen.cml_labs_dir_name(controller)
+        os.makedirs(sessions_cml_labs_dir)
+        write_node_session_template(str(sessions_cml_labs_dir))
+        return str(sessions_dir)
+
+    return make_sessions_dir
+
+
+@pytest.fixture
+def sessions_dir(fake_cml, make_sessions_dir):
+    return make_sessions_dir(fake_cml.controller)
+
+
+@pytest.fixture
+def sessions_cml_labs_dir(fake_cml, sessions_dir):
+    import session_gen
+
+    return os.path.join(
+        sessions_dir, session_gen.cml_labs_dir_name(fake_cml.controller)
+    )
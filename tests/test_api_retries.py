@@ -0,0 +1,123 @@
+import socket
+import time
+
+import pytest
+import requests
+
+import session_gen
+
+
+@pytest.fixture(autouse=True)
+def api_state(monkeypatch):
+    # Fresh circuits, no run budget and short backoff pauses
+    monkeypatch.setattr(session_gen, "_circuits", dict())
+    monkeypatch.setattr(session_gen, "_api_budget", 0)
+    monkeypatch.setattr(session_gen, "_api_deadline", None)
+    monkeypatch.setattr(session_gen, "API_BACKOFF_BASE", 0.001)
+    session_gen.reset_run_stats()
+
+
+@pytest.fixture
+def base_url(fake_cml):
+    fake_cml.requests.clear()
+    return session_gen.api_base_url(fake_cml.controller)
+
+
+def system_information(base_url, **kwargs):
+    return session_gen.cml_api_request("GET", base_url, "/system_information", **kwargs)
+
+
+def test_5xx_and_429_are_retried(fake_cml, base_url):
+    fake_cml.inject_faults("/system_information", 503, (429, 0))
+
+    assert system_information(base_url).status_code == 200
+    assert len(fake_cml.requests) == 3
+    assert session_gen.run_stats()["api_retries"] == 2
+
+
+def test_last_5xx_response_is_returned(fake_cml, base_url):
+    fake_cml.inject_faults("/system_information", 502, 503, 504, 500)
+
+    assert system_information(base_url).status_code == 504
+    assert len(fake_cml.requests) == session_gen.API_RETRIES + 1
+
+
+def test_reset_connection_is_retried(fake_cml, base_url):
+    fake_cml.inject_faults("/system_information", "reset")
+
+    assert system_information(base_url).status_code == 200
+    assert len(fake_cml.requests) == 2
+
+
+def test_name_resolution_failure_is_not_retried(monkeypatch):
+    lookups = []
+
+    def getaddrinfo(*args, **kwargs):
+        lookups.append(args[0])
+        raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+
+    monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+
+    with pytest.raises(requests.exceptions.ConnectionError) as excinfo:
+        system_information("http://cml.invalid/api/v0")
+    assert session_gen.is_name_resolution_error(excinfo.value)
+    assert lookups == ["cml.invalid"]
+
+
+def test_read_timeout_is_not_retried(fake_cml, base_url):
+    fake_cml.inject_faults("/system_information", 1.0)
+
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        system_information(base_url, timeout=(3.05, 0.2))
+    assert len(fake_cml.requests) == 0
+
+
+def test_retry_pause_beyond_budget_gives_up(fake_cml, base_url):
+    fake_cml.inject_faults("/system_information", (503, 5))
+    session_gen.start_api_budget(1)
+
+    start_time = time.monotonic()
+    with pytest.raises(requests.exceptions.Timeout, match="budget"):
+        system_information(base_url)
+    assert time.monotonic() - start_time < 1
+    assert len(fake_cml.requests) == 1
+
+
+def test_used_up_budget_stops_calls(fake_cml, base_url):
+    session_gen.start_api_budget(0.01)
+    time.sleep(0.02)
+
+    with pytest.raises(requests.exceptions.Timeout, match="budget"):
+        system_information(base_url)
+    assert fake_cml.requests == []
+
+
+def test_circuit_opens_blocks_and_half_opens(fake_cml, base_url, monkeypatch):
+    monkeypatch.setattr(session_gen, "CIRCUIT_OPEN_SECONDS", 0.3)
+    fake_cml.inject_faults(
+        "/system_information", *[503] * session_gen.CIRCUIT_FAILURE_THRESHOLD
+    )
+
+    # Three failed attempts, then two more open the circuit
+    assert system_information(base_url).status_code == 503
+    with pytest.raises(requests.exceptions.ConnectionError, match="in a row"):
+        system_information(base_url)
+    assert len(fake_cml.requests) == session_gen.CIRCUIT_FAILURE_THRESHOLD
+
+    # Open: the controller is not contacted
+    with pytest.raises(requests.exceptions.ConnectionError, match="in a row"):
+        system_information(base_url)
+    assert len(fake_cml.requests) == session_gen.CIRCUIT_FAILURE_THRESHOLD
+
+    # Half-open: one attempt, whose failure opens the circuit again
+    time.sleep(0.35)
+    fake_cml.inject_faults("/system_information", 503)
+    with pytest.raises(requests.exceptions.ConnectionError, match="in a row"):
+        system_information(base_url)
+    assert len(fake_cml.requests) == session_gen.CIRCUIT_FAILURE_THRESHOLD + 1
+
+    # Half-open again: a success closes it
+    time.sleep(0.35)
+    assert system_information(base_url).status_code == 200
+    assert system_information(base_url).status_code == 200
+    assert session_gen._circuits[base_url]["failures"] == 0
@@ -0,0 +1,48 @@
+import os
+import stat
+import sys
+
+import pytest
+
+import session_gen
+
+
+def test_json_cache_round_trip(tmp_path):
+    cache_file = str(tmp_path / "sub" / "cache.json")
+    session_gen.save_json_cache(cache_file, {"a": [1, 2]})
+
+    assert session_gen.load_json_cache(cache_file) == {"a": [1, 2]}
+    assert os.listdir(tmp_path / "sub") == ["cache.json"]
+    if sys.platform != "win32":
+        assert stat.S_IMODE(os.stat(cache_file).st_mode) == 0o600
+
+
+@pytest.mark.parametrize("content", ["", "{truncated", "[1, 2]", "null"])
+def test_unusable_json_cache_is_empty(tmp_path, content):
+    cache_file = tmp_path / "cache.json"
+    cache_file.write_text(content)
+
+    assert session_gen.load_json_cache(str(cache_file)) == dict()
+
+
+def test_config_cache_is_private(tmp_path):
+    config_yaml = tmp_path / "config.yaml"
+    config_yaml.write_text("username: user\npassword: secret\n")
+
+    data = session_gen.load_config_yaml(str(config_yaml))
+    cache_file = session_gen.config_cache_path(str(config_yaml))
+
+    assert data == {"username": "user", "password": "secret"}
+    assert session_gen.load_json_cache(cache_file)["data"] == data
+    if sys.platform != "win32":
+        assert stat.S_IMODE(os.stat(cache_file).st_mode) == 0o600
+    assert session_gen.load_config_yaml(str(config_yaml)) == data
+
+
+def test_service_token_is_reused(tmp_path):
+    config_yaml = str(tmp_path / "config.yaml")
+    token_file, token = session_gen.service_token(config_yaml)
+
+    assert session_gen.service_token(config_yaml) == (token_file, token)
+    if sys.platform != "win32":
+        assert stat.S_IMODE(os.stat(token_file).st_mode) == 0o600
@@ -0,0 +1,70 @@
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+import pytest
+
+import session_gen
+
+NODE_SESSION_TEMPLATE = (
+    # Setup saves the template with a byte order mark
+    "\ufeff"
+    'S:"Shell Command"=open /CHANGEME_LAB_TITLE/CHANGEME_NODE_LABEL/CHANGEME_CONSOLE_LINE\n'
+    'S:"Emulation"=Xterm & <VT100>\n'
+    'D:"Port"=00000016\n'
+    'B:"Page Margins"=00000024\n'
+    " 00 00 00 00 00 00 e0 3f 00 00 00 00 00 00 e0 3f 00 00 00 00 00 00 e0 3f 00 00 00 00 00 00 e0 3f\n"
+    " 01 02 03 04\n"
+    'Z:"Expect Send"=00000002\n'
+    " CHANGEME_NODE_LABEL>\n"
+    " show <version>\n"
+    'Z:"Keyword List"=00000000\n'
+)
+
+
+def render_session(substitutions):
+    # Renders one session the way export_labs() does and parses it
+    compiled_template = session_gen.compile_node_session_template(
+        session_gen.export_session_template(NODE_SESSION_TEMPLATE)
+    )
+    session = session_gen.render_node_session(
+        compiled_template,
+        {placeholder: escape(value) for placeholder, value in substitutions.items()},
+    )
+
+    return ET.fromstring(f'<key name="session">\n{session}</key>')
+
+
+def test_session_values_are_exported():
+    session = render_session(session_gen.session_substitutions("lab", "R1", 0))
+
+    assert session.find("string[@name='Emulation']").text == "Xterm & <VT100>"
+    assert session.find("dword[@name='Port']").text == "22"
+    assert session.find("binary[@name='Page Margins']").text == (
+        "000000000000e03f" * 4 + "01020304"
+    )
+    assert [item.text for item in session.find("array[@name='Expect Send']")] == [
+        "R1>",
+        "show <version>",
+    ]
+    assert len(session.find("array[@name='Keyword List']")) == 0
+
+
+def test_placeholder_values_are_escaped():
+    session = render_session(
+        session_gen.session_substitutions("R&D <core>", "\"edge\"&'1'", 2)
+    )
+
+    assert session.find("string[@name='Shell Command']").text == (
+        "open /R&D <core>/\"edge\"&'1'/2"
+    )
+    assert session.find("array[@name='Expect Send']")[0].text == "\"edge\"&'1'>"
+
+
+def test_truncated_binary_value_is_rejected():
+    with pytest.raises(ValueError, match="truncated"):
+        session_gen.export_session_template('B:"Page Margins"=00000024\n 00 00\n')
+
+
+def test_malformed_line_is_rejected():
+    with pytest.raises(ValueError, match="line 2"):
+        session_gen.export_session_template('D:"Port"=00000016\nPort=22\n')
@@ -0,0 +1,66 @@
+import pytest
+
+import session_gen
+
+
+@pytest.fixture
+def config_yaml(fake_cml, tmp_path, monkeypatch):
+    # The top-level entry would be rejected; the listed controller would not
+    config_yaml = tmp_path / "config.yaml"
+    config_yaml.write_text(
+        "username: alice\n"
+        "password: wrong\n"
+        "controller: cml1.example.com\n"
+        "controllers:\n"
+        f"  - controller: {fake_cml.controller}\n"
+        "    username: bob\n"
+        "    password: good\n"
+    )
+    monkeypatch.setattr(session_gen, "CONFIG_YAML", str(config_yaml))
+    for variable in ("CML_CONTROLLER", "CML_USERNAME", "CML_PASSWORD"):
+        monkeypatch.delenv(variable, raising=False)
+    return str(config_yaml)
+
+
+def headless_args(sessions_dir, *extra_args):
+    return session_gen.parse_args(
+        ["--headless", "--batch", "--output-root", sessions_dir, *extra_args]
+    )
+
+
+def test_listed_controller_uses_its_own_credentials(
+    fake_cml, sessions_dir, config_yaml
+):
+    args = headless_args(sessions_dir, "--controller", fake_cml.controller)
+
+    assert session_gen.headless_settings(args)["cml_user"] == "bob"
+    assert session_gen.run_headless(args) == session_gen.EXIT_OK
+
+
+def test_environment_credentials_skip_multiple_controllers(
+    fake_cml, sessions_dir, config_yaml, monkeypatch
+):
+    monkeypatch.setenv("CML_USERNAME", "carol")
+    monkeypatch.setenv("CML_PASSWORD", "wrong")
+
+    controllers = session_gen.headless_controllers(headless_args(sessions_dir))
+    assert [cml_configs["cml_user"] for cml_configs in controllers] == [
+        "alice",
+        "bob",
+    ]
+
+    monkeypatch.setenv("CML_CONTROLLER", fake_cml.controller)
+    controllers = session_gen.headless_controllers(headless_args(sessions_dir))
+    assert [cml_configs["cml_user"] for cml_configs in controllers] == ["carol"]
+
+
+def test_malformed_lab_tile_is_a_typed_error(fake_cml, sessions_dir, config_yaml):
+    lab_id = next(iter(fake_cml.labs))
+    fake_cml.set_responses({f"/labs/{lab_id}": {"state": "STOPPED"}})
+
+    with pytest.raises(session_gen.CMLAPIError) as excinfo:
+        session_gen.open_controller(fake_cml.controller, "bob", "good", config_yaml)
+    assert excinfo.value.kind == session_gen.API_ERROR_OTHER
+
+    args = headless_args(sessions_dir, "--controller", fake_cml.controller)
+    assert session_gen.run_headless(args) == session_gen.EXIT_UNREACHABLE
@@ -0,0 +1,79 @@
+import pytest
+
+import session_gen
+from fake_cml import start_fake_cml
+
+
+@pytest.fixture
+def old_cml():
+    # Controller too old for the per-lab node lists
+    server = start_fake_cml(labs=3, nodes=4, version="2.2.2")
+    yield server
+    server.stop()
+
+
+def authenticate(fake_cml):
+    session_gen._cml_versions.clear()
+    session_gen._conditional_responses.clear()
+    validate_return = session_gen.validate_settings_get_token(
+        "user", "password", fake_cml.controller
+    )
+
+    return validate_return["cml_url"], validate_return["bearer_token"]
+
+
+def get_lab_info(fake_cml, base_url, bearer_token):
+    # Returns (lab_info, paths requested, bytes sent)
+    fake_cml.requests.clear()
+    bytes_sent = fake_cml.bytes_sent
+    lab_info = session_gen.get_lab_info(base_url, bearer_token)
+
+    return (
+        lab_info,
+        [path for _, path in fake_cml.requests],
+        fake_cml.bytes_sent - bytes_sent,
+    )
+
+
+def test_labs_listed_without_node_lists(fake_cml):
+    base_url, bearer_token = authenticate(fake_cml)
+    lab_info, paths, _ = get_lab_info(fake_cml, base_url, bearer_token)
+
+    assert "/labs?show_all=true" in paths
+    assert "/populate_lab_tiles" not in paths
+    assert not any(path.endswith("/nodes?data=true") for path in paths)
+    assert set(lab_info["lab_tiles"]) == set(fake_cml.labs)
+    for lab_tile in lab_info["lab_tiles"].values():
+        assert lab_tile["owner"] == "admin"
+        assert "topology" not in lab_tile
+
+    selected_lab_id = lab_info["lab_details"][0][3]
+    fake_cml.requests.clear()
+    session_gen.get_lab_nodes(base_url, bearer_token, lab_info, [selected_lab_id])
+
+    assert [path for _, path in fake_cml.requests] == [
+        f"/labs/{selected_lab_id}/nodes?data=true"
+    ]
+    assert len(lab_info["lab_tiles"][selected_lab_id]["topology"]["nodes"]) == 5
+
+
+def test_old_controller_gets_populate_lab_tiles(old_cml):
+    base_url, bearer_token = authenticate(old_cml)
+    lab_info, paths, _ = get_lab_info(old_cml, base_url, bearer_token)
+
+    assert paths == ["/system_information", "/populate_lab_tiles"]
+    assert set(lab_info["lab_tiles"]) == set(old_cml.labs)
+    for lab_tile in lab_info["lab_tiles"].values():
+        assert len(lab_tile["topology"]["nodes"]) == 5
+
+
+@pytest.mark.parametrize("controller", ["fake_cml", "old_cml"])
+def test_unchanged_inventory_is_not_downloaded_again(request, controller):
+    fake_cml = request.getfixturevalue(controller)
+    base_url, bearer_token = authenticate(fake_cml)
+    first_lab_info, _, first_bytes = get_lab_info(fake_cml, base_url, bearer_token)
+
+    for _ in range(2):
+        lab_info, _, bytes_sent = get_lab_info(fake_cml, base_url, bearer_token)
+        assert bytes_sent < first_bytes / 10
+        assert lab_info["lab_tiles"] == first_lab_info["lab_tiles"]
@@ -0,0 +1,34 @@
+import session_gen
+
+
+def test_unwritable_snapshot_does_not_fail_a_live_run(fake_cml, tmp_path, capsys):
+    # A file where the snapshot folder should be
+    config_dir = tmp_path / "state"
+    config_dir.mkdir()
+    (config_dir / session_gen.LAB_SNAPSHOT_DIRNAME).write_text("in the way")
+
+    lab_info = session_gen.open_controller(
+        fake_cml.controller, "user", "password", str(config_dir / "config.yaml")
+    )
+    lab_ids = list(lab_info["lab_tiles"])
+    session_gen.get_lab_nodes(
+        lab_info["validate_return"]["cml_url"],
+        lab_info["validate_return"]["bearer_token"],
+        lab_info,
+        lab_ids,
+    )
+
+    assert set(lab_ids) == set(fake_cml.labs)
+    assert "WARNING: Could not write" in capsys.readouterr().out
+
+
+def test_snapshot_is_used_offline(fake_cml, tmp_path):
+    config_yaml = str(tmp_path / "config.yaml")
+    session_gen.open_controller(fake_cml.controller, "user", "password", config_yaml)
+
+    lab_info = session_gen.open_controller(
+        fake_cml.controller, "user", None, config_yaml, offline=True
+    )
+
+    assert lab_info["offline"]
+    assert set(lab_info["lab_tiles"]) == set(fake_cml.labs)
@@ -0,0 +1,158 @@
+import os
+
+import pytest
+
+import session_gen
+
+INVALID_CHARS = session_gen.INVALID_CHARS
+CML_SERVER = "cml.example.com"
+
+
+@pytest.mark.parametrize(
+    "name, sanitized",
+    [
+        ("R1", "R1"),
+        ('a<b>c:d"e/f\\g|h?i*j', "a_b_c_d_e_f_g_h_i_j"),
+        ("tab\there", "tab_here"),
+        ("trailing. . ", "trailing"),
+        ("CON", "_CON"),
+        ("lpt1.txt", "_lpt1.txt"),
+        ("CONSOLE", "CONSOLE"),
+        ("...", "_"),
+        ("Ünïcode ✓", "Ünïcode ✓"),
+    ],
+)
+def test_sanitize_name(name, sanitized):
+    assert session_gen.sanitize_name(name, INVALID_CHARS) == sanitized
+
+
+def test_collisions_ignore_case_and_order():
+    names = {"n3": "R1", "n1": "r1", "n2": "R/1", "n4": "R_1"}
+    resolved = session_gen.unique_names(names, INVALID_CHARS)
+
+    assert resolved == session_gen.unique_names(
+        dict(reversed(list(names.items()))), INVALID_CHARS
+    )
+    assert len(set(name.casefold() for name in resolved.values())) == len(names)
+    # Unchanged names win over sanitized ones, then the lowest key
+    assert resolved["n1"] == "r1"
+    assert resolved["n4"] == "R_1"
+    assert resolved["n3"] == "R1 (2)"
+    assert resolved["n2"] == "R_1 (2)"
+
+
+def test_suffix_skips_names_already_taken():
+    resolved = session_gen.unique_names(
+        {"a": "R1", "b": "R1", "c": "R1 (2)"}, INVALID_CHARS
+    )
+    assert resolved == {"a": "R1", "b": "R1 (3)", "c": "R1 (2)"}
+
+
+def test_previous_holder_keeps_the_unsuffixed_name():
+    # "a" sorts first, but "b" had the name last time
+    resolved = session_gen.unique_names(
+        {"a": "core", "b": "Core"}, INVALID_CHARS, {"b": "Core"}
+    )
+    assert resolved == {"a": "core (2)", "b": "Core"}
+
+
+def test_previous_suffix_is_kept():
+    resolved = session_gen.unique_names(
+        {"a": "R1", "b": "R1", "c": "R1"},
+        INVALID_CHARS,
+        {"b": "R1", "c": "R1 (3)"},
+    )
+    assert resolved == {"a": "R1 (2)", "b": "R1", "c": "R1 (3)"}
+
+
+def lab_info(labs):
+    # labs maps lab ID -> (title, {node ID: label})
+    lab_tiles = dict()
+    for lab_id, (lab_title, nodes) in labs.items():
+        lab_tiles[lab_id] = {
+            "id": lab_id,
+            "lab_title": lab_title,
+            "state": "STOPPED",
+            "topology": {
+                "nodes": [
+                    {"id": node_id, "label": label, "node_definition": "iosv"}
+                    for node_id, label in nodes.items()
+                ]
+            },
+        }
+    return session_gen.build_lab_info(lab_tiles)
+
+
+def generate(sessions_cml_labs_dir, labs):
+    info = lab_info(labs)
+    results = session_gen.batch_generate(
+        sessions_cml_labs_dir, info, info["lab_details"], INVALID_CHARS
+    )
+    assert [result["error"] for result in results] == [None] * len(results)
+    return {result["lab_id"]: result["session_dir"] for result in results}
+
+
+def test_lab_and_node_names_are_stable_across_runs(make_sessions_dir):
+    sessions_cml_labs_dir = os.path.join(
+        make_sessions_dir(CML_SERVER), session_gen.cml_labs_dir_name(CML_SERVER)
+    )
+
+    generate(sessions_cml_labs_dir, {"lab-b": ("Core", {"n2": "R1"})})
+    core_dir = os.path.join(sessions_cml_labs_dir, "Core")
+    with open(os.path.join(core_dir, "R1.ini"), "rb") as f:
+        first_r1 = f.read()
+
+    # A lab and a node whose IDs sort first now collide with both names
+    session_dirs = generate(
+        sessions_cml_labs_dir,
+        {
+            "lab-a": ("core", {"n1": "r1"}),
+            "lab-b": ("Core", {"n1": "r1", "n2": "R1"}),
+        },
+    )
+
+    assert session_dirs["lab-b"] == core_dir
+    assert session_dirs["lab-a"] == os.path.join(sessions_cml_labs_dir, "core (2)")
+    assert sorted(os.listdir(core_dir)) == sorted(
+        [session_gen.SESSION_MANIFEST_FILENAME, "R1.ini", "r1 (2).ini"]
+    )
+    manifest = session_gen.load_session_manifest(core_dir)
+    assert manifest["n2"]["filename"] == "R1.ini"
+    with open(os.path.join(core_dir, "R1.ini"), "rb") as f:
+        assert f.read() == first_r1
+
+
+def test_nodes_without_id_keep_their_own_sessions(make_sessions_dir):
+    sessions_cml_labs_dir = os.path.join(
+        make_sessions_dir(CML_SERVER), session_gen.cml_labs_dir_name(CML_SERVER)
+    )
+    lab_tile = session_gen.compact_lab_tile(
+        {
+            "id": "lab-a",
+            "lab_title": "Old",
+            "state": "STOPPED",
+            "topology": {
+                "nodes": [
+                    {"label": "R1", "node_definition": "iosv"},
+                    {"label": "R2", "node_definition": "iosv"},
+                ]
+            },
+        }
+    )
+    info = session_gen.build_lab_info({"lab-a": lab_tile})
+
+    results = session_gen.batch_generate(
+        sessions_cml_labs_dir, info, info["lab_details"], INVALID_CHARS
+    )
+
+    session_dir = results[0]["session_dir"]
+    assert sorted(results[0]["session_sync"]["added"]) == ["R1.ini", "R2.ini"]
+    assert len(session_gen.load_session_manifest(session_dir)) == 2
+
+    renamed_tile = dict(
+        lab_tile,
+        topology={"nodes": [dict(lab_tile["topology"]["nodes"][0], label="R3")]},
+    )
+    assert session_gen.lab_fingerprint(renamed_tile) != session_gen.lab_fingerprint(
+        lab_tile
+    )
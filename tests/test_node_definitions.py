@@ -0,0 +1,62 @@
+import session_gen
+
+
+def fetch_catalog(fake_cml, config_yaml):
+    # Returns (serial ports, paths requested) as at the start of a process
+    session_gen._cml_versions.clear()
+    session_gen._conditional_responses.clear()
+    validate_return = session_gen.validate_settings_get_token(
+        "user", "password", fake_cml.controller
+    )
+    fake_cml.requests.clear()
+    serial_ports = session_gen.get_node_definitions(
+        config_yaml, validate_return["cml_url"], validate_return["bearer_token"]
+    )
+
+    return serial_ports, [path for _, path in fake_cml.requests]
+
+
+def test_fresh_catalog_needs_no_request(fake_cml, tmp_path):
+    config_yaml = str(tmp_path / "config.yaml")
+
+    serial_ports, paths = fetch_catalog(fake_cml, config_yaml)
+    assert paths == ["/system_information", "/node_definitions"]
+    assert serial_ports["nxosv9000"] == 2
+    assert serial_ports["external_connector"] == 0
+
+    assert fetch_catalog(fake_cml, config_yaml) == (serial_ports, [])
+
+
+def test_expired_catalog_is_fetched_again(fake_cml, tmp_path, monkeypatch):
+    config_yaml = str(tmp_path / "config.yaml")
+    serial_ports, _ = fetch_catalog(fake_cml, config_yaml)
+
+    now = session_gen.time.time()
+    monkeypatch.setattr(
+        session_gen.time,
+        "time",
+        lambda: now + session_gen.NODE_DEFINITIONS_MAX_AGE + 1,
+    )
+
+    assert fetch_catalog(fake_cml, config_yaml) == (
+        serial_ports,
+        ["/system_information", "/node_definitions"],
+    )
+
+
+def test_known_version_change_refreshes_catalog(fake_cml, tmp_path):
+    config_yaml = str(tmp_path / "config.yaml")
+    fetch_catalog(fake_cml, config_yaml)
+
+    base_url = session_gen.api_base_url(fake_cml.controller)
+    cache_file = session_gen.node_definitions_cache_path(config_yaml)
+    catalog_cache = session_gen.load_json_cache(cache_file)
+    catalog_cache[base_url]["version"] = "2.4.0"
+    session_gen.save_json_cache(cache_file, catalog_cache)
+
+    session_gen._cml_versions.clear()
+    session_gen.get_cml_version(base_url)
+    fake_cml.requests.clear()
+    session_gen.get_node_definitions(config_yaml, base_url, "token")
+
+    assert [path for _, path in fake_cml.requests] == ["/node_definitions"]
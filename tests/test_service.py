@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import session_gen
+
+TOKEN = "test-token"
+
+
+@pytest.fixture
+def service_url(fake_cml, sessions_dir, tmp_path):
+
+    service = dict()
+    service["args"] = session_gen.parse_args(["--serve"])
+    service["cml_configs"] = {"cml_server": fake_cml.controller}
+    service["sessions_dir"] = sessions_dir
+    service["lab_info"] = session_gen.open_controller(
+        fake_cml.controller, "user", "password", str(tmp_path / "config.yaml")
+    )
+    service["refreshed"] = None
+    service["error"] = None
+    service["lock"] = threading.Lock()
+    service["generate_lock"] = threading.Lock()
+    service["token"] = TOKEN
+
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), session_gen.make_service_handler(service)
+    )
+    threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    ).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def call(base_url, method, path, body=None, token=TOKEN):
+    request = urllib.request.Request(
+        base_url + path,
+        method=method,
+        headers={"Authorization": "Bearer " + token},
+        data=body,
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as err:
+        return err.code, json.loads(err.read())
+
+
+def test_wrong_token_is_rejected(service_url):
+    assert call(service_url, "GET", "/labs", token="wrong")[0] == 401
+
+
+def test_list_labs(service_url, fake_cml):
+    status, body = call(service_url, "GET", "/labs")
+    assert status == 200
+    assert set(lab["id"] for lab in body["labs"]) == set(fake_cml.labs)
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b"[1]",
+        b"not json",
+        b'{"lab_ids": [1]}',
+        b'{"lab_ids": {"a": 1}}',
+        b'{"title": 5}',
+        b'{"state": ["STARTED"]}',
+        b'{"all_consoles": "yes"}',
+    ],
+)
+def test_bad_generate_body_is_400(service_url, body):
+    status, response_body = call(service_url, "POST", "/generate", body)
+    assert status == 400
+    assert "error" in response_body
+
+
+def test_unknown_lab_is_404(service_url):
+    assert call(service_url, "POST", "/labs/nope/generate", b"")[0] == 404
+
+
+def test_unexpected_error_is_500(service_url, monkeypatch):
+    def broken(*args, **kwargs):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(session_gen, "generate_sessions", broken)
+    status, body = call(service_url, "POST", "/generate", b"{}")
+    assert status == 500
+    assert body["error"] == "RuntimeError: boom"
+
+
+def test_generate(service_url, fake_cml):
+    lab_id = next(iter(fake_cml.labs))
+    status, body = call(
+        service_url, "POST", "/generate", json.dumps({"lab_ids": lab_id}).encode()
+    )
+    assert status == 200
+    assert [result["lab_id"] for result in body["results"]] == [lab_id]
+    assert all(os.path.isfile(path) for path in body["results"][0]["written"])
+
+    status, body = call(service_url, "POST", f"/labs/{lab_id}/generate", b"")
+    assert status == 200
+    assert body["results"][0]["written"] == []
+
+
+def test_refresh_failure_is_reported_and_survived(monkeypatch):
+    def malformed_lab_tile(*args, **kwargs):
+        raise KeyError("id")
+
+    monkeypatch.setattr(session_gen, "open_controller", malformed_lab_tile)
+    lab_info = {"lab_tiles": dict(), "lab_details": []}
+    service = dict()
+    service["cml_configs"] = {
+        "cml_server": "cml.example.com",
+        "cml_user": "user",
+        "cml_pass": "password",
+    }
+    service["offline"] = False
+    service["lab_info"] = lab_info
+    service["error"] = None
+    service["lock"] = threading.Lock()
+
+    session_gen.refresh_inventory(service)
+
+    assert service["lab_info"] is lab_info
+    assert service["error"] == "KeyError: 'id'"
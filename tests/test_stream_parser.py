@@ -0,0 +1,85 @@
+import json
+import random
+
+import pytest
+
+import session_gen
+
+
+def chunked(data, size):
+    return [data[index : index + size] for index in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize(
+    "chunks, expected",
+    [
+        ([b'{"x": 1.', b'5, "lab_tiles": {"a": 1}}'], [("a", 1)]),
+        ([b'{"lab_tiles": {"a": 1.', b"5}}"], [("a", 1.5)]),
+        ([b'{"lab_tiles": {"a": 1.5e', b"10}}"], [("a", 1.5e10)]),
+        ([b'{"lab_tiles": {"a": -', b"2E+", b"3}}"], [("a", -2e3)]),
+        ([b'{"lab_tiles": {"a": 12', b"34}}"], [("a", 1234)]),
+        ([b'{"lab_tiles": {"a": tr', b"ue}}"], [("a", True)]),
+    ],
+)
+def test_number_split_at_chunk_boundary(chunks, expected):
+    assert list(session_gen.iter_lab_tiles(chunks)) == expected
+
+
+def test_every_chunk_size_matches_json_loads():
+    rng = random.Random(7)
+    body = {
+        "other": [1.5e10, -3.25e-7, {"nested": "value"}],
+        "lab_tiles": {
+            f"lab{number}": {
+                "lab_title": f"Lab {number} ü",
+                "float": rng.uniform(-1e12, 1e12),
+                "exponent": 1.5e10,
+                "count": number,
+                "flags": [True, False, None],
+            }
+            for number in range(30)
+        },
+    }
+    data = json.dumps(body).encode("utf-8")
+
+    for size in range(1, 48):
+        assert dict(session_gen.iter_lab_tiles(chunked(data, size))) == (
+            body["lab_tiles"]
+        )
+
+
+def test_truncated_response_raises():
+    with pytest.raises(ValueError):
+        list(session_gen.iter_lab_tiles([b'{"lab_tiles": {"a": 1']))
+
+
+def test_populate_lab_tiles_from_fake_cml(fake_cml):
+    validate_return = session_gen.validate_settings_get_token(
+        "user", "password", fake_cml.controller
+    )
+    lab_tiles = session_gen.get_populated_lab_tiles(
+        validate_return["cml_url"], validate_return["bearer_token"]
+    )
+
+    assert set(lab_tiles) == set(fake_cml.labs)
+
+
+def test_bytes_received_are_counted_compressed(fake_cml):
+    session_gen.reset_run_stats()
+    validate_return = session_gen.validate_settings_get_token(
+        "user", "password", fake_cml.controller
+    )
+    bytes_sent = fake_cml.bytes_sent
+    session_gen.reset_run_stats()
+
+    session_gen.get_populated_lab_tiles(
+        validate_return["cml_url"], validate_return["bearer_token"]
+    )
+    session_gen.cml_api_get_json(
+        validate_return["cml_url"], "/labs", validate_return["bearer_token"]
+    )
+
+    assert (
+        session_gen.run_stats()["http_bytes_received"]
+        == fake_cml.bytes_sent - bytes_sent
+    )
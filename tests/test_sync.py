@@ -0,0 +1,117 @@
+import os
+
+import session_gen
+from fake_cml import build_responses
+
+INVALID_CHARS = session_gen.INVALID_CHARS
+
+
+def fetch_lab_info(fake_cml):
+    validate_return = session_gen.validate_settings_get_token(
+        "user", "password", fake_cml.controller
+    )
+    return session_gen.build_lab_info(
+        session_gen.get_populated_lab_tiles(
+            validate_return["cml_url"], validate_return["bearer_token"]
+        )
+    )
+
+
+def generate(fake_cml, sessions_cml_labs_dir):
+    # Returns the result of the first lab
+    lab_info = fetch_lab_info(fake_cml)
+    results = session_gen.batch_generate(
+        sessions_cml_labs_dir, lab_info, lab_info["lab_details"][:1], INVALID_CHARS
+    )
+    assert results[0]["error"] is None
+
+    return results[0]
+
+
+def edit_first_lab(fake_cml, edit):
+    lab = next(iter(fake_cml.labs.values()))
+    lab["nodes"] = edit(lab["nodes"])
+    fake_cml.set_responses(build_responses(fake_cml.labs, fake_cml.version))
+
+
+def test_unchanged_lab_is_not_touched(fake_cml, sessions_cml_labs_dir):
+    first_run = generate(fake_cml, sessions_cml_labs_dir)
+    session_dir = first_run["session_dir"]
+    assert "R0.ini" in first_run["session_sync"]["added"]
+    mtimes = {
+        dir_entry.name: dir_entry.stat().st_mtime_ns
+        for dir_entry in os.scandir(session_dir)
+    }
+
+    second_run = generate(fake_cml, sessions_cml_labs_dir)
+
+    session_sync = second_run["session_sync"]
+    assert session_gen.sessions_written(session_sync) == 0
+    assert session_sync["removed"] == []
+    assert session_sync["unchanged"] == len(first_run["session_sync"]["added"])
+    assert {
+        dir_entry.name: dir_entry.stat().st_mtime_ns
+        for dir_entry in os.scandir(session_dir)
+    } == mtimes
+    staging_dir, backup_dir = session_gen.lab_publish_dirs(session_dir)
+    assert not os.path.exists(staging_dir)
+    assert not os.path.exists(backup_dir)
+
+
+def test_renamed_and_removed_nodes(fake_cml, sessions_cml_labs_dir):
+    session_dir = generate(fake_cml, sessions_cml_labs_dir)["session_dir"]
+    with open(os.path.join(session_dir, "notes.txt"), "w") as f:
+        f.write("not generated")
+
+    def rename_r0_remove_r1(lab_nodes):
+        lab_nodes = [lab_node for lab_node in lab_nodes if lab_node["label"] != "R1"]
+        lab_nodes[0] = dict(lab_nodes[0], label="Edge")
+        return lab_nodes
+
+    edit_first_lab(fake_cml, rename_r0_remove_r1)
+    session_sync = generate(fake_cml, sessions_cml_labs_dir)["session_sync"]
+
+    assert session_sync["renamed"] == [("R0.ini", "Edge.ini")]
+    assert sorted(session_sync["removed"]) == ["R1.ini"]
+    filenames = set(os.listdir(session_dir))
+    assert {"Edge.ini", "R2.ini", "notes.txt"} <= filenames
+    assert not {"R0.ini", "R1.ini"} & filenames
+
+    # The version it replaced is kept as the backup
+    backup_dir = session_gen.lab_publish_dirs(session_dir)[1]
+    assert {"R0.ini", "R1.ini", "notes.txt"} <= set(os.listdir(backup_dir))
+    assert "Edge.ini" not in os.listdir(backup_dir)
+
+
+def test_interrupted_publish_is_recovered(fake_cml, sessions_cml_labs_dir):
+    session_dir = generate(fake_cml, sessions_cml_labs_dir)["session_dir"]
+    staging_dir, backup_dir = session_gen.lab_publish_dirs(session_dir)
+
+    # Stopped between the two renames of publish_lab_session_dir()
+    session_gen.stage_lab_session_dir(session_dir, set())
+    os.makedirs(os.path.dirname(backup_dir))
+    os.rename(session_dir, backup_dir)
+
+    session_sync = generate(fake_cml, sessions_cml_labs_dir)["session_sync"]
+
+    assert session_gen.sessions_written(session_sync) == 0
+    assert "R0.ini" in os.listdir(session_dir)
+    assert not os.path.exists(staging_dir)
+
+
+def test_incomplete_staging_folder_is_discarded(fake_cml, sessions_cml_labs_dir):
+    session_dir = generate(fake_cml, sessions_cml_labs_dir)["session_dir"]
+    staging_dir = session_gen.stage_lab_session_dir(
+        session_dir, {session_gen.SESSION_MANIFEST_FILENAME, "R0.ini"}
+    )
+    with open(os.path.join(staging_dir, "R0.ini"), "w") as f:
+        f.write("half written")
+
+    edit_first_lab(
+        fake_cml, lambda lab_nodes: [dict(lab_nodes[0], label="Edge")] + lab_nodes[1:]
+    )
+    session_sync = generate(fake_cml, sessions_cml_labs_dir)["session_sync"]
+
+    assert session_sync["renamed"] == [("R0.ini", "Edge.ini")]
+    assert not os.path.exists(staging_dir)
+    assert "R0.ini" in os.listdir(session_gen.lab_publish_dirs(session_dir)[1])
@@ -0,0 +1,117 @@
+import os
+import shutil
+
+import pytest
+
+import session_gen
+
+CML_USER = "user"
+CML_PASS = "password"
+CML_SERVER = "cml.example.com"
+
+
+def securecrt_template(source_file, newline):
+    # The node session template as setup and SecureCRT leave it
+    with open(source_file, encoding="utf-8") as f:
+        template_data = f.read()
+    template_data = template_data.replace("CHANGEME_USER", CML_USER)
+    template_data = template_data.replace("CHANGEME_CONTR", CML_SERVER)
+    template_data = template_data.replace(
+        "CHANGEME_CMD", session_gen.NODE_SESSION_COMMAND
+    )
+    template_data = template_data.replace(
+        'S:"Password V2"=\n', 'S:"Password V2"=02:0123456789abcdef\n'
+    )
+
+    return template_data.replace("\n", newline).encode("utf-8")
+
+
+@pytest.fixture
+def setup_dirs(tmp_path):
+    source_file = str(tmp_path / "cml_console_server")
+    shutil.copyfile(
+        os.path.join(
+            session_gen.os.path.dirname(session_gen.__file__), "cml_console_server"
+        ),
+        source_file,
+    )
+    sessions_dir = str(tmp_path / "Sessions")
+    sessions_cml_labs_dir = os.path.join(
+        sessions_dir, session_gen.cml_labs_dir_name(CML_SERVER)
+    )
+    os.makedirs(sessions_cml_labs_dir)
+
+    return (
+        str(tmp_path / "config.yaml"),
+        source_file,
+        sessions_dir,
+        os.path.join(sessions_cml_labs_dir, "node_session_template"),
+    )
+
+
+@pytest.mark.parametrize("newline", ["\r\n", "\n"])
+def test_rebuilt_template_matches_securecrt_bytes(setup_dirs, newline):
+    config_yaml, source_file, sessions_dir, template_location = setup_dirs
+    saved_template = securecrt_template(source_file, newline)
+    with open(template_location, "wb") as f:
+        f.write(saved_template)
+    session_gen.save_template_cache(
+        config_yaml, CML_USER, CML_PASS, CML_SERVER, template_location, source_file
+    )
+
+    os.remove(template_location)
+    assert session_gen.reuse_node_session_template(
+        config_yaml, CML_USER, CML_PASS, CML_SERVER, sessions_dir, source_file
+    )
+
+    with open(template_location, "rb") as f:
+        assert f.read() == saved_template
+    # The rebuilt template is accepted as is next time
+    assert session_gen.reuse_node_session_template(
+        config_yaml, CML_USER, CML_PASS, CML_SERVER, sessions_dir, source_file
+    )
+
+
+def test_changed_password_is_not_reused(setup_dirs):
+    config_yaml, source_file, sessions_dir, template_location = setup_dirs
+    with open(template_location, "wb") as f:
+        f.write(securecrt_template(source_file, "\r\n"))
+    session_gen.save_template_cache(
+        config_yaml, CML_USER, CML_PASS, CML_SERVER, template_location, source_file
+    )
+
+    assert not session_gen.reuse_node_session_template(
+        config_yaml, CML_USER, "changed", CML_SERVER, sessions_dir, source_file
+    )
+
+
+def test_setup_with_cached_template_does_not_wait(setup_dirs, fake_cml, monkeypatch):
+    config_yaml, source_file, sessions_dir, template_location = setup_dirs
+    controller_settings = {
+        "cml_user": CML_USER,
+        "cml_pass": CML_PASS,
+        "cml_server": fake_cml.controller,
+    }
+    template_location = os.path.join(
+        sessions_dir,
+        session_gen.cml_labs_dir_name(fake_cml.controller),
+        "node_session_template",
+    )
+    os.makedirs(os.path.dirname(template_location))
+    with open(template_location, "wb") as f:
+        f.write(securecrt_template(source_file, "\r\n"))
+    session_gen.save_template_cache(
+        config_yaml,
+        CML_USER,
+        CML_PASS,
+        fake_cml.controller,
+        template_location,
+        source_file,
+    )
+
+    sleeps = []
+    monkeypatch.setattr(session_gen.time, "sleep", sleeps.append)
+    monkeypatch.setattr(session_gen.os, "system", lambda command: 0)
+    session_gen.setup(source_file, sessions_dir, config_yaml, None, controller_settings)
+
+    assert sleeps == []